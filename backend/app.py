@@ -1,27 +1,148 @@
-from flask import Flask, request, jsonify, render_template
-from helpers import get_client
-from user import User
-from dataset import analyze_user_data
-from predict import make_prediction
+from quart import Quart, request, jsonify, g
+from quart_cors import cors
+from clients import client_pool
+from images import image_analyzer
+from ratelimit import is_rate_limit_error
+from predict import make_prediction, make_batch_prediction, prediction_cache
+from registry import registry
+from attribution import ATTRIBUTION_MODES, ATTRIBUTION_MODE
+from singleflight import SingleFlight
+from metrics import metrics, request_seconds, start_trace, current_trace, profile, process_info, process_startup, TRACE_REQUESTS
+from watchlist import WatchlistStore, refresh_watchlist
+from search_index import user_index, user_info, search_key, normalize_query, merge_results, searches_total, SEARCH_TTL
 import asyncio
-import pandas as pd
-from flask_cors import CORS
+import json
+import os
+import time
 
-app = Flask(__name__)
-CORS(app)
+# served from a long-lived event loop by an ASGI server (hypercorn app:app), so in-flight
+# predictions share one worker while they wait on the network
+app = Quart(__name__)
+app = cors(app, allow_origin='*')
+
+MAX_BATCH_USERS = 500
+MAX_PROFILE_SECONDS = 60
+
+# concurrent /predict requests for the same account share one computation
+predictions = SingleFlight()
+searches = SingleFlight()
+
+watchlist_store = WatchlistStore()
+
+# load and warm the model, explainer and sentiment pipeline once per process
+# workers forked by serve.py inherit them already warm from the master
+@app.before_serving
+async def warm_up():
+    if not registry.is_ready: registry.warm_up_in_background()
+    app.add_background_task(user_index.load) # the /search index, in a thread (a no-op when inherited loaded from serve.py)
+
+# every request is timed, and its spans are collected when tracing is on (TRACE_REQUESTS=1, or ?trace=1 on /predict)
+@app.before_request
+async def start_request():
+    g.request_started = time.perf_counter()
+    if TRACE_REQUESTS or request.args.get('trace') == '1':
+        start_trace(f"{request.method} {request.path}")
+
+# streamed responses (/predict/batch) are timed until their headers are sent
+@app.after_request
+async def finish_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    request_seconds.observe(time.perf_counter() - g.request_started, endpoint=endpoint, method=request.method, status=response.status_code)
+    trace = current_trace()
+    if trace is not None and TRACE_REQUESTS: print(trace.format())
+    return response
+
+def is_admin():
+    token = os.environ.get('ADMIN_TOKEN')
+    return token and request.headers.get('X-Admin-Token') == token
+
+@app.route('/health', methods=['GET'])
+async def health():
+    status = registry.status_info()
+    return jsonify(status), 200 if registry.is_ready else 503
+
+# Twitter session pool, cache and image analyzer counters, and the memory and startup time of this worker
+@app.route('/stats', methods=['GET'])
+async def stats():
+    return jsonify({
+        'clients': client_pool.stats(),
+        'cache': await asyncio.to_thread(prediction_cache.stats), # counts the shared tier's rows
+        'images': image_analyzer.stats(),
+        'search': user_index.stats(),
+        'process': {**process_startup, **process_info()},
+    })
+
+# stage latency histograms and counters in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+async def get_metrics():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+# samples every thread's stack for a while under live traffic, e.g. POST /profile?seconds=10
+# returns collapsed stacks for flamegraph.pl or speedscope
+@app.route('/profile', methods=['POST'])
+async def get_profile():
+    if not is_admin():
+        return jsonify({"error": "Forbidden."}), 403
+    seconds = request.args.get('seconds', 10, type=float)
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        return jsonify({"error": f"seconds must be between 0 and {MAX_PROFILE_SECONDS}."}), 400
+    try:
+        stacks = await profile(seconds)
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    return stacks, 200, {'Content-Type': 'text/plain'}
+
+# swaps in a new model version without restarting, e.g. POST /reload {"version": "8ee01dac955f"} or {"model_path": "model.joblib"}
+# an empty body loads the version models/LATEST points at
+@app.route('/reload', methods=['POST'])
+async def reload_model():
+    if not is_admin():
+        return jsonify({"error": "Forbidden."}), 403
+    body = await request.get_json(silent=True) or {}
+    try:
+        version = await asyncio.to_thread(registry.reload, body.get('model_path'), body.get('version'))
+    except Exception as e:
+        print(f"Exception caught: {e}")
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"version": version})
 
 @app.route('/predict', methods=['POST'])
-def predict():
-    user_input = request.get_json()
+async def predict():
+    user_input = await request.get_json()
     screen_name = user_input.get('screen_name')
+    attribution = user_input.get('attribution', ATTRIBUTION_MODE) # 'exact' (TreeSHAP) or the faster 'path'
+    if attribution not in ATTRIBUTION_MODES:
+        return jsonify({"error": f"attribution must be one of {', '.join(ATTRIBUTION_MODES)}."}), 400
 
-    #single event loop
-    result = asyncio.run(process_prediction(screen_name))
+    # screen names are case-insensitive, so @Foo and @foo share a computation
+    result = await predictions.do(((screen_name or '').lower(), attribution), lambda: process_prediction(screen_name, attribution))
+    # only the request that ran the computation has spans, requests coalesced into it get an empty trace
+    if request.args.get('trace') == '1': result = {**result, 'trace': current_trace().to_dict()}
     return jsonify(result)
 
-async def process_prediction(screen_name):
+# screens many accounts at once, e.g. POST /predict/batch {"screen_names": ["a", "b"]}
+# results are streamed back as newline-delimited JSON in the order they finish
+@app.route('/predict/batch', methods=['POST'])
+async def predict_batch():
+    user_input = await request.get_json()
+    screen_names = user_input.get('screen_names') if user_input else None
+    if not isinstance(screen_names, list) or not all(isinstance(screen_name, str) for screen_name in screen_names):
+        return jsonify({"error": "screen_names must be a list of screen names."}), 400
+    if len(screen_names) > MAX_BATCH_USERS:
+        return jsonify({"error": f"At most {MAX_BATCH_USERS} screen names per batch."}), 400
+    attribution = user_input.get('attribution', ATTRIBUTION_MODE)
+    if attribution not in ATTRIBUTION_MODES:
+        return jsonify({"error": f"attribution must be one of {', '.join(ATTRIBUTION_MODES)}."}), 400
+
+    async def stream():
+        async for result in make_batch_prediction(screen_names, attribution=attribution):
+            yield json.dumps(result) + '\n'
+
+    return stream(), 200, {'Content-Type': 'application/x-ndjson'}
+
+async def process_prediction(screen_name, attribution=ATTRIBUTION_MODE):
     try:
-        bot_status = await make_prediction(screen_name)
+        bot_status = await make_prediction(screen_name, attribution)
         return bot_status
     
     except Exception as e:
@@ -29,29 +150,77 @@ async def process_prediction(screen_name):
         return {"error": str(e)}
 
 
+# latest result of every watched account
+@app.route('/watchlist', methods=['GET'])
+async def get_watchlist():
+    return jsonify(await asyncio.to_thread(watchlist_store.results))
+
+# adds accounts to the watchlist, e.g. POST /watchlist {"screen_names": ["a", "b"]}
+@app.route('/watchlist', methods=['POST'])
+async def add_to_watchlist():
+    if not is_admin():
+        return jsonify({"error": "Forbidden."}), 403
+    user_input = await request.get_json(silent=True) or {}
+    screen_names = user_input.get('screen_names')
+    if not isinstance(screen_names, list) or not all(isinstance(screen_name, str) and screen_name for screen_name in screen_names):
+        return jsonify({"error": "screen_names must be a list of screen names."}), 400
+    added = await asyncio.to_thread(lambda: sum(watchlist_store.add(screen_name) for screen_name in screen_names))
+    return jsonify({"added": added, "watched": len(watchlist_store)})
+
+@app.route('/watchlist/<screen_name>', methods=['DELETE'])
+async def remove_from_watchlist(screen_name):
+    if not is_admin():
+        return jsonify({"error": "Forbidden."}), 403
+    if not await asyncio.to_thread(watchlist_store.remove, screen_name):
+        return jsonify({"error": "Not on the watchlist."}), 404
+    return jsonify({"removed": screen_name})
+
+# re-scores every watched account from the tweets posted since its last refresh, streamed back as newline-delimited JSON
+# POST /watchlist/refresh?full=1 refetches every window from scratch
+@app.route('/watchlist/refresh', methods=['POST'])
+async def refresh_watched():
+    if not is_admin():
+        return jsonify({"error": "Forbidden."}), 403
+    full = request.args.get('full') == '1'
+
+    async def stream():
+        async for result in refresh_watchlist(watchlist_store, full):
+            yield json.dumps(result) + '\n'
+
+    return stream(), 200, {'Content-Type': 'application/x-ndjson'}
+
+# calls client.search_user once for concurrent identical queries, its results are cached and added to the local index
+async def search_upstream(query: str):
+    users = await client_pool.run(lambda client: client.search_user(query))
+    users_data = [user_info(user) for user in users]
+    await prediction_cache.set_async(search_key(query), users_data, SEARCH_TTL)
+    await asyncio.to_thread(user_index.add, *users_data)
+    return users_data
+
+# answered from the local index of known accounts when it has enough matches, then from a cached upstream response
+# for the same query, and only then by the Twitter API; when that is rate limited, whatever matched locally is returned
 @app.route('/search/<username>', methods=['GET'])
 async def get_users(username):
+    local_users = await asyncio.to_thread(user_index.search, username)
+    if user_index.is_hit(username, local_users):
+        searches_total.inc(source='local')
+        return jsonify(local_users)
+
+    cached = await prediction_cache.get_async(search_key(username), SEARCH_TTL)
+    if cached is not None:
+        searches_total.inc(source='cache')
+        return jsonify(merge_results(cached, local_users))
+
     try:
-        client = get_client()
-        users = await client.search_user(username)
-        users_data = []
-        for user in users:
-            user_info = {
-                'id': user.id,
-                'screen_name': user.screen_name,
-                'name': user.name,
-                'profile_image': user.profile_image_url,
-                'verified': user.verified,
-                'is_blue_verified': user.is_blue_verified,
-                'followers_count': user.followers_count,
-                'following_count': user.following_count,
-                'statuses_count': user.statuses_count,
-            }
-            users_data.append(user_info)
-        return jsonify(users_data)
+        users_data = await searches.do(normalize_query(username), lambda: search_upstream(username))
+        searches_total.inc(source='upstream')
+        return jsonify(merge_results(users_data, local_users))
     except Exception as e:
         print(f"Exception caught: {e}")
-        if 'Rate limit exceeded' in str(e):
+        if local_users:
+            searches_total.inc(source='local_fallback')
+            return jsonify(local_users)
+        if is_rate_limit_error(e):
             return {"error": 'Rate limit exceeded. Try again in 15 minutes.'}
         return {"error": str(e)}
    
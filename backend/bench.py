@@ -0,0 +1,314 @@
+import argparse
+import asyncio
+import contextlib
+import functools
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from fake_twitter import generate_fixtures, load_fixtures, use_fake_twitter
+
+# Offline benchmark suite: runs the prediction and crawling paths against fake_twitter fixtures, no cookies needed
+# reports end-to-end and per-stage p50/p95/p99 latency, throughput and peak traced memory for each benchmark
+# usage: python bench.py --users 20 --latency 0.05 --out bench_results.json
+#        python bench.py --baseline bench_results.json   (exits with 1 when a metric regressed more than --tolerance)
+
+PERCENTILES = (50, 95, 99)
+BENCHMARKS = ['make_prediction', 'make_prediction_cached', 'analyze_user_data', 'predict_endpoint', 'search_endpoint', 'crawl']
+
+# Deterministic stand-in for the sentiment pipeline, costs `cost` seconds per text (sleeping, like torch releases the GIL)
+class FakeSentimentAnalyzer:
+    def __init__(self, cost=0.002):
+        self.cost = cost
+
+    def __call__(self, texts, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else texts
+        if self.cost: time.sleep(self.cost * len(texts))
+        results = []
+        for text in texts:
+            negative = (sum(map(ord, text)) % 97) / 97
+            results.append([{'label': 'LABEL_0', 'score': negative}, {'label': 'LABEL_1', 'score': (1 - negative) / 2}, {'label': 'LABEL_2', 'score': (1 - negative) / 2}])
+        return results[0] if single else results
+
+# Collects durations per stage by wrapping functions for the duration of a benchmark
+class StageTimer:
+    def __init__(self):
+        self.durations = {}
+        self._patches = []
+
+    def record(self, stage: str, seconds: float):
+        self.durations.setdefault(stage, []).append(seconds)
+
+    # replaces owner.name with a timed version, sync or async
+    def wrap(self, owner, name: str, stage: str):
+        original = getattr(owner, name)
+        if asyncio.iscoroutinefunction(original):
+            @functools.wraps(original)
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+        else:
+            @functools.wraps(original)
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - start)
+        self._patches.append((owner, name, vars(owner).get(name)))
+        setattr(owner, name, timed)
+
+    def restore(self):
+        for owner, name, original in reversed(self._patches):
+            if original is None: delattr(owner, name) # was looked up on the class
+            else: setattr(owner, name, original)
+        self._patches = []
+
+    def reset(self):
+        self.durations = {}
+
+# returns latency percentiles in milliseconds
+def summarize(durations: list):
+    if not durations: return {}
+    values = np.array(durations) * 1000
+    summary = {f"p{p}": round(float(np.percentile(values, p)), 3) for p in PERCENTILES}
+    summary['mean'] = round(float(values.mean()), 3)
+    summary['count'] = len(values)
+    return summary
+
+# runs fn(item) for every item, at most concurrency at a time, returns (per-item latencies, wall time)
+async def run_all(fn, items: list, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def run(item):
+        async with semaphore:
+            start = time.perf_counter()
+            await fn(item)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(item) for item in items))
+    return latencies, time.perf_counter() - start
+
+# Benchmarks share one set of fake sessions, caches are emptied before each run so every user is fetched cold
+# the prediction cache and the /search index are swapped for ones in a temporary directory, so fake accounts never reach
+# the shared cache.sqlite3 or users.sqlite3 (app and predict import them by name, both are replaced)
+class BenchSuite:
+    def __init__(self, fixtures: dict, args):
+        import app, predict, dataset, streaming
+        from cache import TieredCache, MemoryCache
+        from clients import client_pool
+        from images import image_analyzer, LRUCache, IMAGE_CACHE_SIZE
+        from registry import registry, get_model_path
+
+        self.fixtures, self.args = fixtures, args
+        self.users = fixtures['users']
+        self.app, self.predict, self.dataset, self.streaming = app, predict, dataset, streaming
+        self.tmp = tempfile.TemporaryDirectory()
+        self.user_indexes = 0
+        self.image_analyzer, self.LRUCache, self.IMAGE_CACHE_SIZE = image_analyzer, LRUCache, IMAGE_CACHE_SIZE
+        self.clients = use_fake_twitter(client_pool, fixtures, sessions=args.sessions, analyzer=image_analyzer, image_latency=args.latency, latency=args.latency, jitter=args.jitter)
+
+        if args.sentiment == 'fake': registry._sentiment_analyzer = FakeSentimentAnalyzer(args.sentiment_cost)
+        try:
+            model_path = registry.model_path or get_model_path()
+        except FileNotFoundError as e: # MODEL_VERSION or models/LATEST names a missing version
+            model_path = None
+            print(e)
+        self.has_model = model_path is not None and os.path.exists(model_path)
+        if self.has_model: registry.warm_up()
+        else: print(f"No model at {model_path or 'the configured version'}, skipping the prediction benchmarks (train one with python train.py --promote).")
+
+        predict.prediction_cache = app.prediction_cache = TieredCache(MemoryCache()) # memory only, the benchmark shouldn't touch the shared cache
+        self.reset_user_index()
+        self.timer = StageTimer()
+
+    # a fresh index of the dataset accounts only, so one benchmark doesn't answer another's searches
+    def reset_user_index(self):
+        from search_index import UserIndex
+        self.user_indexes += 1
+        index = UserIndex(os.path.join(self.tmp.name, f"users-{self.user_indexes}.sqlite3"))
+        index.load()
+        self.predict.user_index = self.app.user_index = index
+
+    def clear_caches(self):
+        self.predict.prediction_cache.memory.clear()
+        self.image_analyzer.url_cache = self.LRUCache(self.IMAGE_CACHE_SIZE)
+        self.image_analyzer.content_cache = self.LRUCache(self.IMAGE_CACHE_SIZE)
+
+    def instrument(self):
+        timer, predict, dataset = self.timer, self.predict, self.dataset
+        timer.wrap(predict, 'compute_features', 'features')
+        timer.wrap(predict, 'predict_features', 'model')
+        timer.wrap(predict, 'aggregate_timeline', 'timeline')
+        timer.wrap(dataset, 'aggregate_timeline', 'timeline')
+        timer.wrap(dataset, 'add_user_to_dataset', 'crawl_user')
+        timer.wrap(self.streaming.TimelineAggregator, 'add_page', 'page_analysis')
+        timer.wrap(self.image_analyzer, 'analyze', 'image')
+        for client in self.clients:
+            timer.wrap(client, '_request', 'twitter_request')
+
+    async def make_prediction(self):
+        self.clear_caches()
+        return await run_all(lambda user: self.predict.make_prediction(user['screen_name']), self.users, self.args.concurrency)
+
+    async def make_prediction_cached(self):
+        await run_all(lambda user: self.predict.make_prediction(user['screen_name']), self.users, self.args.concurrency) # fill
+        return await run_all(lambda user: self.predict.make_prediction(user['screen_name']), self.users, self.args.concurrency)
+
+    async def analyze_user_data(self):
+        self.clear_caches()
+        client = self.clients[0]
+        async def analyze(user):
+            fake_user = await client.get_user_by_id(user['id'])
+            await self.dataset.analyze_user_data(fake_user, 'bot')
+        return await run_all(analyze, self.users, self.args.concurrency)
+
+    async def predict_endpoint(self):
+        self.clear_caches()
+        test_client = self.app.app.test_client()
+        async def post(user):
+            response = await test_client.post('/predict', json={'screen_name': user['screen_name']})
+            assert response.status_code == 200, response.status_code
+        return await run_all(post, self.users, self.args.concurrency)
+
+    async def search_endpoint(self):
+        self.clear_caches()
+        self.reset_user_index() # fixture accounts go upstream once, not answered from what the prediction benchmarks added
+        test_client = self.app.app.test_client()
+        async def search(user):
+            response = await test_client.get(f"/search/{user['screen_name'][:-1]}")
+            assert response.status_code == 200, response.status_code
+        return await run_all(search, self.users, self.args.concurrency)
+
+    async def crawl(self):
+        from datastore import DatasetStore
+        self.clear_caches()
+        with tempfile.TemporaryDirectory() as tmp:
+            csv = os.path.join(tmp, 'users.csv')
+            pd.DataFrame({'id': ['u' + user['id'] for user in self.users], 'label': ['bot' if user['screen_name'].startswith('bot') else 'human' for user in self.users]}).to_csv(csv, index=False)
+            store = DatasetStore(os.path.join(tmp, 'store'))
+            before = len(self.timer.durations.get('crawl_user', []))
+            start = time.perf_counter()
+            await self.dataset.create_dataset(self.args.concurrency, store=store, csvs=[csv], state_path=os.path.join(tmp, 'state.json'), num_users=len(self.users), requests_per_window=10**9)
+            wall = time.perf_counter() - start
+        return self.timer.durations.get('crawl_user', [])[before:], wall
+
+    # runs one benchmark: timed repeats, then one pass under tracemalloc for the peak
+    async def run(self, name: str):
+        latencies, walls, items = [], [], 0
+        self.timer.reset()
+        self.instrument()
+        try:
+            for _ in range(self.args.repeat):
+                run_latencies, wall = await getattr(self, name)()
+                latencies += run_latencies
+                walls.append(wall)
+                items += len(self.users)
+            stages = {stage: summarize(durations) for stage, durations in sorted(self.timer.durations.items())}
+        finally:
+            self.timer.restore()
+
+        tracemalloc.start()
+        try:
+            await getattr(self, name)()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        return {
+            'latency_ms': summarize(latencies),
+            'throughput': round(items / sum(walls), 3), # users per second
+            'peak_mb': round(peak / 2**20, 3),
+            'stages': stages,
+        }
+
+# returns {benchmark: {metric: (baseline, current, change)}} and the list of regressions above tolerance
+def compare(results: dict, baseline: dict, tolerance: float):
+    report, regressions = {}, []
+    for name, current in results['benchmarks'].items():
+        previous = baseline.get('benchmarks', {}).get(name)
+        if not previous: continue
+        metrics = {f"latency {p}": (previous['latency_ms'].get(p), current['latency_ms'].get(p)) for p in ('p50', 'p95', 'p99')}
+        metrics['throughput'] = (previous['throughput'], current['throughput'])
+        metrics['peak_mb'] = (previous['peak_mb'], current['peak_mb'])
+        report[name] = {}
+        for metric, (before, after) in metrics.items():
+            if not before or after is None: continue
+            change = (after - before) / before
+            report[name][metric] = (before, after, change)
+            worse = -change if metric == 'throughput' else change # higher throughput is better, lower everything else
+            if worse > tolerance: regressions.append(f"{name} {metric}: {before} -> {after} ({change:+.1%})")
+    return report, regressions
+
+def print_results(results: dict):
+    for name, result in results['benchmarks'].items():
+        latency = result['latency_ms']
+        print(f"\n{name}: p50 {latency.get('p50')}ms, p95 {latency.get('p95')}ms, p99 {latency.get('p99')}ms, {result['throughput']} users/s, peak {result['peak_mb']}MB")
+        for stage, summary in result['stages'].items():
+            print(f"  {stage:<16} p50 {summary['p50']:>9.3f}ms  p95 {summary['p95']:>9.3f}ms  p99 {summary['p99']:>9.3f}ms  ({summary['count']} calls)")
+    print(f"\nMax RSS: {results['max_rss_mb']}MB")
+
+async def main(args):
+    fixtures = load_fixtures(args.fixtures) if args.fixtures else generate_fixtures(args.users, args.tweets, seed=args.seed)
+    quiet = contextlib.redirect_stdout(io.StringIO()) if not args.verbose else contextlib.nullcontext()
+    suite = BenchSuite(fixtures, args)
+    names = [name for name in (args.only or BENCHMARKS) if suite.has_model or name in ('analyze_user_data', 'search_endpoint', 'crawl')]
+
+    results = {'config': {key: value for key, value in vars(args).items() if key not in ('baseline', 'out', 'only')}, 'benchmarks': {}}
+    for name in names:
+        print(f"Running {name}...", file=sys.stderr)
+        with quiet:
+            results['benchmarks'][name] = await suite.run(name)
+    results['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the prediction and crawling paths')
+    parser.add_argument('--fixtures', help='fixtures JSON from fake_twitter.py, synthetic users are generated otherwise')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--tweets', type=int, default=125)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per simulated Twitter/image request')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--sessions', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--sentiment', choices=['fake', 'real'], default='fake')
+    parser.add_argument('--sentiment-cost', type=float, default=0.002, help='seconds per text for the fake sentiment model')
+    parser.add_argument('--only', nargs='*', choices=BENCHMARKS)
+    parser.add_argument('--out', help='write the results as JSON, e.g. to use as a baseline later')
+    parser.add_argument('--baseline', help='results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative change that counts as a regression')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    results = asyncio.run(main(args))
+    print_results(results)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.out}.")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            report, regressions = compare(results, json.load(f), args.tolerance)
+        print(f"\nCompared with {args.baseline}:")
+        for name, metrics in report.items():
+            print(f"  {name}: " + ', '.join(f"{metric} {change:+.1%}" for metric, (_, _, change) in metrics.items()))
+        if regressions:
+            print(f"\nRegressions above {args.tolerance:.0%}:\n  " + '\n  '.join(regressions))
+            sys.exit(1)
+        print("No regressions.")
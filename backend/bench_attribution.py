@@ -0,0 +1,67 @@
+import argparse
+import time
+import joblib
+import numpy as np
+import shap
+from attribution import AttributionEngine, TOP_K
+from registry import get_model_path
+from helpers import features_dict
+
+# Benchmark of shap.TreeExplainer against the serving attribution engine
+# usage: python bench_attribution.py --rows 1 --repeat 20
+
+# returns rows to explain, from the dataset when there is one and synthetic otherwise
+def make_rows(n: int, n_features: int, seed=0):
+    try:
+        from datastore import load_dataset
+        df = load_dataset().fillna(0)
+        X = df[list(features_dict)].values
+        return X[np.random.default_rng(seed).integers(0, len(X), n)]
+    except Exception as e:
+        print(f"Using synthetic rows ({e})")
+        return np.random.default_rng(seed).exponential(10, (n, n_features))
+
+def time_it(fn, repeat: int):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', help='model file, the served version by default')
+    parser.add_argument('--rows', type=int, default=1)
+    parser.add_argument('--top-k', type=int, default=TOP_K)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    args.model = args.model or get_model_path()
+
+    model = joblib.load(args.model)
+    X = make_rows(args.rows, model.n_features_in_)
+    classes = model.predict(X)
+
+    build_time, engine = time_it(lambda: AttributionEngine(model), 1)
+    explainer = engine.explainer
+    engine.top_k(X, classes, args.top_k, 'exact') # warm up
+    engine.top_k(X, classes, args.top_k, 'path')
+
+    shap_time, shap_values = time_it(lambda: shap.TreeExplainer(model).shap_values(X), args.repeat) # what serving used to do
+    cached_time, _ = time_it(lambda: explainer.shap_values(X), args.repeat)
+    exact_time, (exact_indices, _) = time_it(lambda: engine.top_k(X, classes, args.top_k, 'exact'), args.repeat)
+    path_time, (path_indices, _) = time_it(lambda: engine.top_k(X, classes, args.top_k, 'path'), args.repeat)
+
+    exact_diff = np.abs(engine.contributions(X, 'exact') - np.asarray(shap_values)).max()
+    path_total_diff = np.abs(engine.contributions(X, 'path').sum(axis=1) + engine.bias - model.predict_proba(X)).max()
+    same_set = np.mean([set(a) == set(b) for a, b in zip(exact_indices, path_indices)])
+    same_first = np.mean(exact_indices[:, 0] == path_indices[:, 0])
+
+    print(f"Rows: {len(X)}, trees: {engine.forest.n_trees}, max depth: {engine.forest.max_depth}, top k: {args.top_k}")
+    print(f"Engine build:            {build_time * 1000:.1f}ms (once per model version)")
+    print(f"New TreeExplainer:       {shap_time * 1000:.2f}ms ({shap_time * 1000 / len(X):.2f}ms/row)")
+    print(f"Cached TreeExplainer:    {cached_time * 1000:.2f}ms ({cached_time * 1000 / len(X):.2f}ms/row)")
+    print(f"Engine exact top k:      {exact_time * 1000:.2f}ms ({exact_time * 1000 / len(X):.2f}ms/row)")
+    print(f"Engine path top k:       {path_time * 1000:.2f}ms ({path_time * 1000 / len(X):.2f}ms/row), {shap_time / path_time:.1f}x faster than a new explainer")
+    print(f"Exact vs shap max difference: {exact_diff:.2e}, path total vs predict_proba max difference: {path_total_diff:.2e}")
+    print(f"Path agrees with exact on the top {args.top_k} set for {same_set:.0%} of rows, on the top feature for {same_first:.0%}")
@@ -0,0 +1,54 @@
+import argparse
+import os
+import tempfile
+import time
+import joblib
+import numpy as np
+from forest import CompiledForest
+from registry import get_model_path
+from bench_attribution import make_rows, time_it
+
+# Benchmark of sklearn's predict_proba against the compiled, memory-mapped forest
+# usage: python bench_forest.py --rows 1 --repeat 50
+
+# returns the resident set size of this process in MB (Linux only)
+def get_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return float('nan')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', help='model file, the served version by default')
+    parser.add_argument('--rows', type=int, default=1)
+    parser.add_argument('--check-rows', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    args.model = args.model or get_model_path()
+
+    rss = get_rss()
+    model = joblib.load(args.model)
+    model_rss = get_rss() - rss
+
+    with tempfile.TemporaryDirectory() as path:
+        CompiledForest.from_sklearn(model).save(path)
+        rss = get_rss()
+        forest = CompiledForest.load(path)
+        forest_rss = get_rss() - rss
+
+        X = make_rows(args.check_rows, model.n_features_in_)
+        X[::7] = X[::7] * np.random.default_rng(1).uniform(0.5, 1.5, X[::7].shape) # off the training rows too
+        same_proba = np.array_equal(model.predict_proba(X), forest.predict_proba(X))
+        same_predict = np.array_equal(model.predict(X), forest.predict(X))
+
+        X = X[:args.rows]
+        sklearn_time, _ = time_it(lambda: model.predict_proba(X), args.repeat)
+        forest_time, _ = time_it(lambda: forest.predict_proba(X), args.repeat)
+
+        print(f"Trees: {forest.n_trees}, nodes: {forest.n_nodes}, max depth: {forest.max_depth}, rows per call: {len(X)}")
+        print(f"Identical to sklearn on {args.check_rows} rows: predict_proba {same_proba}, predict {same_predict}")
+        print(f"sklearn predict_proba: {sklearn_time * 1000:.3f}ms")
+        print(f"Compiled forest:       {forest_time * 1000:.3f}ms ({sklearn_time / forest_time:.1f}x faster)")
+        print(f"RSS after loading: sklearn model +{model_rss:.1f}MB, memory-mapped forest +{forest_rss:.1f}MB (pages are shared between processes)")
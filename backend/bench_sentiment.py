@@ -0,0 +1,50 @@
+import argparse
+import random
+import time
+from sentiment import load_sentiment_analyzer, SENTIMENT_BACKEND, SENTIMENT_BACKENDS, SENTIMENT_MODEL, SENTIMENT_THREADS
+from helpers import get_sentiment_score, get_sentiment_scores, SENTIMENT_BATCH_SIZE, SENTIMENT_MAX_LENGTH
+
+# Benchmark of per-tweet vs batched sentiment scoring
+# usage: python bench_sentiment.py --tweets 125 --batch-size 32 --repeat 3 --backend int8 --threads 4
+
+WORDS = ['great', 'terrible', 'love', 'hate', 'today', 'crypto', 'giveaway', 'follow', 'news', 'game', 'vote', 'https://t.co/abc', '#ad', 'lol', 'sad', 'happy', 'the', 'a', 'and', 'is', 'my', 'your', 'this', 'market', 'win']
+
+# returns synthetic tweets with lengths spread out like real timelines (short replies to full 280 char tweets)
+def make_texts(n: int, seed=0):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 45)))[:280] for _ in range(n)]
+
+def time_it(fn, repeat: int):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tweets', type=int, default=125)
+    parser.add_argument('--batch-size', type=int, default=SENTIMENT_BATCH_SIZE)
+    parser.add_argument('--max-length', type=int, default=SENTIMENT_MAX_LENGTH)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--backend', default=SENTIMENT_BACKEND, choices=SENTIMENT_BACKENDS)
+    parser.add_argument('--model', default=SENTIMENT_MODEL)
+    parser.add_argument('--threads', type=int, default=SENTIMENT_THREADS)
+    args = parser.parse_args()
+
+    sentiment_analyzer = load_sentiment_analyzer(args.backend, args.model, args.threads)
+    texts = make_texts(args.tweets)
+    get_sentiment_scores(texts[:args.batch_size], sentiment_analyzer) # warm up
+
+    per_tweet_time, per_tweet_scores = time_it(lambda: [get_sentiment_score(text, sentiment_analyzer) for text in texts], args.repeat)
+    batched_time, batched_scores = time_it(lambda: get_sentiment_scores(texts, sentiment_analyzer, args.batch_size, args.max_length), args.repeat)
+
+    max_diff = max(abs(a - b) for a, b in zip(per_tweet_scores, batched_scores))
+    avg_diff = abs(sum(per_tweet_scores) - sum(batched_scores)) / len(texts)
+
+    print(f"Tweets: {len(texts)}, backend: {args.backend}, batch size: {args.batch_size}, max length: {args.max_length}")
+    print(f"Per-tweet: {per_tweet_time:.3f}s ({len(texts) / per_tweet_time:.1f} tweets/s)")
+    print(f"Batched:   {batched_time:.3f}s ({len(texts) / batched_time:.1f} tweets/s)")
+    print(f"Speedup:   {per_tweet_time / batched_time:.2f}x")
+    print(f"Max score difference: {max_diff:.2e}, average sentiment difference: {avg_diff:.2e}")
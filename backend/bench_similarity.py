@@ -0,0 +1,57 @@
+import argparse
+import random
+import time
+from fuzzywuzzy import fuzz
+from similarity import count_identical_pairs, SIMILARITY_SCORE_TEST_MARK
+
+# Benchmark of near-duplicate tweet detection at growing timeline sizes
+# usage: python bench_similarity.py --sizes 125 1000 10000 --quadratic-limit 1000
+
+# returns normalized synthetic tweets where about a third are exact or near copies of earlier ones, like a spammy timeline
+def make_texts(n: int, seed=0):
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(1, 9))) for _ in range(5000)]
+    texts = []
+    for _ in range(n):
+        if texts and rng.random() < 0.3:
+            text = rng.choice(texts)
+            if rng.random() < 0.5: text = text + rng.choice(['!', '.', ' lol'])
+        else:
+            text = ' '.join(rng.choice(vocabulary) for _ in range(rng.randint(3, 45)))[:280]
+        texts.append(text.lower().strip())
+    return texts
+
+# the original O(n^2) loop over a set of earlier tweets
+def quadratic_pairs(texts: list, similarity_score_test_mark=SIMILARITY_SCORE_TEST_MARK):
+    identical_tweet_pairs, num_pairs = 0, 0
+    tweets_analyzed = set()
+    for text in texts:
+        for other_tweet in tweets_analyzed:
+            num_pairs += 1
+            if fuzz.ratio(text, other_tweet) >= similarity_score_test_mark: identical_tweet_pairs += 1
+        tweets_analyzed.add(text)
+    return identical_tweet_pairs, num_pairs
+
+def time_it(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[125, 1000, 10000])
+    parser.add_argument('--quadratic-limit', type=int, default=1000, help='skip the original loop above this many tweets')
+    args = parser.parse_args()
+
+    print(f"{'tweets':>8} {'method':>18} {'seconds':>10} {'identical':>10} {'pairs':>12}")
+    for size in args.sizes:
+        texts = make_texts(size)
+        runs = [
+            ('parity/exact', lambda: count_identical_pairs(texts, mode='parity', candidates='exact')),
+            ('parity/lsh', lambda: count_identical_pairs(texts, mode='parity', candidates='lsh')),
+            ('all_pairs/lsh', lambda: count_identical_pairs(texts, mode='all_pairs', candidates='lsh')),
+        ]
+        if size <= args.quadratic_limit: runs.insert(0, ('quadratic', lambda: quadratic_pairs(texts)))
+        for name, fn in runs:
+            seconds, (identical_tweet_pairs, num_pairs) = time_it(fn)
+            print(f"{size:>8} {name:>18} {seconds:>10.3f} {identical_tweet_pairs:>10} {num_pairs:>12}")
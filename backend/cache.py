@@ -0,0 +1,138 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+CACHE_PATH = os.environ.get('CACHE_PATH', os.path.join(dir_path, 'cache.sqlite3'))
+MEMORY_CACHE_SIZE = 2048
+
+# In-process tier: LRU with a per-entry time to live
+class MemoryCache:
+    def __init__(self, maxsize=MEMORY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits, self.misses = 0, 0
+        self._data = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None: del self._data[key]
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl: float):
+        with self._lock:
+            self._data[key] = (time.time() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+# Shared tier backed by a local SQLite file, values are stored as JSON
+# any object with the same get_entry/set/delete/clear/stats methods can be plugged in instead (e.g. a Redis client wrapper)
+class SQLiteCache:
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.hits, self.misses = 0, 0
+        self._lock = threading.Lock()
+        self.reopen()
+
+    # opens the connection, called again in forked workers since SQLite connections must not be used across a fork
+    def reopen(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)')
+
+    # returns (value, expires_at), or None when the key is missing or expired
+    def get_entry(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None or row[1] < time.time():
+                if row is not None: self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0]), row[1]
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def set(self, key, value, ttl: float):
+        data = json.dumps(value)
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)', (key, data, time.time() + ttl))
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM cache')
+
+    def stats(self):
+        with self._lock:
+            size = self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        return {'size': size, 'hits': self.hits, 'misses': self.misses}
+
+# In-process tier in front of an optional shared tier
+# reads fall through memory -> shared and refill memory for what is left of the entry's lifetime, writes go to both
+class TieredCache:
+    def __init__(self, memory: MemoryCache, shared=None):
+        self.memory = memory
+        self.shared = shared
+
+    def get(self, key, ttl: float):
+        value = self.memory.get(key)
+        if value is None and self.shared is not None: value = self._refill(key, self.shared.get_entry(key), ttl)
+        return value
+
+    # copies a shared-tier entry into memory until it expires there, not for a fresh ttl, or every worker would extend it
+    def _refill(self, key, entry, ttl: float):
+        if entry is None: return None
+        value, expires_at = entry
+        self.memory.set(key, value, min(ttl, expires_at - time.time()))
+        return value
+
+    def set(self, key, value, ttl: float):
+        self.memory.set(key, value, ttl)
+        if self.shared is not None: self.shared.set(key, value, ttl)
+
+    # get/set for the event loop: memory is checked inline, the shared tier (a disk read or write that can wait on
+    # SQLite's busy timeout while another worker writes) runs in a thread
+    async def get_async(self, key, ttl: float):
+        value = self.memory.get(key)
+        if value is None and self.shared is not None: value = self._refill(key, await asyncio.to_thread(self.shared.get_entry, key), ttl)
+        return value
+
+    async def set_async(self, key, value, ttl: float):
+        self.memory.set(key, value, ttl)
+        if self.shared is not None: await asyncio.to_thread(self.shared.set, key, value, ttl)
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.shared is not None: self.shared.delete(key)
+
+    def stats(self):
+        return {'memory': self.memory.stats(), 'shared': self.shared.stats() if self.shared is not None else None}
@@ -0,0 +1,158 @@
+import asyncio
+import glob
+import os
+import time
+from dotenv import load_dotenv
+from twikit import Client
+from ratelimit import is_rate_limit_error, get_rate_limit_reset, RATE_LIMIT_WINDOW
+from metrics import twitter_requests
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+REQUESTS_PER_WINDOW = 150 # soft cap on requests per session every 15 minutes, sessions over it are used last
+TWEETS_PAGE_SIZE = 20 # tweets per UserTweets page
+
+# returns the requests fetching `tweets` tweets of a timeline takes, the cost to pass to client_pool.run
+def timeline_cost(tweets: int):
+    return -(-tweets // TWEETS_PAGE_SIZE)
+
+# returns the cookie files to log in with, TWITTER_COOKIES="a.json,b.json" overrides the cookies*.json next to this file
+def get_cookies_paths():
+    paths = os.environ.get('TWITTER_COOKIES')
+    if paths: return [path.strip() for path in paths.split(',') if path.strip()]
+    return sorted(glob.glob(os.path.join(dir_path, 'cookies*.json'))) or [os.path.join(dir_path, 'cookies.json')]
+
+# one long-lived, logged in Twikit client and its rate limit accounting
+class PooledSession:
+    def __init__(self, cookies_path: str, client=None):
+        self.cookies_path = cookies_path
+        if client is None:
+            client = Client('en-US')
+            client.load_cookies(cookies_path)
+        self.client = client
+        self.in_use = 0
+        self.requests = 0 # requests in the current 15 minute window
+        self.window_started = time.monotonic()
+        self.rate_limited_until = 0
+        self.total_requests = 0
+        self.rate_limits = 0
+
+    def _roll_window(self, now: float):
+        if now - self.window_started >= RATE_LIMIT_WINDOW:
+            self.requests, self.window_started = 0, now
+
+    def is_available(self, now: float):
+        return self.rate_limited_until <= now
+
+    def record(self, cost: int):
+        self._roll_window(time.monotonic())
+        self.requests += cost
+        self.total_requests += cost
+
+    def on_rate_limit(self, reset_after: float):
+        self.rate_limits += 1
+        self.rate_limited_until = time.monotonic() + reset_after
+
+    def stats(self):
+        now = time.monotonic()
+        self._roll_window(now)
+        return {
+            'cookies': os.path.basename(self.cookies_path),
+            'in_use': self.in_use,
+            'requests_in_window': self.requests,
+            'total_requests': self.total_requests,
+            'rate_limits': self.rate_limits,
+            'rate_limited_for': max(0, round(self.rate_limited_until - now, 1)),
+        }
+
+# Pool of authenticated sessions shared by /predict, /search and the crawler
+# each call is handed the least used session that isn't rate limited; when Twitter reports a rate limit
+# the session is benched until its window resets and the call is retried on the next session
+class ClientPool:
+    # client_factory(cookies_path) replaces logging in with Twikit, e.g. with fake_twitter.FakeClient offline
+    def __init__(self, cookies_paths=None, requests_per_window=REQUESTS_PER_WINDOW, client_factory=None):
+        self.cookies_paths = cookies_paths
+        self.requests_per_window = requests_per_window
+        self.client_factory = client_factory
+        self._sessions = None
+
+    # logs every session in once, on first use
+    @property
+    def sessions(self):
+        if self._sessions is None:
+            load_dotenv(os.path.join(dir_path, '.env'))
+            paths = self.cookies_paths or get_cookies_paths()
+            self._sessions = [PooledSession(path, self.client_factory(path) if self.client_factory else None) for path in paths]
+        return self._sessions
+
+    # returns the best available session, or None if they are all rate limited
+    def _pick(self):
+        now = time.monotonic()
+        available = [session for session in self.sessions if session.is_available(now)]
+        if not available: return None
+        for session in available: session._roll_window(now)
+        # prefer sessions under their soft cap, then the least used and least busy
+        return min(available, key=lambda session: (session.requests >= self.requests_per_window, session.requests, session.in_use))
+
+    # returns a session, waiting for one to come off its rate limit if wait is True
+    async def acquire(self, wait=False):
+        while True:
+            session = self._pick()
+            if session is not None:
+                session.in_use += 1
+                return session
+            if not wait: raise Exception('Rate limit exceeded for every session.')
+            await asyncio.sleep(max(0.1, min(session.rate_limited_until for session in self.sessions) - time.monotonic()))
+
+    def release(self, session: PooledSession):
+        session.in_use -= 1
+
+    # number of sessions that aren't rate limited right now
+    def available(self):
+        now = time.monotonic()
+        return sum(1 for session in self.sessions if session.is_available(now))
+
+    # returns await fn(client), moving to another session whenever one reports "Rate limit exceeded"
+    # cost is the number of requests fn makes, used to spread load between sessions
+    # on_rate_limit(session, reset_after) is called after a session is benched
+    async def run(self, fn, cost=1, wait=False, on_rate_limit=None):
+        last_error = None
+        for _ in range(len(self.sessions) if not wait else 1 << 30):
+            session = await self.acquire(wait)
+            try:
+                session.record(cost)
+                result = await fn(session.client)
+                twitter_requests.inc(outcome='ok')
+                return result
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    twitter_requests.inc(outcome='error')
+                    raise
+                twitter_requests.inc(outcome='rate_limited')
+                reset_after = get_rate_limit_reset(e)
+                session.on_rate_limit(reset_after)
+                print(f"Rate limit exceeded for session {session.cookies_path}, benched for {round(reset_after)} seconds.")
+                if on_rate_limit: on_rate_limit(session, reset_after)
+                last_error = e
+            finally:
+                self.release(session)
+        raise last_error
+
+    # returns the client of the least used session, for callers that don't need rotation
+    def get_client(self):
+        return (self._pick() or min(self.sessions, key=lambda session: session.rate_limited_until)).client
+
+    # swaps in new sessions (they log in on next use), e.g. client_pool.configure(['fake'], client_factory=...)
+    def configure(self, cookies_paths=None, client_factory=None):
+        self.cookies_paths, self.client_factory = cookies_paths, client_factory
+        self._sessions = None
+
+    def stats(self):
+        sessions = [session.stats() for session in self.sessions] if self._sessions is not None else []
+        return {
+            'sessions': sessions,
+            'available': self.available() if self._sessions is not None else 0,
+            'requests_per_window': self.requests_per_window,
+        }
+
+client_pool = ClientPool()
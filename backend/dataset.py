@@ -1,69 +1,164 @@
 import pandas as pd
 import asyncio 
-from helpers import get_client
+import json
+import os
+from ratelimit import TokenBucket, is_rate_limit_error, RATE_LIMIT_WINDOW
+from images import image_analyzer
+from clients import client_pool, timeline_cost
 from user import User
-from transformers import pipeline
-import torch
-from helpers import get_client, get_age, analyze_profile_image, load_image, analyze_tweets_similarity, get_sentiment_score
+from registry import registry
+from datastore import DatasetStore, FIELDS, DATASET_CSV_PATH, convert_csv
+from helpers import get_age
+from streaming import TimelineAggregator, iterate_pages, aggregate_timeline
+from metrics import metrics, span, timed
+from retry import RetryPolicy, Deadline, retry
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu") # disregard this if you're running on mac
+dir_path = os.path.dirname(os.path.realpath(__file__))
 
-FIELDS = ["user_id", "screen_name", "is_bot", "account_age", "is_blue_verified", "is_verified", "profile_description_sentiment", "following_count", "followers_count", "following_to_followers", "is_possibly_sensitive", "is_default_profile_image", "is_profile_banner", "is_profile_image_valid", "tweet_freq", "parsed_owned_tweets_count", "parsed_owned_text_tweets_count", "parsed_retweets_count", "likes_freq", "media_freq", "followers_freq", "following_freq", "replies_to_owned", "quotes_to_owned", "retweets_to_owned", "avg_urls", "avg_hashtags", "identical_tweet_freq", "avg_tweet_sentiment", "avg_replies_per_follower", "avg_likes_per_follower", "avg_retweets_per_follower"]
 TARGET_TWEETS = 125
 MIN_TWEETS = 0
 NUM_USERS = 3000
 ADDING_TO_DATASET = True
 
+CRAWL_CONCURRENCY = 4 # users crawled at the same time
+CRAWL_STATE_PATH = os.path.join(dir_path, 'crawl_state.json') # next to the store, wherever the crawler is started from
+TWEETS_REQUESTS_PER_WINDOW = 50 # UserTweets requests each session may make every 15 minutes
+
+# on its own, a crawl waits out rate limits; under create_dataset they are raised so the user moves to another session
+CRAWL_RETRY = RetryPolicy(attempts=5, base_delay=2, max_delay=60, wait_on_rate_limit=True)
+POOLED_CRAWL_RETRY = RetryPolicy(attempts=3, base_delay=2, max_delay=30)
+CRAWL_USER_DEADLINE = 3 * RATE_LIMIT_WINDOW # seconds one user's tweets may take, waits included
+
+crawled_users = metrics.counter('botdetector_crawled_users_total', 'Users crawled into the dataset, by result (added, invalid, error)', ['result'])
+
+# Crawl progress, saved whenever the dataset store writes its buffer so an interrupted crawl resumes without rescanning anything
+# next_row is the first row of each source CSV that isn't finished yet, finished holds finished rows after it
+# (users are crawled concurrently, so they can finish out of order)
+class CrawlState:
+    def __init__(self, path: str, sources=None):
+        self.path = path
+        self.sources = sources or {}
+
+    @classmethod
+    def load(cls, path: str):
+        if not os.path.exists(path): return None
+        with open(path) as f:
+            state = json.load(f)
+        sources = {csv: {'next_row': source['next_row'], 'finished': set(source['finished'])} for csv, source in state['sources'].items()}
+        return cls(path, sources)
+
+    def save(self):
+        state = {
+            'sources': {csv: {'next_row': source['next_row'], 'finished': sorted(source['finished'])} for csv, source in self.sources.items()},
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path) # atomic, a crash never leaves a half written state file
+
+    def source(self, csv: str):
+        return self.sources.setdefault(csv, {'next_row': 0, 'finished': set()})
+
+    def is_finished(self, csv: str, row_index: int):
+        source = self.source(csv)
+        return row_index < source['next_row'] or row_index in source['finished']
+
+    def finish(self, csv: str, row_index: int):
+        source = self.source(csv)
+        source['finished'].add(row_index)
+        while source['next_row'] in source['finished']:
+            source['finished'].remove(source['next_row'])
+            source['next_row'] += 1
+
 # Will parse data set and abstract key values to use for model training
-async def create_dataset():
+# users are crawled concurrently across the session pool (every cookies*.json), paced by a shared token bucket
+# store, csvs, state_path, num_users and requests_per_window default to the real crawl (bench.py points them elsewhere)
+async def create_dataset(concurrency=CRAWL_CONCURRENCY, store: DatasetStore = None, csvs=None, state_path=CRAWL_STATE_PATH, num_users=NUM_USERS, requests_per_window=TWEETS_REQUESTS_PER_WINDOW):
 
-    csvs = ['twibot-22-dataset.csv']
-    client = get_client()
+    csvs = csvs or ['twibot-22-dataset.csv']
 
-    last_user_id = None # add here the last user ID in the dataset to avoid duplicates
+    if store is None:
+        store = DatasetStore()
+        if len(store) == 0 and os.path.exists(DATASET_CSV_PATH):
+            print(f"Converted {convert_csv()} users from dataset.csv into the dataset store.")
+            store = DatasetStore()
 
-    try:
-        df = pd.read_csv('dataset.csv')  
-        last_user_id = int(df['user_id'].iloc[-1]) # get the last user ID in the dataset
-        print(f"Last user ID in dataset: {last_user_id}")
-    except:
-        df = pd.DataFrame(columns=FIELDS)
-        df.to_csv('dataset.csv', index=False)  # create the dataset file at the start
-        print("Dataset file created.")
+    # counts are kept in memory for the rest of the crawl
+    bots, humans = store.label_counts()
+    counts = {'rows': len(store), 'bot': bots, 'human': humans}
+    print(f"Users in dataset: {counts['rows']}")
+
+    state = CrawlState.load(state_path) or CrawlState(state_path)
+
+    sessions = len(client_pool.sessions)
+    limiter = TokenBucket(rate=sessions * requests_per_window / RATE_LIMIT_WINDOW, capacity=sessions)
+
+    # only pause the whole crawl when no other session can take over
+    def on_rate_limit(session, reset_after):
+        limiter.on_rate_limit(reset_after if client_pool.available() == 0 else 0)
+
+    in_flight = {'human': 0, 'bot': 0}
+    tasks = set()
+
+    async def crawl_user(csv, row_index, user_id, label):
+        try:
+            # a rate limited session is benched and the user is retried on the next one, waiting if they all are
+            # the cost is the user lookup and the timeline pages, counted like /predict counts them
+            res = await client_pool.run(lambda client: add_user_to_dataset(user_id[1:], label, client, limiter, store), cost=1 + timeline_cost(TARGET_TWEETS), wait=True, on_rate_limit=on_rate_limit)
+            crawled_users.inc(result='added' if res == "SUCCESS" else 'invalid')
+            if res == "SUCCESS":
+                counts['rows'] += 1
+                counts[label] += 1
+                print(f"Added user {user_id} ({counts['rows']}) to dataset.")
+        except Exception as e:
+            crawled_users.inc(result='error')
+            print(f"Error crawling user {user_id}: {e}")
+        finally:
+            in_flight[label] -= 1
+            state.finish(csv, row_index)
+            # only checkpoint once every finished user is on disk, otherwise a crash could skip buffered users
+            if store.pending == 0: state.save()
 
     for csv in csvs:
-        df_reading = pd.read_csv(csv)
+        start_row = state.source(csv)['next_row']
+        df_reading = pd.read_csv(csv, skiprows=range(1, start_row + 1)) # resume without scanning finished rows
 
         if 'id' not in df_reading.columns or 'label' not in df_reading.columns: continue
 
-        users_in_ds = pd.read_csv('dataset.csv').shape[0]
+        for offset, row in enumerate(df_reading[['id', 'label']].itertuples(index=False)):
+            row_index = start_row + offset
+            if state.is_finished(csv, row_index): continue
 
-        humans = 4
-        bots = 0
+            # wait for a free slot, and for in-flight users to settle before deciding we have enough
+            while tasks and (len(tasks) >= concurrency or counts['rows'] + len(tasks) >= num_users):
+                _, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            if counts['rows'] >= num_users: break
 
-        for _, row in df_reading.iterrows():
-            if users_in_ds == NUM_USERS: break
-            user_id = row['id']
-            label = row['label']
+            user_id, label = row.id, row.label
+            if not user_id or not label or user_id[1:] in store: # skip non-existent users and users already in the dataset
+                state.finish(csv, row_index)
+                continue
+            humans, bots = counts['human'] + in_flight['human'], counts['bot'] + in_flight['bot']
             if humans > bots and label == 'human' or bots > humans and label == 'bot': # balance the dataset
                 print(f"Skipping user {user_id} with label {label} to balance the dataset.")
+                state.finish(csv, row_index)
                 continue
-            if last_user_id != None: # skip users already in the dataset if adding onto existing dataset
-                if int(user_id[1:]) == last_user_id:
-                    last_user_id = None
-                continue
-            if not user_id or not label: continue # skip non-existent users
-            res = await add_user_to_dataset(user_id[1:], label, client)
-            if res == "INVALID USER": continue
-            users_in_ds = pd.read_csv('dataset.csv').shape[0]
-            print(f"Added user {user_id} ({users_in_ds}) to dataset.")
-            if label == 'bot': bots += 1
-            else: humans += 1
-        
-async def add_user_to_dataset(user_id: str, label: str, client): 
+
+            in_flight[label] += 1
+            tasks.add(asyncio.ensure_future(crawl_user(csv, row_index, user_id, label)))
+
+        if tasks: await asyncio.wait(tasks)
+        tasks = set()
+        store.flush()
+        state.save()
+
+# adds one user to the dataset store, returns "SUCCESS" or "INVALID USER"
+# when a limiter is given, tweet requests are paced by it and rate limit errors are raised so the caller can switch sessions
+async def add_user_to_dataset(user_id: str, label: str, client, limiter: TokenBucket = None, store: DatasetStore = None): 
     try:
         user = await client.get_user_by_id(user_id)
     except Exception as e:
+        if limiter and is_rate_limit_error(e): raise
         print(f"Error fetching user with ID {user_id}: {e}")
         return "INVALID USER"
 
@@ -71,79 +166,72 @@ async def add_user_to_dataset(user_id: str, label: str, client):
         print(f"User with ID {user_id} not found.")
         return "INVALID USER"
     
-    row = await analyze_user_data(user, label, True)
+    row = await analyze_user_data(user, label, True, limiter)
     if not row: 
         print(f"User with ID {user_id} has less than {MIN_TWEETS} tweets.")
         return "INVALID USER"
-    df_row = pd.DataFrame([row])  
-    df_row.to_csv('dataset.csv', mode='a', header=False, index=False)  # append row to dataset file
+    if store is None:
+        with DatasetStore() as store: store.append(row)
+    elif not store.append(row): # buffered, written to disk in batches
+        print(f"User with ID {user_id} is already in the dataset.")
+        return "INVALID USER"
 
     return "SUCCESS"
 
 # preprocesses user data to be used in the dataset
-async def analyze_user_data(user: User, label, seeding_data=False):
+@timed('analyze_user')
+async def analyze_user_data(user: User, label, seeding_data=False, limiter: TokenBucket = None):
     age = get_age(user.created_at)
-    parsed_owned_tweets_count, parsed_owned_text_tweets_count, parsed_retweets_count, likes_count, replies_count, retweets_count, reply_tweets_count, urls_count, hashtags_count, quotes_tweet_count =  0, 0, 0, 0, 0, 0, 0, 0, 0, 0
 
-    try:
-        # analyze profile picture with openCV
-        is_profile_image_valid = analyze_profile_image(user.profile_image_url)
-    except Exception as e:
-        print(f"Error analyzing profile image for user {user.id}: {e}")
-        return
+    # analyze profile picture with openCV in the background while the tweets are fetched
+    image_task = asyncio.ensure_future(image_analyzer.analyze(user.profile_image_url))
     
-    tweets = []
+    # pages are scored and counted as they arrive (see streaming.py)
+    timeline = TimelineAggregator(registry.get_sentiment_analyzer(), TARGET_TWEETS, user.description)
+
+    async def before_request():
+        if limiter: await limiter.acquire()
+        elif seeding_data: await asyncio.sleep(22) # sleep every request to avoid rate limit
 
     print(f"Fetching tweets for user {user.id}...")
 
-    finished = False
-    while not finished:
+    # a retry continues after the tweets that were already counted
+    def fetch():
+        pages = iterate_pages(lambda: user.get_tweets('Tweets', count=TARGET_TWEETS), TARGET_TWEETS, timeline.tweets_count, before_request, limiter.on_success if limiter else None)
+        return aggregate_timeline(pages, timeline)
+
+    def on_retry(e, retries, delay):
+        reason = "Rate limit exceeded" if is_rate_limit_error(e) else f"Error ({e})"
+        print(f"{reason} fetching tweets for user {user.id}. Retrying in {round(delay)} seconds...")
+
+    with span('timeline'):
         try:
-            res = await user.get_tweets('Tweets', count=TARGET_TWEETS)
-            if seeding_data: await asyncio.sleep(22) # sleep every request to avoid rate limit
-            while res and len(tweets) < TARGET_TWEETS:
-                tweets += res
-                res = await res.next()
-                if seeding_data: await asyncio.sleep(22)
-            finished = True
+            await retry(fetch, POOLED_CRAWL_RETRY if limiter else CRAWL_RETRY, Deadline(CRAWL_USER_DEADLINE), 'crawl_timeline', on_retry)
         except Exception as e:
-            if 'Rate limit exceeded' in str(e): 
-                print(f"Rate limit exceeded for user {user.id}. Sleeping for 15 minutes...")
-                await asyncio.sleep(900) # sleep for 15 minutes to reset rate limit
-            else: 
-                print(f"Error fetching tweets for user {user.id}: {e}")
-                return
+            image_task.cancel()
+            if limiter and is_rate_limit_error(e): raise # the crawler retries the user on another session
+            print(f"Error fetching tweets for user {user.id}: {e}")
+            return
     
-    if len(tweets) <= MIN_TWEETS: 
+    if timeline.tweets_count <= MIN_TWEETS: 
         print(f"User {user.id} has less than {MIN_TWEETS} tweets.")
+        image_task.cancel()
         return False # User is private or has zero tweets - not relevant for dataset
 
-    # print(f"Analyzing tweets for user {user.id} with {len(tweets)} tweets...")
-
-    sentiment_analyzer = pipeline('sentiment-analysis', model='cardiffnlp/twitter-roberta-base-sentiment', device=device, max_length=512, truncation=True)
-    sentiment = 0
-
-    tweets = tweets[:TARGET_TWEETS] # limit to 125 tweets
-    
-    for tweet in tweets:
-        if tweet.retweeted_tweet: 
-            parsed_retweets_count += 1
-            continue
-        if tweet.text:
-            sentiment += get_sentiment_score(tweet.text, sentiment_analyzer)
-            parsed_owned_text_tweets_count += 1
-        parsed_owned_tweets_count += 1
-        if tweet.in_reply_to: reply_tweets_count += 1
-        hashtags_count += len(tweet.hashtags)
-        likes_count += tweet.favorite_count
-        replies_count += tweet.reply_count
-        retweets_count += tweet.retweet_count
-        urls_count += len(tweet.urls)
-        if tweet.is_quote_status: quotes_tweet_count += 1
-    
-    identical_tweet_pairs, num_tweet_pairs = analyze_tweets_similarity(tweets)
+    try:
+        # analyze profile picture with openCV
+        with span('image_wait'):
+            is_profile_image_valid = await image_task
+    except Exception as e:
+        print(f"Error analyzing profile image for user {user.id}: {e}")
+        return
 
-    # print(f"Finished analyzing tweets for user {user.id}.")
+    await asyncio.to_thread(timeline.finish)
+    parsed_owned_tweets_count, parsed_owned_text_tweets_count, parsed_retweets_count = timeline.parsed_owned_tweets_count, timeline.parsed_owned_text_tweets_count, timeline.parsed_retweets_count
+    likes_count, replies_count, retweets_count = timeline.likes_count, timeline.replies_count, timeline.retweets_count
+    reply_tweets_count, quotes_tweet_count, urls_count, hashtags_count = timeline.reply_tweets_count, timeline.quotes_tweet_count, timeline.urls_count, timeline.hashtags_count
+    sentiment, description_sentiment = timeline.sentiment, timeline.description_sentiment
+    identical_tweet_pairs, num_tweet_pairs = timeline.similarity_counts()
 
     # 33 features
     return {
@@ -154,7 +242,7 @@ async def analyze_user_data(user: User, label, seeding_data=False):
         'account_age': age, 
         'is_blue_verified': 1 if user.is_blue_verified else 0,
         'is_verified': 1 if user.verified else 0,
-        'profile_description_sentiment': round(get_sentiment_score(user.description, sentiment_analyzer), 3) if user.description else None,
+        'profile_description_sentiment': round(description_sentiment, 3) if user.description else None,
         'following_count': user.following_count,
         'followers_count': user.followers_count,
         'following_to_followers': user.following_count if user.followers_count == 0 else round(user.following_count / user.followers_count, 3),
@@ -0,0 +1,152 @@
+import argparse
+import glob
+import os
+import uuid
+import pyarrow as pa
+import pyarrow.compute as pc
+
+FIELDS = ["user_id", "screen_name", "is_bot", "account_age", "is_blue_verified", "is_verified", "profile_description_sentiment", "following_count", "followers_count", "following_to_followers", "is_possibly_sensitive", "is_default_profile_image", "is_profile_banner", "is_profile_image_valid", "tweet_freq", "parsed_owned_tweets_count", "parsed_owned_text_tweets_count", "parsed_retweets_count", "likes_freq", "media_freq", "followers_freq", "following_freq", "replies_to_owned", "quotes_to_owned", "retweets_to_owned", "avg_urls", "avg_hashtags", "identical_tweet_freq", "avg_tweet_sentiment", "avg_replies_per_follower", "avg_likes_per_follower", "avg_retweets_per_follower"]
+
+INT_FIELDS = {"user_id", "is_bot", "account_age", "is_blue_verified", "is_verified", "following_count", "followers_count", "is_possibly_sensitive", "is_default_profile_image", "is_profile_banner", "is_profile_image_valid", "parsed_owned_tweets_count", "parsed_owned_text_tweets_count", "parsed_retweets_count"}
+
+# typed columns in FIELDS order, everything that isn't an id, a flag or a count is a (nullable) float
+SCHEMA = pa.schema([
+    pa.field(field, pa.string() if field == 'screen_name' else pa.int64() if field in INT_FIELDS else pa.float64())
+    for field in FIELDS
+])
+
+# returns the row with every FIELDS value cast to its column type (twikit ids are strings, flags may be bools)
+def coerce_row(row: dict):
+    coerced = {}
+    for field in FIELDS:
+        value = row.get(field)
+        if value is None or value != value: coerced[field] = None # missing or NaN
+        elif field == 'screen_name': coerced[field] = str(value)
+        elif field in INT_FIELDS: coerced[field] = int(value)
+        else: coerced[field] = float(value)
+    return coerced
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+DATASET_STORE_PATH = os.path.join(dir_path, 'dataset_store')
+DATASET_CSV_PATH = os.path.join(dir_path, 'dataset.csv')
+APPEND_BUFFER_SIZE = 256
+
+# Columnar dataset store: a directory of uncompressed Arrow IPC part files with the SCHEMA above
+# rows are appended into an in-memory buffer and written as a new part file per batch,
+# user_id is unique across the whole store, and reads memory-map the parts without copying them
+class DatasetStore:
+    def __init__(self, path=DATASET_STORE_PATH, buffer_size=APPEND_BUFFER_SIZE):
+        self.path = path
+        self.buffer_size = buffer_size
+        self._buffer = []
+        os.makedirs(path, exist_ok=True)
+        self._user_ids = set(self.load_table(['user_id']).column('user_id').to_pylist()) if self.parts() else set()
+
+    def parts(self):
+        return sorted(glob.glob(os.path.join(self.path, 'part-*.arrow')))
+
+    def __len__(self):
+        return len(self._user_ids)
+
+    def __contains__(self, user_id):
+        return int(user_id) in self._user_ids
+
+    # buffers a row, returns False if a row with the same user_id is already stored
+    def append(self, row: dict):
+        user_id = int(row['user_id'])
+        if user_id in self._user_ids: return False
+        self._user_ids.add(user_id)
+        self._buffer.append(row)
+        if len(self._buffer) >= self.buffer_size: self.flush()
+        return True
+
+    # number of rows waiting in the buffer
+    @property
+    def pending(self):
+        return len(self._buffer)
+
+    # writes buffered rows as a new part file
+    def flush(self):
+        if not self._buffer: return
+        table = pa.Table.from_pylist([coerce_row(row) for row in self._buffer], schema=SCHEMA)
+        self._write_part(table)
+        self._buffer = []
+
+    def _write_part(self, table: pa.Table):
+        # part numbers only grow, so rows keep their append order across flushes and compactions
+        parts = self.parts()
+        number = int(os.path.basename(parts[-1]).split('-')[1]) + 1 if parts else 0
+        name = f"part-{number:06d}-{uuid.uuid4().hex[:8]}.arrow"
+        tmp_path = os.path.join(self.path, '.' + name + '.tmp')
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, SCHEMA) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, os.path.join(self.path, name)) # readers never see a half written part
+
+    # rewrites all part files into one, keeps reads fast after many small appends
+    def compact(self):
+        self.flush()
+        parts = self.parts()
+        if len(parts) <= 1: return
+        table = self.load_table().combine_chunks()
+        self._write_part(table)
+        for part in parts: os.remove(part)
+
+    # returns the stored rows as a memory-mapped Arrow table (one chunk per part file)
+    def load_table(self, columns=None):
+        tables = [pa.ipc.open_file(pa.memory_map(part, 'r')).read_all().select(columns or FIELDS) for part in self.parts()]
+        if not tables: return SCHEMA.empty_table().select(columns or FIELDS)
+        return pa.concat_tables(tables)
+
+    # returns the stored rows as a pandas DataFrame (numeric columns without nulls are converted without copying)
+    def load(self, columns=None):
+        return self.load_table(columns).to_pandas(split_blocks=True, self_destruct=True)
+
+    # returns the number of bots and humans in the store
+    def label_counts(self):
+        is_bot = self.load_table(['is_bot']).column('is_bot')
+        bots = pc.sum(is_bot).as_py() or 0
+        return bots, len(is_bot) - bots
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+# one-time conversion of dataset.csv into a store, keeping the first row of each user_id
+def convert_csv(csv_path=DATASET_CSV_PATH, path=DATASET_STORE_PATH):
+    import pandas as pd
+    df = pd.read_csv(csv_path)
+    store = DatasetStore(path)
+    with store:
+        for row in df.to_dict('records'):
+            store.append(row)
+    store.compact()
+    return len(store)
+
+# writes the store back out as a CSV (e.g. for the notebook)
+def export_csv(csv_path=DATASET_CSV_PATH, path=DATASET_STORE_PATH):
+    DatasetStore(path).load().to_csv(csv_path, index=False)
+
+# returns the training data, from the store when it exists and from dataset.csv otherwise
+def load_dataset(path=DATASET_STORE_PATH, csv_path=DATASET_CSV_PATH):
+    if glob.glob(os.path.join(path, 'part-*.arrow')): return DatasetStore(path).load()
+    import pandas as pd
+    return pd.read_csv(csv_path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the columnar dataset store')
+    parser.add_argument('command', choices=['convert', 'export', 'compact'])
+    parser.add_argument('--csv', default=DATASET_CSV_PATH)
+    parser.add_argument('--store', default=DATASET_STORE_PATH)
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        print(f"Converted {convert_csv(args.csv, args.store)} users into {args.store}.")
+    elif args.command == 'export':
+        export_csv(args.csv, args.store)
+        print(f"Exported {args.store} to {args.csv}.")
+    else:
+        DatasetStore(args.store).compact()
+        print(f"Compacted {args.store}.")
@@ -0,0 +1,245 @@
+import argparse
+import asyncio
+import json
+import random
+from datetime import datetime, timedelta, timezone
+import cv2
+import numpy as np
+
+# Offline stand-in for the parts of twikit that predict.py, dataset.py and app.py use:
+# Client.get_user_by_screen_name/get_user_by_id/get_user_tweets/search_user, User.get_tweets and paged Results
+# backed by fixtures, either recorded from Twitter (record) or synthetic (generate), with simulated latency and rate limits
+#
+# fixtures are JSON: {"users": [{"id", "screen_name", ..., "image": {"width", "height", "face"}, "tweets": [...]}]}
+# usage: python fake_twitter.py generate --users 50 --tweets 125 --out fixtures.json
+#        python fake_twitter.py record --screen-names elonmusk nasa --out fixtures.json
+
+TWITTER_DATE_FORMAT = '%a %b %d %H:%M:%S %z %Y'
+PAGE_SIZE = 20
+
+USER_FIELDS = ['id', 'screen_name', 'name', 'created_at', 'description', 'profile_image_url', 'profile_banner_url', 'is_blue_verified', 'verified', 'possibly_sensitive', 'default_profile_image', 'following_count', 'followers_count', 'statuses_count', 'media_count']
+TWEET_FIELDS = ['id', 'created_at', 'text', 'in_reply_to', 'is_quote_status', 'hashtags', 'urls', 'favorite_count', 'reply_count', 'retweet_count']
+
+# same class names as twikit.errors, so ratelimit.is_rate_limit_error and callers treat them the same way
+class TooManyRequests(Exception):
+    def __init__(self, message='Rate limit exceeded', rate_limit_reset=None):
+        super().__init__(message)
+        self.rate_limit_reset = rate_limit_reset
+
+class UserNotFound(Exception):
+    pass
+
+class FakeTweet:
+    def __init__(self, data: dict, retweeted_tweet=None):
+        for field in TWEET_FIELDS: setattr(self, field, data.get(field))
+        self.hashtags = self.hashtags or []
+        self.urls = self.urls or []
+        self.retweeted_tweet = retweeted_tweet
+
+class FakeUser:
+    def __init__(self, data: dict, client):
+        for field in USER_FIELDS: setattr(self, field, data.get(field))
+        self._client = client
+
+    async def get_tweets(self, tweet_type: str, count=40):
+        return await self._client.get_user_tweets(self.id, tweet_type, count)
+
+# one page of results, next() requests the following page through the client (paying its latency and rate limit)
+class FakeResult(list):
+    def __init__(self, items, fetch_next=None):
+        super().__init__(items)
+        self._fetch_next = fetch_next
+
+    async def next(self):
+        if self._fetch_next is None: return FakeResult([])
+        return await self._fetch_next()
+
+# Fake twikit.Client serving users and tweets from fixtures
+# every request waits latency (+ up to jitter) seconds, and after rate_limit_after requests raises TooManyRequests
+class FakeClient:
+    def __init__(self, fixtures: dict, latency=0.0, jitter=0.0, page_size=PAGE_SIZE, rate_limit_after=None, seed=0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.page_size = page_size
+        self.rate_limit_after = rate_limit_after
+        self.requests = 0
+        self._rng = random.Random(seed)
+        self._by_id = {user['id']: user for user in fixtures['users']}
+        self._by_screen_name = {user['screen_name'].lower(): user for user in fixtures['users']}
+
+    def load_cookies(self, path: str):
+        pass
+
+    async def _request(self):
+        self.requests += 1
+        if self.rate_limit_after is not None and self.requests > self.rate_limit_after:
+            raise TooManyRequests()
+        delay = self.latency + self.jitter * self._rng.random()
+        if delay > 0: await asyncio.sleep(delay)
+
+    async def get_user_by_screen_name(self, screen_name: str):
+        await self._request()
+        user = self._by_screen_name.get(screen_name.lower())
+        if user is None: raise UserNotFound(f"User {screen_name} not found.")
+        return FakeUser(user, self)
+
+    async def get_user_by_id(self, user_id: str):
+        await self._request()
+        user = self._by_id.get(str(user_id))
+        if user is None: raise UserNotFound(f"User {user_id} not found.")
+        return FakeUser(user, self)
+
+    async def get_user_tweets(self, user_id: str, tweet_type: str, count=40, cursor=None):
+        await self._request()
+        user = self._by_id.get(str(user_id))
+        if user is None: raise UserNotFound(f"User {user_id} not found.")
+        start = int(cursor or 0)
+        end = start + min(count, self.page_size)
+        tweets = [make_tweet(tweet) for tweet in user['tweets'][start:end]]
+        fetch_next = (lambda: self.get_user_tweets(user_id, tweet_type, count, end)) if end < len(user['tweets']) else None
+        return FakeResult(tweets, fetch_next)
+
+    async def search_user(self, query: str, count=20, cursor=None):
+        await self._request()
+        query = query.lower()
+        users = [user for user in self.fixtures['users'] if query in user['screen_name'].lower() or query in (user['name'] or '').lower()]
+        return FakeResult([FakeUser(user, self) for user in users[:count]])
+
+def make_tweet(data: dict):
+    retweeted = data.get('retweeted_tweet')
+    return FakeTweet(data, FakeTweet(retweeted) if retweeted else None)
+
+# returns PNG bytes of the fixture user's profile image: noise (no face) of the recorded size
+def render_image(spec: dict, seed=0):
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 256, (spec.get('height', 400), spec.get('width', 400), 3), dtype=np.uint8)
+    return cv2.imencode('.png', image)[1].tobytes()
+
+# serves profile images of the fixtures to an images.ImageAnalyzer instead of downloading them
+def use_fake_images(analyzer, fixtures: dict, latency=0.0):
+    specs = {user['profile_image_url']: user.get('image', {}) for user in fixtures['users']}
+    rendered = {}
+
+    async def fetch(url: str):
+        if latency > 0: await asyncio.sleep(latency)
+        if url not in rendered: rendered[url] = render_image(specs.get(url, {}), seed=len(rendered))
+        return rendered[url]
+
+    analyzer.fetch = fetch
+
+# points a clients.ClientPool (and optionally an ImageAnalyzer) at fake sessions serving the fixtures
+# returns the fake clients, e.g. to read their request counts
+def use_fake_twitter(pool, fixtures: dict, sessions=1, analyzer=None, image_latency=0.0, **client_kwargs):
+    clients = []
+    def client_factory(path):
+        client = FakeClient(fixtures, seed=len(clients), **client_kwargs)
+        clients.append(client)
+        return client
+    pool.configure([f"fake-{i}" for i in range(sessions)], client_factory)
+    pool.sessions # log in now so the clients list is filled
+    if analyzer is not None: use_fake_images(analyzer, fixtures, image_latency)
+    return clients
+
+HUMAN_WORDS = ['coffee', 'morning', 'game', 'tonight', 'love', 'this', 'new', 'album', 'finally', 'weekend', 'can\'t', 'believe', 'what', 'happened', 'today', 'work', 'friends', 'dinner', 'movie', 'great', 'so', 'tired', 'happy', 'birthday', 'team', 'won', 'lost', 'again', 'the', 'a', 'my', 'is', 'and', 'of', 'with']
+BOT_TEMPLATES = ['Free {coin} giveaway! Follow and RT to win', 'Don\'t miss out on {coin}, join now', '{coin} is going to the moon, buy now', 'Claim your {coin} airdrop today', 'Best {coin} signals, DM me']
+COINS = ['BTC', 'ETH', 'DOGE', 'SOL', 'PEPE']
+
+# returns one synthetic user with n_tweets tweets, bots post templated, repetitive tweets with links and hashtags
+def generate_user(index: int, n_tweets: int, bot: bool, rng: random.Random):
+    now = datetime.now(timezone.utc)
+    created_at = now - timedelta(days=rng.randint(20, 400) if bot else rng.randint(300, 5000))
+    followers = rng.randint(0, 200) if bot else int(rng.lognormvariate(6, 2))
+    user = {
+        'id': str(1000000 + index),
+        'screen_name': f"{'bot' if bot else 'user'}_{index}",
+        'name': f"{'Crypto Deals' if bot else 'Person'} {index}",
+        'created_at': created_at.strftime(TWITTER_DATE_FORMAT),
+        'description': rng.choice(['', 'Crypto signals daily', 'Follow for giveaways']) if bot else ' '.join(rng.choices(HUMAN_WORDS, k=rng.randint(0, 15))),
+        'profile_image_url': f"https://pbs.twimg.com/profile_images/{index}/avatar.jpg",
+        'profile_banner_url': None if bot and rng.random() < 0.7 else f"https://pbs.twimg.com/profile_banners/{index}/banner",
+        'is_blue_verified': rng.random() < (0.3 if bot else 0.1),
+        'verified': False,
+        'possibly_sensitive': rng.random() < (0.2 if bot else 0.02),
+        'default_profile_image': rng.random() < (0.4 if bot else 0.05),
+        'following_count': rng.randint(500, 5000) if bot else rng.randint(10, 1500),
+        'followers_count': followers,
+        'statuses_count': rng.randint(n_tweets, n_tweets * 40),
+        'media_count': rng.randint(0, 200),
+        'image': {'width': 48, 'height': 48} if bot and rng.random() < 0.5 else {'width': 400, 'height': 400},
+        'tweets': [],
+    }
+    for k in range(n_tweets):
+        if bot:
+            text = rng.choice(BOT_TEMPLATES).format(coin=rng.choice(COINS))
+            hashtags, urls = rng.sample(COINS, rng.randint(1, 3)), [{'url': f"https://t.co/{rng.randint(0, 999)}"}]
+        else:
+            text = ' '.join(rng.choices(HUMAN_WORDS, k=rng.randint(3, 30)))
+            hashtags, urls = ([rng.choice(COINS)] if rng.random() < 0.05 else []), ([{'url': 'https://t.co/x'}] if rng.random() < 0.1 else [])
+        tweet = {
+            'id': str(user['id']) + f"{n_tweets - k:05d}", # newest first, like a real timeline
+            'created_at': (now - timedelta(hours=k * rng.uniform(0.1, 2 if bot else 30))).strftime(TWITTER_DATE_FORMAT),
+            'text': text,
+            'in_reply_to': str(rng.randint(1, 10**9)) if rng.random() < (0.05 if bot else 0.3) else None,
+            'is_quote_status': rng.random() < 0.05,
+            'hashtags': hashtags,
+            'urls': urls,
+            'favorite_count': rng.randint(0, 5) if bot else int(rng.lognormvariate(1, 1.5)),
+            'reply_count': rng.randint(0, 2),
+            'retweet_count': rng.randint(0, 3),
+        }
+        if rng.random() < (0.4 if bot else 0.2):
+            tweet['retweeted_tweet'] = {'id': '1', 'text': text, 'hashtags': hashtags, 'urls': urls}
+        user['tweets'].append(tweet)
+    return user
+
+# returns fixtures with n_users synthetic users of n_tweets tweets each, bot_ratio of them bots
+def generate_fixtures(n_users: int, n_tweets=125, bot_ratio=0.5, seed=0):
+    rng = random.Random(seed)
+    return {'users': [generate_user(index, n_tweets, rng.random() < bot_ratio, rng) for index in range(n_users)]}
+
+# returns fixtures recorded from Twitter with a logged in twikit client (as many tweets per user as n_tweets)
+async def record_fixtures(client, screen_names: list, n_tweets=125):
+    users = []
+    for screen_name in screen_names:
+        user = await client.get_user_by_screen_name(screen_name)
+        data = {field: getattr(user, field, None) for field in USER_FIELDS}
+        data['tweets'] = []
+        res = await user.get_tweets('Tweets', count=n_tweets)
+        while res and len(data['tweets']) < n_tweets:
+            for tweet in res:
+                record = {field: getattr(tweet, field, None) for field in TWEET_FIELDS}
+                if tweet.retweeted_tweet: record['retweeted_tweet'] = {'id': tweet.retweeted_tweet.id, 'text': tweet.retweeted_tweet.text}
+                data['tweets'].append(record)
+            res = await res.next()
+        data['tweets'] = data['tweets'][:n_tweets]
+        users.append(data)
+        print(f"Recorded {screen_name} with {len(data['tweets'])} tweets.")
+    return {'users': users}
+
+def load_fixtures(path: str):
+    with open(path) as f:
+        return json.load(f)
+
+def save_fixtures(fixtures: dict, path: str):
+    with open(path, 'w') as f:
+        json.dump(fixtures, f, default=str)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create fixtures for the offline fake Twitter client')
+    parser.add_argument('command', choices=['generate', 'record'])
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--tweets', type=int, default=125)
+    parser.add_argument('--bot-ratio', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--screen-names', nargs='*', default=[])
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        fixtures = generate_fixtures(args.users, args.tweets, args.bot_ratio, args.seed)
+    else:
+        from clients import client_pool
+        fixtures = asyncio.run(record_fixtures(client_pool.get_client(), args.screen_names, args.tweets))
+    save_fixtures(fixtures, args.out)
+    print(f"Saved {len(fixtures['users'])} users to {args.out}.")
@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import numpy as np
+
+FOREST_ARRAYS = ('feature', 'threshold', 'children', 'value')
+
+# returns where the compiled forest of a model file is stored, e.g. model.joblib -> model.forest/
+def get_forest_path(model_path: str):
+    return os.path.splitext(model_path)[0] + '.forest'
+
+# A fitted sklearn RandomForestClassifier flattened into contiguous node arrays shared by every tree:
+# feature, threshold, children ((left, right) global node indices) and value (class probabilities at every node)
+# leaves point to themselves, and all rows walk down all trees together, one vectorized step per level
+class CompiledForest:
+    def __init__(self, feature, threshold, children, value, roots, classes, max_depth: int, n_features: int, version: str = None):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.value = value
+        self.roots = roots
+        self.classes = classes
+        self.max_depth = max_depth
+        self.n_features = n_features
+        self.version = version # version of the model it was compiled from
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def n_nodes(self):
+        return len(self.feature)
+
+    @classmethod
+    def from_sklearn(cls, model, version: str = None):
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+
+        nodes = np.arange(offsets[-1], dtype=np.int64)
+        is_leaf = np.concatenate([tree.children_left == -1 for tree in trees])
+        left = np.concatenate([tree.children_left + offset for tree, offset in zip(trees, offsets)])
+        right = np.concatenate([tree.children_right + offset for tree, offset in zip(trees, offsets)])
+        feature = np.concatenate([tree.feature for tree in trees])
+
+        # normalized like DecisionTreeClassifier.predict_proba does for every leaf it lands on
+        value = np.concatenate([tree.value[:, 0, :] for tree in trees])
+        normalizer = value.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+
+        return cls(
+            feature=np.where(is_leaf, 0, feature).astype(np.int64),
+            threshold=np.concatenate([tree.threshold for tree in trees]).astype(np.float64),
+            children=np.stack([np.where(is_leaf, nodes, left), np.where(is_leaf, nodes, right)], axis=1).astype(np.int64),
+            value=value / normalizer,
+            roots=offsets[:-1].astype(np.int64),
+            classes=np.asarray(model.classes_),
+            max_depth=max(tree.max_depth for tree in trees),
+            n_features=model.n_features_in_,
+            version=version,
+        )
+
+    # writes one .npy file per array plus forest.json, so load() can memory-map them
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        for name in FOREST_ARRAYS + ('roots',):
+            # replaced rather than overwritten, workers that have the old file mapped keep reading it safely
+            tmp_path = os.path.join(path, f".{name}.{os.getpid()}.npy")
+            np.save(tmp_path, np.ascontiguousarray(getattr(self, name)))
+            os.replace(tmp_path, os.path.join(path, name + '.npy'))
+        metadata = {'classes': self.classes.tolist(), 'max_depth': self.max_depth, 'n_features': self.n_features, 'version': self.version}
+        tmp_path = os.path.join(path, f".forest.{os.getpid()}.json")
+        with open(tmp_path, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, os.path.join(path, 'forest.json')) # written last, a forest without it is incomplete
+
+    # memory-mapped by default: the OS page cache keeps one copy of the arrays for every worker process
+    @classmethod
+    def load(cls, path: str, mmap=True):
+        with open(os.path.join(path, 'forest.json')) as f:
+            metadata = json.load(f)
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None) for name in FOREST_ARRAYS + ('roots',)}
+        return cls(**arrays, classes=np.asarray(metadata['classes']), max_depth=metadata['max_depth'], n_features=metadata['n_features'], version=metadata.get('version'))
+
+    # returns (leaves, path): the leaf each row reaches in each tree, (n_rows, n_trees), and with_path,
+    # (rows, nodes, children, feature) for every step down the trees
+    # only (row, tree) pairs that haven't reached a leaf yet are walked, so shallow leaves finish early
+    def apply(self, X, with_path=False):
+        X = np.asarray(X, dtype=np.float32) # sklearn compares float32 features against float64 thresholds
+        n_rows = len(X)
+        leaves = np.tile(self.roots, n_rows)
+        rows = np.repeat(np.arange(n_rows), self.n_trees)
+        X = X.ravel()
+        flat_children = self.children.reshape(-1) # left of node i at 2 * i, right at 2 * i + 1
+        active = np.flatnonzero(flat_children[2 * leaves] != leaves)
+        path = []
+        while len(active):
+            nodes = leaves[active]
+            feature = self.feature[nodes]
+            active_rows = rows[active]
+            go_right = ~(X[active_rows * self.n_features + feature] <= self.threshold[nodes]) # NaN goes right, like sklearn
+            children = flat_children[2 * nodes + go_right]
+            leaves[active] = children
+            if with_path: path.append((active_rows, nodes, children, feature))
+            active = active[flat_children[2 * children] != children]
+        return leaves.reshape(n_rows, self.n_trees), path
+
+    # same result as model.predict_proba(X): tree probabilities summed in tree order, then averaged
+    def predict_proba(self, X):
+        leaves, _ = self.apply(X)
+        proba = np.zeros((len(leaves), self.value.shape[1]))
+        for tree in range(self.n_trees):
+            proba += self.value[leaves[:, tree]]
+        proba /= self.n_trees
+        return proba
+
+    # same result as model.predict(X)
+    def predict(self, X):
+        return self.classes.take(np.argmax(self.predict_proba(X), axis=1), axis=0)
+
+# returns the compiled forest for a loaded model, memory-mapped from its export when that matches the version
+# and compiled (and exported for the next process) otherwise, e.g. when an interrupted export left it truncated
+def load_forest(model, model_path: str, version: str):
+    path = get_forest_path(model_path)
+    try:
+        forest = CompiledForest.load(path)
+        if forest.version == version: return forest
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError) as e: # a truncated .npy or forest.json (json.JSONDecodeError is a ValueError)
+        print(f"Recompiling the forest, couldn't load {path}: {e!r}")
+    forest = CompiledForest.from_sklearn(model, version)
+    try:
+        forest.save(path)
+        return CompiledForest.load(path)
+    except OSError as e:
+        print(f"Error exporting compiled forest to {path}: {e}")
+        return forest
+
+# compiles a model file and saves it next to it (or to path)
+def export_forest(model_path: str, path: str = None):
+    import joblib
+    from registry import get_model_version
+    forest = CompiledForest.from_sklearn(joblib.load(model_path), get_model_version(model_path))
+    path = path or get_forest_path(model_path)
+    forest.save(path)
+    return forest, path
+
+if __name__ == '__main__':
+    from registry import get_model_path
+    parser = argparse.ArgumentParser(description='Compile a trained random forest into memory-mappable arrays')
+    parser.add_argument('--model', help='model file, the served version by default')
+    parser.add_argument('--out', default=None)
+    args = parser.parse_args()
+    args.model = args.model or get_model_path()
+
+    forest, path = export_forest(args.model, args.out)
+    print(f"Exported {forest.n_trees} trees ({forest.n_nodes} nodes, max depth {forest.max_depth}) to {path}.")
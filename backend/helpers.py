@@ -1,22 +1,22 @@
 
 from dotenv import load_dotenv 
 import os
-from twikit import Client
-from user import User
+import threading
 from datetime import datetime
-import cv2
-import numpy as np
-import urllib.request
-from fuzzywuzzy import fuzz
-
-# returns a Twikit client
-def get_client():
+from metrics import timed
+
+# returns a Twikit client logged in with the given cookies
+# without a cookies path, returns a long-lived client from the shared session pool
+def get_client(cookies_path=None):
+    from clients import client_pool # twikit is only imported for callers that need a client
+    if cookies_path is None: return client_pool.get_client()
+    from twikit import Client
     dir_path = os.path.dirname(os.path.realpath(__file__))
     envars = os.path.join(dir_path, '.env')
     load_dotenv(envars)
 
     client = Client('en-US')
-    client.load_cookies('cookies.json')
+    client.load_cookies(cookies_path)
     return client
 
 # returns the age in number of days
@@ -27,59 +27,84 @@ def get_age(created_at: str):
     age_in_days = delta.days
     return age_in_days
 
-# returns 1 if the profile image is valid, 0 otherwise
-def analyze_profile_image(url: str):
-    image = load_image(url)
-    if image is None or not image.any(): return 0
-
-    gray_scale_img = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-    faces = face_cascade.detectMultiScale(gray_scale_img, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
-
-    is_face_detected = len(faces) > 0
-
-    resolution = image.shape[:2] # (height, width)
-    is_high_quality = False if resolution[0] < 100 or resolution[1] < 100 else True
-
-    return 1 if is_face_detected or is_high_quality else 0
-    
-# loads an image from a URL
-def load_image(url: str):
-    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'}
-    request = urllib.request.Request(url, headers=headers)
-    resp = urllib.request.urlopen(request)
-    image = np.asarray(bytearray(resp.read()), dtype="uint8")
-    image = cv2.imdecode(image, cv2.IMREAD_COLOR)
-    return image
-
-# returns the number of identical tweet pairs and the total number of pairs
-def analyze_tweets_similarity(tweets: list, similarity_score_test_mark=95):
-    identical_tweet_pairs, num_pairs = 0, 0
-    tweets_analyzed = set()
+SENTIMENT_BATCH_SIZE = 32
+SENTIMENT_MAX_LENGTH = 512
 
-    for tweet in tweets:
-        if not tweet.text: continue # skip tweets without text
-        normalized_tweet = tweet.text.lower().strip()
-        # check for fuzzy matches
-        for other_tweet in tweets_analyzed:
-            num_pairs += 1
-            similarity_score = fuzz.ratio(normalized_tweet, other_tweet)
-            if similarity_score >= similarity_score_test_mark: 
-                identical_tweet_pairs += 1
-        tweets_analyzed.add(normalized_tweet)
+# map the labels to weights: LABEL_0 -> -1, LABEL_1 -> 0, LABEL_2 -> +1
+SENTIMENT_WEIGHTS = {'LABEL_0': -1, 'LABEL_1': 0, 'LABEL_2': 1}
 
-    return identical_tweet_pairs, num_pairs
+# converts a pipeline result for one text into a score between -1 and 1 - negative, neutral, positive
+def weighted_sentiment(result):
+    if isinstance(result, dict): result = [result]
+    label_scores = {res['label']: res['score'] for res in result}
+    return sum(SENTIMENT_WEIGHTS[label] * score for label, score in label_scores.items())
 
 # returns the sentiment score of a text from -1 to 1
 def get_sentiment_score(text: str, sentiment_analyzer):
-
-    result = sentiment_analyzer(text)
-    label_scores = {res['label']: res['score'] for res in result}
-
-    # map the labels to weights: LABEL_0 -> -1, LABEL_1 -> 0, LABEL_2 -> +1
-    weights = {'LABEL_0': -1, 'LABEL_1': 0, 'LABEL_2': 1}
-
-    return sum(weights[label] * score for label, score in label_scores.items()) # score between -1 and 1 - negative, neutral, positive
+    return weighted_sentiment(sentiment_analyzer(text))
+
+# returns the sentiment scores of many texts from -1 to 1, in the same order as the texts
+# texts are sorted by length and scored in padded batches so each batch wastes little padding
+@timed('sentiment')
+def get_sentiment_scores(texts: list, sentiment_analyzer, batch_size=SENTIMENT_BATCH_SIZE, max_length=SENTIMENT_MAX_LENGTH):
+    scores = [0] * len(texts)
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        results = sentiment_analyzer([texts[i] for i in batch], batch_size=len(batch), truncation=True, max_length=max_length)
+        for i, result in zip(batch, results):
+            scores[i] = weighted_sentiment(result)
+    return scores
+
+# scores the texts of many users in shared batches, returns one list of scores per user
+def get_grouped_sentiment_scores(texts_per_user: list, sentiment_analyzer, batch_size=SENTIMENT_BATCH_SIZE, max_length=SENTIMENT_MAX_LENGTH):
+    flat_texts = [text for texts in texts_per_user for text in texts]
+    flat_scores = get_sentiment_scores(flat_texts, sentiment_analyzer, batch_size, max_length)
+    grouped, start = [], 0
+    for texts in texts_per_user:
+        grouped.append(flat_scores[start:start + len(texts)])
+        start += len(texts)
+    return grouped
+
+# Scores the texts of concurrent callers (threads, e.g. the users of one batch prediction) in shared batches
+# the first caller runs the model, whoever calls while it is busy waits and joins the next round, which scores
+# everything that queued up meanwhile with get_grouped_sentiment_scores; rounds continue until nothing is queued
+class SentimentBatcher:
+    def __init__(self, sentiment_analyzer, batch_size=SENTIMENT_BATCH_SIZE, max_length=SENTIMENT_MAX_LENGTH):
+        self.sentiment_analyzer = sentiment_analyzer
+        self.batch_size, self.max_length = batch_size, max_length
+        self.rounds, self.requests = 0, 0
+        self._pending = [] # [texts, done event, scores, error]
+        self._running = False
+        self._lock = threading.Lock()
+
+    # returns the scores of texts, like get_sentiment_scores
+    def __call__(self, texts: list):
+        request = [texts, threading.Event(), None, None]
+        with self._lock:
+            self._pending.append(request)
+            self.requests += 1
+            leader = not self._running
+            self._running = True
+        if leader: self._run()
+        request[1].wait()
+        if request[3] is not None: raise request[3]
+        return request[2]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                if not batch:
+                    self._running = False
+                    return
+                self.rounds += 1
+            try:
+                for request, scores in zip(batch, get_grouped_sentiment_scores([request[0] for request in batch], self.sentiment_analyzer, self.batch_size, self.max_length)):
+                    request[2] = scores
+            except Exception as e:
+                for request in batch: request[3] = e
+            for request in batch: request[1].set()
 
 features_dict = {
     'account_age': 'Account Age',
@@ -0,0 +1,124 @@
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import httpx
+import numpy as np
+from singleflight import SingleFlight
+from metrics import span
+
+IMAGE_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'}
+IMAGE_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+IMAGE_WORKERS = 4
+IMAGE_CACHE_SIZE = 4096
+
+# thread-safe LRU cache with a fixed number of entries
+class LRUCache:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits, self.misses = 0, 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+_worker = threading.local()
+
+# returns the Haar face classifier of the current thread, loaded once per worker
+def get_face_cascade():
+    if not hasattr(_worker, 'face_cascade'):
+        _worker.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+    return _worker.face_cascade
+
+# returns 1 if the decoded image is valid (a face is detected or it is at least 100x100), 0 otherwise
+def analyze_image(image):
+    if image is None or not image.any(): return 0
+
+    gray_scale_img = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    faces = get_face_cascade().detectMultiScale(gray_scale_img, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
+
+    is_face_detected = len(faces) > 0
+
+    resolution = image.shape[:2] # (height, width)
+    is_high_quality = False if resolution[0] < 100 or resolution[1] < 100 else True
+
+    return 1 if is_face_detected or is_high_quality else 0
+
+# decodes raw image bytes and analyzes them
+def analyze_image_bytes(data: bytes):
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return analyze_image(image)
+
+# Profile image analysis off the critical path:
+# images are downloaded with a shared async HTTP client, decoded and run through face detection on a
+# worker pool that keeps its classifiers loaded, and results are cached by URL and by content hash
+# (many bots reuse the same avatar under different URLs)
+class ImageAnalyzer:
+    def __init__(self, workers=IMAGE_WORKERS, cache_size=IMAGE_CACHE_SIZE, timeout=IMAGE_TIMEOUT):
+        self.timeout = timeout
+        self.url_cache = LRUCache(cache_size)
+        self.content_cache = LRUCache(cache_size)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image-worker', initializer=get_face_cascade)
+        self._client, self._client_loop = None, None
+        self._in_flight = SingleFlight()
+
+    # returns the HTTP client for the running event loop, connections are reused between requests on the same loop
+    def _get_client(self):
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(headers=IMAGE_HEADERS, timeout=self.timeout, follow_redirects=True, limits=httpx.Limits(max_keepalive_connections=20))
+            self._client_loop = loop
+        return self._client
+
+    async def fetch(self, url: str):
+        resp = await self._get_client().get(url)
+        resp.raise_for_status()
+        return resp.content
+
+    # returns 1 if the profile image is valid, 0 otherwise
+    async def analyze(self, url: str):
+        result = self.url_cache.get(url)
+        if result is not None: return result
+
+        # concurrent requests for the same avatar share one download
+        return await self._in_flight.do(url, lambda: self._analyze(url))
+
+    async def _analyze(self, url: str):
+        with span('image_download'):
+            data = await self.fetch(url)
+        content_hash = hashlib.sha1(data).hexdigest()
+        result = self.content_cache.get(content_hash)
+        if result is None:
+            with span('haar'): # includes the wait for a free worker
+                result = await asyncio.get_running_loop().run_in_executor(self._executor, analyze_image_bytes, data)
+            self.content_cache.put(content_hash, result)
+        self.url_cache.put(url, result)
+        return result
+
+    def stats(self):
+        return {
+            'url_cache': {'size': len(self.url_cache), 'hits': self.url_cache.hits, 'misses': self.url_cache.misses},
+            'content_cache': {'size': len(self.content_cache), 'hits': self.content_cache.hits, 'misses': self.content_cache.misses},
+            'in_flight': len(self._in_flight),
+        }
+
+image_analyzer = ImageAnalyzer()
@@ -0,0 +1,262 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import os
+import resource
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+
+# Timing spans, counters and histograms for the prediction pipeline, exposed in the Prometheus text format on /metrics
+# metrics are kept per process, so with several workers each one reports its own (scrape every worker or aggregate them)
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # seconds
+TRACE_REQUESTS = os.environ.get('TRACE_REQUESTS') == '1' # print the spans of every request
+PROFILE_INTERVAL = 0.01 # seconds between stack samples
+
+def _label_key(labelnames: tuple, labels: dict):
+    return tuple(str(labels.get(name, '')) for name in labelnames)
+
+def _format_labels(labelnames: tuple, values: tuple, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs: return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+# monotonically increasing count, e.g. predictions by outcome
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, key), value) for key, value in sorted(self._values.items())]
+
+# distribution of observed values over fixed buckets, e.g. seconds spent in each stage
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {} # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None: entry = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets): entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def count(self, **labels):
+        entry = self._values.get(_label_key(self.labelnames, labels))
+        return entry[-1] if entry else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, entry in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, entry):
+                    cumulative += bucket_count
+                    samples.append((f"{self.name}_bucket", _format_labels(self.labelnames, key, [('le', bound)]), cumulative))
+                samples.append((f"{self.name}_bucket", _format_labels(self.labelnames, key, [('le', '+Inf')]), entry[-1]))
+                samples.append((f"{self.name}_sum", _format_labels(self.labelnames, key), round(entry[-2], 6)))
+                samples.append((f"{self.name}_count", _format_labels(self.labelnames, key), entry[-1]))
+        return samples
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _get_or_create(self, cls, name, help, labelnames, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None: metric = self._metrics[name] = cls(name, help, labelnames, **kwargs)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames=()):
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, help, labelnames, buckets=buckets)
+
+    # returns every metric in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines += [f"{name}{labels} {value}" for name, labels, value in metric.samples()]
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+stage_seconds = metrics.histogram('botdetector_stage_seconds', 'Time spent in each stage of the prediction and crawling pipelines', ['stage'])
+stage_errors = metrics.counter('botdetector_stage_errors_total', 'Stages that raised an exception', ['stage'])
+predictions_total = metrics.counter('botdetector_predictions_total', 'Predictions made, by outcome (bot, human, invalid) and whether they came from the cache', ['outcome', 'cached'])
+request_seconds = metrics.histogram('botdetector_http_request_seconds', 'HTTP request latency', ['endpoint', 'method', 'status'])
+twitter_requests = metrics.counter('botdetector_twitter_requests_total', 'Calls made through the Twitter session pool, by outcome (ok, rate_limited, error)', ['outcome'])
+
+# Spans of one request, collected through a context variable so they follow the request into tasks and to_thread workers
+class Trace:
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = [] # (stage, offset, seconds), appended from any thread
+
+    def add(self, stage: str, start: float, seconds: float):
+        self.spans.append((stage, start - self.started, seconds))
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'total_ms': round((time.perf_counter() - self.started) * 1000, 3),
+            'spans': [{'stage': stage, 'start_ms': round(offset * 1000, 3), 'duration_ms': round(seconds * 1000, 3)} for stage, offset, seconds in sorted(self.spans, key=lambda span: span[1])],
+        }
+
+    def format(self):
+        trace = self.to_dict()
+        lines = [f"Trace {trace['name']}: {trace['total_ms']}ms"]
+        lines += [f"  {span['start_ms']:>10.3f}ms  {span['duration_ms']:>10.3f}ms  {span['stage']}" for span in trace['spans']]
+        return '\n'.join(lines)
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+
+# starts collecting the spans of the current request (and whatever it awaits or runs in threads from here on)
+def start_trace(name: str):
+    trace = Trace(name)
+    _current_trace.set(trace)
+    return trace
+
+def current_trace():
+    return _current_trace.get()
+
+# times the block into the stage histogram (and the current trace, if any), e.g. with span('sentiment'): ...
+# works in sync and async code, exceptions are counted per stage and re-raised
+@contextmanager
+def span(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        if not isinstance(e, (asyncio.CancelledError, GeneratorExit)): stage_errors.inc(stage=stage)
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        stage_seconds.observe(seconds, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None: trace.add(stage, start, seconds)
+
+# decorator version of span for sync and async functions
+def timed(stage: str):
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with span(stage):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with span(stage):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Samples the stacks of every thread at a fixed interval from a background thread
+# results are collapsed stacks ("outer;inner;leaf count"), the input format of flamegraph.pl and speedscope
+# meant to be switched on for a short while under real load, e.g. through POST /profile
+class SamplingProfiler:
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = StackCounter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None: raise RuntimeError('Profiler is already running.')
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is None: return self
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        return self
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate(): names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id: continue
+                stack = [f"{entry.name} ({os.path.basename(entry.filename)}:{entry.lineno})" for entry in traceback.extract_stack(frame)]
+                self.stacks[';'.join([names.get(thread_id, str(thread_id))] + stack)] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common()) + '\n'
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+_profiler_lock = threading.Lock()
+
+# profiles the process for `seconds` and returns the collapsed stacks, one profile at a time
+async def profile(seconds: float, interval=PROFILE_INTERVAL):
+    if not _profiler_lock.acquire(blocking=False): raise RuntimeError('A profile is already being taken.')
+    try:
+        with SamplingProfiler(interval) as profiler:
+            await asyncio.sleep(seconds)
+        return profiler.collapsed()
+    finally:
+        _profiler_lock.release()
+
+# startup of this process, filled in by whoever starts serving (serve.py records the worker index and seconds to ready)
+process_startup = {}
+
+# memory of a process in MB from /proc/<pid>/smaps_rollup (Linux): rss, pss (rss with every shared page split
+# between the processes sharing it), shared and private; pages a pre-forked worker inherited and never wrote to stay shared
+# elsewhere only the peak rss of the current process is known
+def process_info(pid='self'):
+    fields = {'Rss': 'rss_mb', 'Pss': 'pss_mb', 'Shared_Clean': 'shared_mb', 'Shared_Dirty': 'shared_mb', 'Private_Clean': 'private_mb', 'Private_Dirty': 'private_mb'}
+    info = {'pid': os.getpid() if pid == 'self' else pid}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in fields: info[fields[key]] = info.get(fields[key], 0) + int(value.split()[0]) / 1024
+    except OSError:
+        if pid != 'self': return info
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        info['max_rss_mb'] = maxrss / (1 << 20 if sys.platform == 'darwin' else 1024) # bytes on macOS, KB on Linux
+        return info
+    return {key: round(value, 1) if key != 'pid' else value for key, value in info.items()}
@@ -1,75 +1,152 @@
 import asyncio
-from helpers import get_client, get_age, analyze_profile_image, get_sentiment_score, analyze_tweets_similarity, features_dict
-from transformers import pipeline
-import torch
-import pandas as pd
-import joblib
-import shap
+import os
+from images import image_analyzer
+from clients import client_pool, timeline_cost
+from ratelimit import is_rate_limit_error
+from retry import RetryPolicy, Deadline, retry
+from helpers import get_age, features_dict, SentimentBatcher
+from streaming import TimelineAggregator, iterate_pages, aggregate_timeline
+from registry import registry
+from attribution import ATTRIBUTION_MODE, TOP_K
+from cache import TieredCache, MemoryCache, SQLiteCache, CACHE_PATH
+from metrics import span, timed, predictions_total
+from search_index import user_index, user_info
 
 TARGET_TWEETS = 125
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu") 
+FEATURES_TTL = 6 * 60 * 60 # seconds
+RESULT_TTL = 6 * 60 * 60
+BATCH_CONCURRENCY = 8 # users fetched at the same time by a batch prediction
+MAX_MODEL_BATCH_SIZE = 256 # users scored by one model + SHAP call
+FETCH_DEADLINE = float(os.environ.get('FETCH_DEADLINE', 30)) or None # seconds to fetch a user in, 0 waits for every tweet
+FETCH_RETRY = RetryPolicy(attempts=4, base_delay=0.5, max_delay=5) # rate limits aren't waited out, the pool already tried every session
+MIN_PARTIAL_TWEETS = 20 # a fetch cut short with fewer tweets than this is invalid rather than a low confidence prediction
+IMAGE_GRACE = 2 # seconds the profile image still gets when the deadline already ran out on the tweets
+DEFAULT_PROFILE_IMAGE_VALID = False # used when the image can't be analyzed in time, like ~96% of the dataset
+
+# how much of the tweet sample a prediction is based on, only 'high' (every tweet that was asked for) is cached
+CONFIDENCE_HIGH, CONFIDENCE_MEDIUM, CONFIDENCE_LOW = 'high', 'medium', 'low'
+
+# features only depend on the account, results also depend on the model version
+# so swapping the model invalidates the result tier but keeps the (expensive to fetch) features
+prediction_cache = TieredCache(MemoryCache(), SQLiteCache(CACHE_PATH) if CACHE_PATH else None)
+
+def features_key(screen_name: str):
+    return f"features:{screen_name.lower()}"
+
+def result_key(screen_name: str, model_version: str, attribution=ATTRIBUTION_MODE):
+    return f"result:{model_version}:{attribution}:{screen_name.lower()}"
+
 # function that makes prediction
 # retuns prediction (human | bot | invalid), probability of prediction,
 # and top three user features that contributed to the prediction w/ their values
 # prediction can be invalid if the user is private (unable to access data) 
 # or has no tweets (not enough data)
-async def make_prediction(screen_name: str):
-    client = get_client()
-    user = await client.get_user_by_screen_name(screen_name)
-    if not user: return {"prediction": "invalid", "probability": 0, "features": [], "error": "User not found."} 
+# attribution picks how the top features are found: 'exact' (TreeSHAP) or 'path' (faster Saabas attributions)
+async def make_prediction(screen_name: str, attribution=ATTRIBUTION_MODE):
+    artifacts = await asyncio.to_thread(registry.get)
+
+    result = await prediction_cache.get_async(result_key(screen_name, artifacts.version, attribution), RESULT_TTL)
+    if result is not None:
+        predictions_total.inc(outcome=result['prediction'], cached='true')
+        return result
+
+    features, confidence = await prediction_cache.get_async(features_key(screen_name), FEATURES_TTL), CONFIDENCE_HIGH
+    if features is None:
+        features, error, confidence = await compute_features(screen_name, artifacts.sentiment_analyzer)
+        if features is None: # invalid results aren't cached, the user may become valid again
+            predictions_total.inc(outcome='invalid', cached='false')
+            return error
+        if confidence == CONFIDENCE_HIGH: await prediction_cache.set_async(features_key(screen_name), features, FEATURES_TTL)
+
+    result = {**await asyncio.to_thread(predict_features, features, artifacts, attribution), 'confidence': confidence}
+    if confidence == CONFIDENCE_HIGH: await prediction_cache.set_async(result_key(screen_name, artifacts.version, attribution), result, RESULT_TTL)
+    predictions_total.inc(outcome=result['prediction'], cached='false')
+    return result
+
+# returns the confidence of features built from tweets_count tweets
+def sample_confidence(complete: bool, tweets_count: int):
+    if complete: return CONFIDENCE_HIGH
+    return CONFIDENCE_MEDIUM if tweets_count >= TARGET_TWEETS // 2 else CONFIDENCE_LOW
+
+# one step down, for features that had to fall back on a default
+def lower_confidence(confidence: str):
+    return CONFIDENCE_MEDIUM if confidence == CONFIDENCE_HIGH else CONFIDENCE_LOW
+
+def invalid_prediction(error: str):
+    return {"prediction": "invalid", "probability": 0, "features": [], "error": error}
+
+# fetches the user's profile and tweets and computes the model's features
+# pages of tweets are aggregated as they arrive (see streaming.py), so features are ready right after the last page
+# the whole fetch, retries included, has `deadline` seconds: failed requests are retried with backoff while there
+# is time, and when the budget runs out (or the errors don't stop) the features are built from the tweets fetched so far
+# returns (features, None, confidence), or (None, invalid prediction, None) when the user can't be analyzed
+# confidence is CONFIDENCE_HIGH unless the fetch was cut short, such features (and results) shouldn't be cached
+@timed('features')
+async def compute_features(screen_name: str, sentiment_analyzer, deadline=FETCH_DEADLINE, scorer=None):
+    budget = Deadline(deadline)
+    with span('user_lookup'):
+        user = await retry(lambda: client_pool.run(lambda client: client.get_user_by_screen_name(screen_name)), FETCH_RETRY, budget, 'user_lookup')
+    if not user: return None, invalid_prediction("User not found."), None
+    await asyncio.to_thread(user_index.add, user_info(user)) # predicted accounts show up in /search without asking Twitter
 
-    parsed_owned_tweets_count, parsed_owned_text_tweets_count, parsed_retweets_count, likes_count, replies_count, retweets_count, reply_tweets_count, urls_count, hashtags_count, quotes_tweet_count, sentiment =  0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
     age = get_age(user.created_at)
 
-    try:
-        # analyze profile picture with openCV
-        is_profile_image_valid = analyze_profile_image(user.profile_image_url)
-    except Exception as e:
-        print(f"Error analyzing profile image for user {user.id}: {e}")
-        return
+    # analyze profile picture with openCV in the background while the tweets are fetched
+    image_task = asyncio.ensure_future(image_analyzer.analyze(user.profile_image_url))
 
-    tweets = []
+    timeline = TimelineAggregator(sentiment_analyzer, TARGET_TWEETS, user.description, scorer=scorer)
 
-    finished = False
-    while not finished:
+    # a rate limited session hands the rest of the fetch over to the next one in the pool
+    # a retry continues after the tweets that were already counted
+    # aggregate_timeline stops fetching at the deadline itself and keeps what it has, so retry doesn't cancel it
+    def fetch(client):
+        pages = iterate_pages(lambda: client.get_user_tweets(user.id, 'Tweets', count=TARGET_TWEETS), TARGET_TWEETS, skip=timeline.tweets_count)
+        return aggregate_timeline(pages, timeline, budget.expires_at)
+
+    fetch_error = None
+    with span('timeline'):
         try:
-            res = await user.get_tweets('Tweets', count=TARGET_TWEETS)
-            while res and len(tweets) < TARGET_TWEETS:
-                tweets += res
-                res = await res.next()
-            finished = True
+            await retry(lambda: client_pool.run(fetch, cost=timeline_cost(TARGET_TWEETS)), FETCH_RETRY, budget, 'timeline', bound_attempts=False)
         except Exception as e:
-            if 'Rate limit exceeded' in str(e): 
-                return {"prediction": "invalid", "probability": 0, "features": [], "error": "Server rate limit exceeded. Try again in 15 minutes."}
-    
-    if len(tweets) <= 0: 
-        return {"prediction": "invalid", "probability": 0, "features": [], "error": "User is either private or has no tweets to analyze."}
-
-    sentiment_analyzer = pipeline('sentiment-analysis', model='cardiffnlp/twitter-roberta-base-sentiment', device=device, max_length=512, truncation=True)
-    tweets = tweets[:TARGET_TWEETS]
-
-    for tweet in tweets:
-        if tweet.retweeted_tweet: 
-            parsed_retweets_count += 1
-            continue
-        if tweet.text:
-            sentiment += get_sentiment_score(tweet.text, sentiment_analyzer)
-            parsed_owned_text_tweets_count += 1
-        if tweet.in_reply_to: reply_tweets_count += 1
-        if tweet.is_quote_status: quotes_tweet_count += 1
-        parsed_owned_tweets_count += 1
-        hashtags_count += len(tweet.hashtags)
-        likes_count += tweet.favorite_count
-        replies_count += tweet.reply_count
-        retweets_count += tweet.retweet_count
-        urls_count += len(tweet.urls)
-
-    identical_tweet_pairs, num_tweet_pairs = analyze_tweets_similarity(tweets)
-
-    features = {
+            print(f"Error fetching tweets for user {user.id}: {e}")
+            fetch_error = e
+
+    complete = fetch_error is None and not timeline.timed_out
+    if not complete and timeline.tweets_count < MIN_PARTIAL_TWEETS:
+        image_task.cancel()
+        if fetch_error is None: return None, invalid_prediction("Couldn't fetch enough tweets in time. Try again later."), None
+        if is_rate_limit_error(fetch_error): return None, invalid_prediction("Server rate limit exceeded. Try again in 15 minutes."), None
+        return None, invalid_prediction("Unable to fetch the user's tweets. Try again later."), None
+    if timeline.tweets_count <= 0: 
+        image_task.cancel()
+        return None, invalid_prediction("User is either private or has no tweets to analyze."), None
+
+    confidence = sample_confidence(complete, timeline.tweets_count)
+    try:
+        # analyze profile picture with openCV, the wait is whatever the image took beyond the tweets
+        # (at least IMAGE_GRACE, so a deadline spent on the tweets doesn't throw away an almost finished image)
+        with span('image_wait'):
+            is_profile_image_valid = await asyncio.wait_for(image_task, max(budget.remaining(), IMAGE_GRACE) if budget.expires_at is not None else None)
+    except Exception as e:
+        # the prediction goes ahead without the image, at a lower confidence so it isn't cached
+        print(f"Error analyzing profile image for user {user.id}: {e!r}")
+        is_profile_image_valid, confidence = DEFAULT_PROFILE_IMAGE_VALID, lower_confidence(confidence)
+
+    await asyncio.to_thread(timeline.finish)
+    return build_features(user, age, timeline, is_profile_image_valid), None, confidence
+
+# returns the model's features from the user's profile and the counts of their timeline
+# timeline is a streaming.TimelineAggregator, or anything with the same counts (e.g. a watchlist.WatchState window)
+def build_features(user, age: int, timeline, is_profile_image_valid):
+    identical_tweet_pairs, num_tweet_pairs = timeline.similarity_counts()
+    parsed_owned_tweets_count, parsed_owned_text_tweets_count = timeline.parsed_owned_tweets_count, timeline.parsed_owned_text_tweets_count
+    likes_count, replies_count, retweets_count = timeline.likes_count, timeline.replies_count, timeline.retweets_count
+    description_sentiment = timeline.description_sentiment
+
+    return {
         'account_age': age,
         'is_blue_verified': user.is_blue_verified,
-        'profile_description_sentiment': round(get_sentiment_score(user.description, sentiment_analyzer), 3) if user.description else 0,
+        'profile_description_sentiment': round(description_sentiment, 3) if user.description else 0,
         'following_count': user.following_count,
         'followers_count': user.followers_count,
         'following_to_followers': round(user.following_count / user.followers_count, 3) if user.followers_count > 0 else 0,
@@ -82,37 +159,110 @@ async def make_prediction(screen_name: str):
         'media_freq': round(user.media_count / age, 3) if age > 0 else 0,
         'followers_freq': round(user.followers_count / age, 3) if age > 0 else 0,
         'following_freq': round(user.following_count / age, 3) if age > 0 else 0,
-        'replies_to_owned': round(reply_tweets_count / parsed_owned_tweets_count, 3) if parsed_owned_tweets_count > 0 else 0,
-        'quotes_to_owned': round(quotes_tweet_count / parsed_owned_tweets_count, 3) if parsed_owned_tweets_count > 0 else 0,
+        'replies_to_owned': round(timeline.reply_tweets_count / parsed_owned_tweets_count, 3) if parsed_owned_tweets_count > 0 else 0,
+        'quotes_to_owned': round(timeline.quotes_tweet_count / parsed_owned_tweets_count, 3) if parsed_owned_tweets_count > 0 else 0,
         'retweets_to_owned': round(retweets_count / parsed_owned_tweets_count, 3) if parsed_owned_tweets_count > 0 else 0,
-        'avg_urls': round(urls_count / parsed_owned_tweets_count, 3) if parsed_owned_tweets_count > 0 else 0,
-        'avg_hashtags': round(hashtags_count / parsed_owned_tweets_count, 3) if parsed_owned_tweets_count > 0 else 0,
+        'avg_urls': round(timeline.urls_count / parsed_owned_tweets_count, 3) if parsed_owned_tweets_count > 0 else 0,
+        'avg_hashtags': round(timeline.hashtags_count / parsed_owned_tweets_count, 3) if parsed_owned_tweets_count > 0 else 0,
         'identical_tweet_freq': round(identical_tweet_pairs / num_tweet_pairs, 3) if num_tweet_pairs > 0 else 0,
-        'avg_tweet_sentiment': round(sentiment / parsed_owned_text_tweets_count, 3) if parsed_owned_text_tweets_count > 0 else 0,
+        'avg_tweet_sentiment': round(timeline.sentiment / parsed_owned_text_tweets_count, 3) if parsed_owned_text_tweets_count > 0 else 0,
         'avg_replies_per_follower': round(replies_count / parsed_owned_tweets_count / user.followers_count * 1000, 3) if user.followers_count > 0 and parsed_owned_tweets_count > 0 else 0,
         'avg_likes_per_follower': round(likes_count / parsed_owned_tweets_count / user.followers_count * 1000, 3) if user.followers_count > 0 and parsed_owned_tweets_count > 0 else 0,
         'avg_retweets_per_follower': round(retweets_count / parsed_owned_tweets_count / user.followers_count * 1000, 3) if user.followers_count > 0 and parsed_owned_tweets_count > 0 else 0,
     }
 
-    user_df = pd.DataFrame(features, index=[0])
+# runs the model and attribution engine on a user's features
+def predict_features(features: dict, artifacts, attribution=ATTRIBUTION_MODE):
+    return predict_features_batch([features], artifacts, attribution)[0]
 
-    model = joblib.load('model.joblib')
-    prediction = model.predict(user_df.values)
-    probabilities = model.predict_proba(user_df.values)
+# runs the model and attribution engine once over the stacked features of many users
+# only the top TOP_K attributions towards each predicted class are kept
+def predict_features_batch(features_list: list, artifacts, attribution=ATTRIBUTION_MODE):
+    import pandas as pd # imported on first use so routes that never predict (e.g. /search) don't load it
+    users_df = pd.DataFrame(features_list)
 
-    explainer = shap.TreeExplainer(model)
-    shap_values = explainer.shap_values(user_df)
-    feature_names = user_df.columns.tolist()
+    # the compiled forest gives the same results as model.predict/predict_proba without sklearn's per-call overhead
+    with span('model'):
+        probabilities = artifacts.forest.predict_proba(users_df.values)
+        predictions = artifacts.forest.classes.take(probabilities.argmax(axis=1))
 
-    feature_contributions = list(zip(feature_names, shap_values[0][:, 0 if prediction[0] == 0 else 1]))
-    feature_contributions.sort(key=lambda x: abs(x[1]), reverse=True)
-    top_features = {features_dict[feature]: features[feature] for feature, _ in feature_contributions[:3]}
+    with span(f"attribution_{attribution}"):
+        top_indices, _ = artifacts.attribution.top_k(users_df.values, predictions, TOP_K, attribution)
+    feature_names = users_df.columns.tolist()
 
-    return {
-        'prediction': 'bot' if prediction[0] == 1 else 'human',
-        'probability': float(probabilities[0][1]) if prediction[0] == 1 else float(probabilities[0][0]),
-        'top_features': top_features
-    }
+    results = []
+    for i, features in enumerate(features_list):
+        prediction = predictions[i]
+        top_features = {features_dict[feature_names[j]]: features[feature_names[j]] for j in top_indices[i]}
+
+        results.append({
+            'prediction': 'bot' if prediction == 1 else 'human',
+            'probability': float(probabilities[i][1]) if prediction == 1 else float(probabilities[i][0]),
+            'top_features': top_features
+        })
+    return results
+
+# makes predictions for many users, yielding {'screen_name': ..., **prediction} as each one finishes
+# users are fetched concurrently (at most `concurrency` at a time to stay inside the rate limit), and whatever
+# features are ready are stacked and scored together, so the model and SHAP run once per batch instead of per user
+# (the same goes for the sentiment model, the pages of the users being fetched share its batches)
+async def make_batch_prediction(screen_names: list, concurrency=BATCH_CONCURRENCY, max_batch_size=MAX_MODEL_BATCH_SIZE, attribution=ATTRIBUTION_MODE):
+    artifacts = await asyncio.to_thread(registry.get)
+    semaphore = asyncio.Semaphore(concurrency)
+    ready = asyncio.Queue()
+    sentiment = SentimentBatcher(artifacts.sentiment_analyzer) # pages of different users are scored together
+
+    async def collect(screen_name):
+        try:
+            result = await prediction_cache.get_async(result_key(screen_name, artifacts.version, attribution), RESULT_TTL)
+            if result is not None:
+                predictions_total.inc(outcome=result['prediction'], cached='true')
+                return await ready.put((screen_name, None, result, None))
+
+            features, confidence = await prediction_cache.get_async(features_key(screen_name), FEATURES_TTL), CONFIDENCE_HIGH
+            if features is None:
+                async with semaphore:
+                    features, error, confidence = await compute_features(screen_name, artifacts.sentiment_analyzer, scorer=sentiment)
+                if features is None:
+                    predictions_total.inc(outcome='invalid', cached='false')
+                    return await ready.put((screen_name, None, error, None))
+                if confidence == CONFIDENCE_HIGH: await prediction_cache.set_async(features_key(screen_name), features, FEATURES_TTL)
+            await ready.put((screen_name, features, None, confidence))
+        except Exception as e:
+            print(f"Exception caught: {e}")
+            await ready.put((screen_name, None, {"error": str(e)}, None))
+
+    # screen names are case-insensitive, only analyze each account once
+    unique_names = list({screen_name.lower(): screen_name for screen_name in screen_names}.values())
+    tasks = [asyncio.ensure_future(collect(screen_name)) for screen_name in unique_names]
+
+    try:
+        remaining = len(tasks)
+        while remaining:
+            items = [await ready.get()]
+            while not ready.empty() and len(items) < max_batch_size:
+                items.append(ready.get_nowait())
+            remaining -= len(items)
+
+            finished = [(screen_name, result) for screen_name, _, result, _ in items if result is not None]
+            pending = [(screen_name, features, confidence) for screen_name, features, _, confidence in items if features is not None]
+            if pending:
+                try:
+                    results = await asyncio.to_thread(predict_features_batch, [features for _, features, _ in pending], artifacts, attribution)
+                except Exception as e:
+                    print(f"Exception caught: {e}")
+                    results = [{"error": str(e)}] * len(pending)
+                for (screen_name, _, confidence), result in zip(pending, results):
+                    if 'error' not in result:
+                        result = {**result, 'confidence': confidence}
+                        predictions_total.inc(outcome=result['prediction'], cached='false')
+                        if confidence == CONFIDENCE_HIGH: await prediction_cache.set_async(result_key(screen_name, artifacts.version, attribution), result, RESULT_TTL)
+                    finished.append((screen_name, result))
+
+            for screen_name, result in finished:
+                yield {'screen_name': screen_name, **result}
+    finally:
+        for task in tasks: task.cancel()
 
 if __name__ == '__main__':
     screen_name = 'DKVaishnav96' # DKVaishnav96 for example
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+RATE_LIMIT_WINDOW = 900 # Twitter rate limits reset every 15 minutes
+
+# returns True if the exception is a Twitter rate limit response
+def is_rate_limit_error(e: Exception):
+    return type(e).__name__ == 'TooManyRequests' or 'Rate limit exceeded' in str(e)
+
+# returns the number of seconds until the rate limit from the exception resets
+def get_rate_limit_reset(e: Exception, default=RATE_LIMIT_WINDOW):
+    reset = getattr(e, 'rate_limit_reset', None)
+    if not reset: return default
+    return max(1, reset - time.time())
+
+# Token bucket shared by every task that calls the rate-limited endpoint
+# tokens refill at `rate` per second up to `capacity`; the rate creeps back up after successes
+# and is halved (with all requests paused until the window resets) when Twitter reports a rate limit
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1, min_rate: float = None, max_rate: float = None, increase=0.05):
+        self.rate = rate
+        self.base_rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate if min_rate is not None else rate / 8
+        self.max_rate = max_rate if max_rate is not None else rate * 2
+        self.increase = increase
+        self.tokens = capacity
+        self.paused_until = 0
+        self.rate_limits = 0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    # waits until a token is available and takes it
+    async def acquire(self):
+        async with self._lock: # first come, first served
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # additive increase after a successful request
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.increase * self.base_rate)
+
+    # multiplicative decrease after a rate limit response, nobody gets a token until the limit resets
+    def on_rate_limit(self, reset_after: float = RATE_LIMIT_WINDOW):
+        self.rate_limits += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0
+        self._updated = time.monotonic()
+        self.paused_until = max(self.paused_until, self._updated + reset_after)
+
+    def stats(self):
+        return {'rate': round(self.rate, 4), 'tokens': round(self.tokens, 2), 'paused_for': max(0, round(self.paused_until - time.monotonic(), 1)), 'rate_limits': self.rate_limits}
@@ -0,0 +1,187 @@
+import os
+import json
+import threading
+import hashlib
+import time
+from dataclasses import dataclass
+import numpy as np
+from attribution import AttributionEngine
+from forest import CompiledForest, load_forest
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+MODELS_DIR = os.path.join(dir_path, 'models') # one directory per version written by train.py
+MODEL_FILENAME = 'model.joblib'
+METADATA_FILENAME = 'metadata.json'
+LATEST_PATH = os.path.join(MODELS_DIR, 'LATEST') # the version served by default, set by train.py --promote
+LEGACY_MODEL_PATH = os.path.join(dir_path, MODEL_FILENAME) # unversioned model from before train.py
+
+# returns the model file of a version, of MODEL_VERSION or of models/LATEST, falling back to the unversioned model.joblib
+def get_model_path(version: str = None):
+    version = version or os.environ.get('MODEL_VERSION')
+    if not version and os.path.exists(LATEST_PATH):
+        with open(LATEST_PATH) as f:
+            version = f.read().strip()
+    if not version: return LEGACY_MODEL_PATH
+    path = os.path.join(MODELS_DIR, version, MODEL_FILENAME)
+    if not os.path.exists(path): raise FileNotFoundError(f"No model version {version} in {MODELS_DIR}")
+    return path
+
+def set_latest_version(version: str):
+    tmp_path = LATEST_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(version + '\n')
+    os.replace(tmp_path, LATEST_PATH)
+
+# returns the metadata.json written next to a versioned model, None for unversioned ones
+def load_metadata(model_path: str):
+    path = os.path.join(os.path.dirname(model_path), METADATA_FILENAME)
+    if not os.path.exists(path): return None
+    with open(path) as f:
+        return json.load(f)
+
+# everything needed to serve one model version, swapped as a whole on reload
+@dataclass(frozen=True)
+class Artifacts:
+    version: str
+    model_path: str
+    model: object
+    forest: CompiledForest
+    explainer: object
+    attribution: AttributionEngine
+    sentiment_analyzer: object
+    metadata: dict = None
+
+# returns a short content hash of the model file, used as its version
+def get_model_version(model_path: str):
+    sha = hashlib.sha256()
+    with open(model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()[:12]
+
+# process-wide holder for the model, SHAP explainer and sentiment pipeline
+# artifacts are loaded once and shared by app.py, predict.py and dataset.py
+class ModelRegistry:
+    # model_path None serves the version get_model_path picks, resolved on first load so a bad MODEL_VERSION or
+    # models/LATEST shows up as a failed warm-up on /health instead of breaking every import of this module
+    def __init__(self, model_path: str = None):
+        self.model_path = model_path
+        self.status = 'cold' # cold -> warming -> ready | failed
+        self.error = None
+        self.loaded_at = None
+        self.warm_up_seconds = None
+        self._artifacts = None
+        self._sentiment_analyzer = None
+        self.sentiment_info = None
+        self._lock = threading.RLock()
+
+    # the sentiment pipeline doesn't depend on the model version, so it is loaded on its own
+    # (crawling for the dataset needs it before any model has been trained), the backend comes from SENTIMENT_BACKEND
+    def get_sentiment_analyzer(self):
+        if self._sentiment_analyzer is None:
+            with self._lock:
+                if self._sentiment_analyzer is None:
+                    # torch and transformers are imported here, so processes that only serve cached or lightweight routes never load them
+                    from sentiment import load_sentiment_analyzer, device, SENTIMENT_BACKEND, SENTIMENT_MODEL
+                    self._sentiment_analyzer = load_sentiment_analyzer()
+                    self.sentiment_info = {'backend': SENTIMENT_BACKEND, 'model': SENTIMENT_MODEL, 'device': str(device)}
+        return self._sentiment_analyzer
+
+    # returns the current artifacts, loading them on first use
+    # callers should grab this once per request so a concurrent reload can't mix versions
+    def get(self) -> Artifacts:
+        artifacts = self._artifacts
+        if artifacts is None:
+            with self._lock:
+                if self._artifacts is None:
+                    self._artifacts = self._load(self.model_path or get_model_path())
+                    self.model_path = self._artifacts.model_path
+                artifacts = self._artifacts
+        return artifacts
+
+    @property
+    def version(self):
+        return self._artifacts.version if self._artifacts else None
+
+    @property
+    def is_ready(self):
+        return self.status == 'ready'
+
+    def _load(self, model_path: str) -> Artifacts:
+        import joblib
+        import shap
+        from helpers import features_dict
+        metadata = load_metadata(model_path)
+        if os.path.abspath(model_path) == LEGACY_MODEL_PATH: print(f"Serving the unversioned {LEGACY_MODEL_PATH}, train and promote a version with train.py --promote")
+        # predictions build features in features_dict order, a model trained on another order would silently mix them up
+        if metadata is not None and metadata['features'] != list(features_dict):
+            raise ValueError(f"Model {model_path} was trained on features {metadata['features']}, not the features_dict order")
+        version = get_model_version(model_path)
+        model = joblib.load(model_path)
+        forest = load_forest(model, model_path, version) # memory-mapped, shared by every worker
+        explainer = shap.TreeExplainer(model)
+        return Artifacts(version, model_path, model, forest, explainer, AttributionEngine(model, forest, explainer), self.get_sentiment_analyzer(), metadata)
+
+    # runs each artifact once so the first real request doesn't pay for lazy initialization
+    @staticmethod
+    def _warm(artifacts: Artifacts):
+        row = np.zeros((1, artifacts.model.n_features_in_))
+        artifacts.forest.predict_proba(row)
+        for mode in ('exact', 'path'): artifacts.attribution.top_k(row, [0], mode=mode)
+        artifacts.sentiment_analyzer('warm up')
+
+    # loads and warms all artifacts, blocking until done
+    def warm_up(self):
+        start = time.perf_counter()
+        self.status = 'warming'
+        try:
+            self._warm(self.get())
+        except Exception as e:
+            self.status, self.error = 'failed', str(e)
+            print(f"Error warming up model registry: {e}")
+            raise
+        self.status, self.error = 'ready', None
+        self.loaded_at = time.time()
+        self.warm_up_seconds = round(time.perf_counter() - start, 3)
+
+    # warms up on a daemon thread so the server can start accepting connections immediately
+    def warm_up_in_background(self):
+        def run():
+            try:
+                self.warm_up()
+            except Exception:
+                pass
+        thread = threading.Thread(target=run, name='registry-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    # loads and warms a new model version next to the current one, then swaps it in atomically
+    # requests already in flight keep using the artifacts they grabbed
+    # without a path or version, the version models/LATEST points at is loaded (or model.joblib again)
+    def reload(self, model_path: str = None, version: str = None):
+        model_path = model_path or get_model_path(version)
+        artifacts = self._load(model_path)
+        self._warm(artifacts)
+        with self._lock:
+            self._artifacts = artifacts
+            self.model_path = model_path
+            self.loaded_at = time.time()
+            self.status, self.error = 'ready', None
+        return artifacts.version
+
+    def status_info(self):
+        metadata = (self._artifacts.metadata if self._artifacts else None) or {}
+        return {
+            'status': self.status,
+            'version': self.version,
+            'model_path': self.model_path,
+            'loaded_at': self.loaded_at,
+            'warm_up_seconds': self.warm_up_seconds,
+            'trained_at': metadata.get('trained_at'),
+            'metrics': metadata.get('metrics'),
+            'sentiment': self.sentiment_info,
+            'error': self.error,
+        }
+
+registry = ModelRegistry()
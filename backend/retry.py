@@ -0,0 +1,71 @@
+import asyncio
+import random
+import time
+from ratelimit import is_rate_limit_error, get_rate_limit_reset
+from metrics import metrics
+
+# Retries with jittered exponential backoff inside a per-request time budget
+# shared by the /predict fetch (short budget, gives up and degrades) and the crawler (waits out rate limits)
+
+# Twikit errors that won't go away by asking again (matched by name, like ratelimit.is_rate_limit_error)
+PERMANENT_ERRORS = {'BadRequest', 'Unauthorized', 'Forbidden', 'NotFound', 'UserNotFound', 'UserUnavailable', 'AccountSuspended', 'AccountLocked', 'TweetNotAvailable'}
+
+retries_total = metrics.counter('botdetector_retries_total', 'Retries scheduled, by operation and reason (rate_limit, error)', ['operation', 'reason'])
+
+def is_retryable_error(e: Exception):
+    return type(e).__name__ not in PERMANENT_ERRORS
+
+# Time budget of one request, None never runs out
+class Deadline:
+    def __init__(self, seconds: float = None):
+        self.expires_at = time.monotonic() + seconds if seconds is not None else None
+
+    def remaining(self):
+        if self.expires_at is None: return float('inf')
+        return max(0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+# attempts counts the first try, delays are drawn from [0, min(max_delay, base_delay * 2^retry)] ("full jitter"),
+# so callers that failed together don't retry together
+# rate limits wait until the limit resets when wait_on_rate_limit is set, and give up right away otherwise
+class RetryPolicy:
+    def __init__(self, attempts=4, base_delay=0.5, max_delay=10.0, wait_on_rate_limit=False):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.wait_on_rate_limit = wait_on_rate_limit
+
+    def backoff(self, retry: int):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+    # returns the seconds to wait before retry number `retry` (0 based) after e, or None to give up
+    def delay(self, e: Exception, retry: int):
+        if retry + 1 >= self.attempts: return None
+        if is_rate_limit_error(e):
+            return get_rate_limit_reset(e) + self.backoff(0) if self.wait_on_rate_limit else None
+        if not is_retryable_error(e): return None
+        return self.backoff(retry)
+
+# returns await fn(), retrying failures as the policy allows while the deadline has time for the wait
+# each attempt is cancelled when the deadline runs out (a hung request raises TimeoutError instead of outliving it),
+# unless bound_attempts is False for an fn that stops at the deadline on its own and mustn't be cancelled midway
+# the last error is raised when giving up; on_retry(e, retry, delay) is called before each wait
+async def retry(fn, policy: RetryPolicy, deadline: Deadline = None, operation='request', on_retry=None, bound_attempts=True):
+    retries = 0
+    while True:
+        try:
+            if not bound_attempts or deadline is None or deadline.expires_at is None: return await fn()
+            try:
+                return await asyncio.wait_for(fn(), deadline.remaining())
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"{operation} didn't finish within the deadline") from None
+        except Exception as e:
+            delay = policy.delay(e, retries)
+            if delay is None or deadline is not None and delay >= deadline.remaining(): raise
+            retries_total.inc(operation=operation, reason='rate_limit' if is_rate_limit_error(e) else 'error')
+            if on_retry: on_retry(e, retries, delay)
+            retries += 1
+            await asyncio.sleep(delay)
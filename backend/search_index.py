@@ -0,0 +1,207 @@
+import bisect
+import csv
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from fuzzywuzzy import fuzz
+from metrics import metrics
+
+# Local index of known accounts for /search, so most keystrokes are answered from memory instead of client.search_user
+# accounts come from the dataset (the store the crawler appends to, or dataset.csv before it was converted), users looked up for predictions and past upstream search results; the last two are kept
+# in a SQLite file so they survive restarts and every worker picks up what the others added
+# queries match screen name and name prefixes first, then fuzzy matches: trigram candidates verified with fuzz.ratio
+# (the same candidates-then-verify approach as similarity.py)
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+USER_INDEX_PATH = os.environ.get('USER_INDEX_PATH', os.path.join(dir_path, 'users.sqlite3'))
+INDEX_FIELDS = ['user_id', 'screen_name', 'is_verified', 'is_blue_verified', 'followers_count', 'following_count', 'tweet_freq', 'account_age'] # dataset columns the index reads
+SEARCH_LIMIT = 10 # results returned from the local index
+LOCAL_MIN_RESULTS = 3 # fewer local screen name prefix matches than this (and no exact screen name match) is a miss that goes upstream
+LOCAL_MIN_QUERY = 5 # shorter queries only skip upstream on an exact screen name match, their prefixes match too many dataset accounts
+SEARCH_TTL = 60 * 60 # seconds an upstream response is reused for the same query
+FUZZY_MIN_SCORE = 75
+FUZZY_CANDIDATES = 200 # accounts sharing the most trigrams with the query, verified with fuzz.ratio
+MAX_PREFIX_MATCHES = 1000 # short prefixes match a lot, only this many are ranked
+SYNC_INTERVAL = 30 # seconds between picking up accounts added by other workers
+DEFAULT_PROFILE_IMAGE = 'https://abs.twimg.com/sticky/default_profile_images/default_profile_normal.png'
+
+searches_total = metrics.counter('botdetector_searches_total', 'Searches, by where they were answered from (local, cache, upstream, local_fallback)', ['source'])
+
+# returns the INDEX_FIELDS of every dataset row, like datastore.load_dataset: from the store when it has parts, dataset.csv otherwise
+# datastore (and pyarrow) is imported here so importing the app doesn't pay for it before the index loads
+def load_dataset_accounts(store_path=None, csv_path=None):
+    from datastore import DatasetStore, DATASET_STORE_PATH, DATASET_CSV_PATH
+    store_path, csv_path = store_path or DATASET_STORE_PATH, csv_path or DATASET_CSV_PATH
+    if glob.glob(os.path.join(store_path, 'part-*.arrow')):
+        return DatasetStore(store_path).load_table(INDEX_FIELDS).to_pylist()
+    if not os.path.exists(csv_path): return []
+    with open(csv_path, newline='') as f:
+        return [{field: row[field] for field in INDEX_FIELDS} for row in csv.DictReader(f)]
+
+# returns the /search representation of a Twikit user
+def user_info(user):
+    return {
+        'id': user.id,
+        'screen_name': user.screen_name,
+        'name': user.name,
+        'profile_image': user.profile_image_url,
+        'verified': user.verified,
+        'is_blue_verified': user.is_blue_verified,
+        'followers_count': user.followers_count,
+        'following_count': user.following_count,
+        'statuses_count': user.statuses_count,
+    }
+
+def normalize_query(query: str):
+    return (query or '').strip().lstrip('@').lower()
+
+def search_key(query: str):
+    return f"search:{normalize_query(query)}"
+
+def trigrams(text: str):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+# returns the lowercase strings a query can be a prefix of: the screen name, the full name and each word of the name
+def prefix_keys(info: dict):
+    name = (info.get('name') or '').lower()
+    return {info['screen_name'].lower(), name, *name.split()} - {''}
+
+# returns first followed by the accounts of second it doesn't already have, at most limit of them (None keeps all)
+def merge_results(first: list, second: list, limit: int = None):
+    seen = {user['screen_name'].lower() for user in first}
+    merged = first + [user for user in second if user['screen_name'].lower() not in seen]
+    return merged[:limit] if limit is not None else merged
+
+# accounts from the dataset have no name or profile image, fill them in (and any count missing) so every result has the user_info fields
+def with_defaults(info: dict):
+    return {'verified': False, 'is_blue_verified': False, 'followers_count': 0, 'following_count': 0, 'statuses_count': 0, **info,
+            'name': info.get('name') or info['screen_name'], 'profile_image': info.get('profile_image') or DEFAULT_PROFILE_IMAGE}
+
+class UserIndex:
+    def __init__(self, path=USER_INDEX_PATH, store_path=None, csv_path=None):
+        self.path = path
+        self.store_path, self.csv_path = store_path, csv_path # None for datastore's defaults
+        self._users = {} # lowercase screen name -> info
+        self._keys = [] # sorted (prefix key, lowercase screen name)
+        self._trigrams = {} # trigram -> lowercase screen names
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._synced_until = 0 # updated_at of the newest stored account read so far
+        self._checked_at = 0
+        self._conn = None
+        if path: self.reopen()
+
+    # opens the connection, called again in forked workers since SQLite connections must not be used across a fork
+    def reopen(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS users (screen_name TEXT PRIMARY KEY, info TEXT NOT NULL, updated_at REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS users_updated_at ON users (updated_at)')
+
+    # reads the dataset and the stored accounts, when serving starts (or ahead of forking workers) or on first search
+    # blocking, so async callers run it (and search/add, which may trigger it) in a thread
+    def load(self):
+        with self._lock:
+            if self._loaded: return
+            for row in load_dataset_accounts(self.store_path, self.csv_path):
+                if not row['screen_name']: continue
+                self._put({
+                    'id': str(row['user_id']),
+                    'screen_name': row['screen_name'],
+                    'verified': int(row['is_verified'] or 0) == 1,
+                    'is_blue_verified': int(row['is_blue_verified'] or 0) == 1,
+                    'followers_count': int(row['followers_count'] or 0),
+                    'following_count': int(row['following_count'] or 0),
+                    'statuses_count': round(float(row['tweet_freq'] or 0) * int(row['account_age'] or 0)), # tweet_freq is statuses_count / account_age
+                }, sort=False)
+            self._sync()
+            self._keys.sort()
+            self._loaded = True
+
+    # picks up accounts stored since the last sync (by this or another worker)
+    def _sync(self):
+        if self._conn is None: return
+        rows = self._conn.execute('SELECT info, updated_at FROM users WHERE updated_at > ? ORDER BY updated_at', (self._synced_until,)).fetchall()
+        for info, updated_at in rows:
+            self._put(json.loads(info), sort=self._loaded)
+            self._synced_until = updated_at
+        self._checked_at = time.monotonic()
+
+    # merges known fields into the account's entry, returns the merged entry
+    def _put(self, info: dict, sort=True):
+        key = info['screen_name'].lower()
+        current = self._users.get(key)
+        merged = {**(current or {}), **{field: value for field, value in info.items() if value is not None}}
+        self._users[key] = merged
+        old_keys = prefix_keys(current) if current else set()
+        for prefix_key in prefix_keys(merged) - old_keys:
+            if sort: bisect.insort(self._keys, (prefix_key, key))
+            else: self._keys.append((prefix_key, key))
+            for trigram in trigrams(prefix_key): self._trigrams.setdefault(trigram, set()).add(key)
+        return merged
+
+    # adds or updates accounts (user_info dicts) and stores them for other workers and restarts
+    def add(self, *infos: dict):
+        infos = [info for info in infos if info and info.get('screen_name')]
+        if not infos: return
+        with self._lock:
+            self.load()
+            merged = [self._put(info) for info in infos]
+            if self._conn is not None:
+                now = time.time()
+                self._conn.executemany('INSERT OR REPLACE INTO users (screen_name, info, updated_at) VALUES (?, ?, ?)',
+                                       [(info['screen_name'].lower(), json.dumps(info), now) for info in merged])
+
+    def get(self, screen_name: str):
+        self.load()
+        info = self._users.get(normalize_query(screen_name))
+        return with_defaults(info) if info else None
+
+    # returns up to limit accounts matching the query: exact screen name, screen name prefixes, name prefixes
+    # (larger accounts first), then fuzzy matches on screen name and name for queries of 3 or more characters
+    def search(self, query: str, limit=SEARCH_LIMIT):
+        query = normalize_query(query)
+        if not query: return []
+        self.load()
+        with self._lock:
+            if time.monotonic() - self._checked_at >= SYNC_INTERVAL: self._sync()
+            matches = {}
+            start = bisect.bisect_left(self._keys, (query,))
+            for prefix_key, key in self._keys[start:start + MAX_PREFIX_MATCHES]:
+                if not prefix_key.startswith(query): break
+                rank = 0 if key == query else 1 if prefix_key == key else 2
+                matches[key] = min(rank, matches.get(key, rank))
+            ranked = sorted(matches, key=lambda key: (matches[key], -(self._users[key].get('followers_count') or 0), key))[:limit]
+
+            if len(ranked) < limit and len(query) >= 3:
+                candidates = Counter()
+                for trigram in trigrams(query):
+                    for key in self._trigrams.get(trigram, ()):
+                        if key not in matches: candidates[key] += 1
+                scored = []
+                for key, _ in candidates.most_common(FUZZY_CANDIDATES):
+                    info = self._users[key]
+                    score = max(fuzz.ratio(query, key), fuzz.ratio(query, (info.get('name') or '').lower()))
+                    if score >= FUZZY_MIN_SCORE: scored.append((-score, -(info.get('followers_count') or 0), key))
+                ranked += [key for _, _, key in sorted(scored)[:limit - len(ranked)]]
+            return [with_defaults(self._users[key]) for key in ranked]
+
+    # True if the local results can answer the query without going upstream: the account typed is known, or enough
+    # screen names start with the query (name and fuzzy matches are only filler, they don't mean the account is there)
+    @staticmethod
+    def is_hit(query: str, results: list):
+        query = normalize_query(query)
+        screen_names = [user['screen_name'].lower() for user in results]
+        if query in screen_names: return True
+        return len(query) >= LOCAL_MIN_QUERY and sum(screen_name.startswith(query) for screen_name in screen_names) >= LOCAL_MIN_RESULTS
+
+    def stats(self):
+        return {'accounts': len(self._users), 'loaded': self._loaded, **{source: searches_total.value(source=source) for source in ('local', 'cache', 'upstream', 'local_fallback')}}
+
+user_index = UserIndex()
@@ -0,0 +1,105 @@
+import os
+import numpy as np
+import torch
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer, pipeline
+
+# Sentiment model backends, all returning the same output as the transformers pipeline (one {'label', 'score'} per text)
+#   'torch'      - the full precision pipeline, on the GPU when there is one (the reference)
+#   'int8'       - the same model with its Linear layers dynamically quantized to int8, CPU only
+#   'onnx'       - the model exported to ONNX and run with ONNX Runtime, CPU only (pip install onnx onnxruntime)
+#   'onnx-int8'  - the ONNX export with int8 dynamic quantization
+# pick one with SENTIMENT_BACKEND, and check its drift from 'torch' with sentiment_parity.py before switching production
+# SENTIMENT_MODEL can also point at a local checkpoint directory (e.g. one made by sentiment_parity.py --make-tiny-checkpoint)
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+SENTIMENT_MODEL = os.environ.get('SENTIMENT_MODEL', 'cardiffnlp/twitter-roberta-base-sentiment')
+SENTIMENT_BACKENDS = ('torch', 'int8', 'onnx', 'onnx-int8')
+SENTIMENT_BACKEND = os.environ.get('SENTIMENT_BACKEND', 'torch')
+SENTIMENT_THREADS = int(os.environ['SENTIMENT_THREADS']) if os.environ.get('SENTIMENT_THREADS') else None # intra-op threads, None keeps the library default
+ONNX_DIR = os.path.join(dir_path, 'sentiment_onnx')
+MAX_LENGTH = 512
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# returns where the ONNX export of a model is kept, next to a local checkpoint or in ONNX_DIR for hub models
+def get_onnx_path(model_name: str, quantized=False):
+    filename = 'model.int8.onnx' if quantized else 'model.onnx'
+    if os.path.isdir(model_name): return os.path.join(model_name, filename)
+    return os.path.join(ONNX_DIR, model_name.replace('/', '--'), filename)
+
+# exports the model to ONNX (and its int8 quantization) once, returns the path of the requested file
+def export_onnx(model_name: str, quantized=False):
+    path = get_onnx_path(model_name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        sample = tokenizer(['warm up', 'a slightly longer sample text'], padding=True, return_tensors='pt')
+        tmp_path = path + '.tmp'
+        with torch.no_grad():
+            torch.onnx.export(model, (sample['input_ids'], sample['attention_mask']), tmp_path,
+                              input_names=['input_ids', 'attention_mask'], output_names=['logits'], opset_version=14,
+                              dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'}, 'logits': {0: 'batch'}})
+        os.replace(tmp_path, path) # a half written export is never picked up
+        print(f"Exported {model_name} to {path}")
+
+    if not quantized: return path
+    quantized_path = get_onnx_path(model_name, quantized=True)
+    if not os.path.exists(quantized_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(path, quantized_path + '.tmp', weight_type=QuantType.QInt8)
+        os.replace(quantized_path + '.tmp', quantized_path)
+        print(f"Quantized {path} to {quantized_path}")
+    return quantized_path
+
+# Runs an ONNX export of a sequence classification model like a transformers sentiment-analysis pipeline
+class OnnxSentimentPipeline:
+    def __init__(self, onnx_path: str, tokenizer, id2label: dict, threads=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if threads: options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.tokenizer = tokenizer
+        self.id2label = id2label
+
+    def __call__(self, texts, batch_size=None, truncation=True, max_length=MAX_LENGTH, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        batch_size = batch_size or len(texts) or 1
+        results = []
+        for start in range(0, len(texts), batch_size):
+            encoded = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=truncation, max_length=max_length, return_tensors='np')
+            logits = self.session.run(['logits'], {'input_ids': encoded['input_ids'].astype(np.int64), 'attention_mask': encoded['attention_mask'].astype(np.int64)})[0]
+            probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+            probabilities /= probabilities.sum(axis=1, keepdims=True)
+            for row in probabilities:
+                label = int(row.argmax())
+                results.append({'label': self.id2label[label], 'score': float(row[label])})
+        return results[0] if single else results
+
+# sets the number of threads torch uses for inference, process wide
+def set_torch_threads(threads: int = None):
+    if threads: torch.set_num_threads(threads)
+
+# returns a sentiment analyzer for the backend, called like a transformers pipeline
+def load_sentiment_analyzer(backend=SENTIMENT_BACKEND, model_name=SENTIMENT_MODEL, threads=SENTIMENT_THREADS):
+    if backend not in SENTIMENT_BACKENDS: raise ValueError(f"Unknown sentiment backend: {backend}, expected one of {', '.join(SENTIMENT_BACKENDS)}")
+
+    if backend == 'torch':
+        set_torch_threads(threads)
+        return pipeline('sentiment-analysis', model=model_name, device=device, max_length=MAX_LENGTH, truncation=True)
+
+    if backend == 'int8':
+        set_torch_threads(threads)
+        model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return pipeline('sentiment-analysis', model=model, tokenizer=AutoTokenizer.from_pretrained(model_name), device=torch.device('cpu'), max_length=MAX_LENGTH, truncation=True)
+
+    try:
+        import onnx, onnxruntime
+    except ImportError:
+        raise RuntimeError('The onnx sentiment backends need onnx and onnxruntime (pip install onnx onnxruntime).')
+    onnx_path = export_onnx(model_name, quantized=backend == 'onnx-int8')
+    config = AutoConfig.from_pretrained(model_name)
+    return OnnxSentimentPipeline(onnx_path, AutoTokenizer.from_pretrained(model_name), {int(i): label for i, label in config.id2label.items()}, threads)
@@ -0,0 +1,140 @@
+import argparse
+import json
+import sys
+import time
+import numpy as np
+from fake_twitter import generate_fixtures, load_fixtures
+from helpers import get_sentiment_scores
+from predict import TARGET_TWEETS
+from sentiment import load_sentiment_analyzer, SENTIMENT_BACKENDS, SENTIMENT_MODEL
+
+# Accuracy parity of sentiment backends against the full precision 'torch' pipeline on a fixture corpus
+# reports the drift of per-text scores (get_sentiment_score) and of the avg_tweet_sentiment and
+# profile_description_sentiment features they feed, plus the throughput of each backend
+# usage: python sentiment_parity.py --backends int8 onnx onnx-int8 --fixtures fixtures.json --threads 4
+#        python sentiment_parity.py --make-tiny-checkpoint tiny_sentiment   (small random checkpoint for offline runs)
+#        SENTIMENT_MODEL=tiny_sentiment python sentiment_parity.py --backends int8 onnx
+
+# returns (tweet texts per user, descriptions) the way the features see them: owned tweets with text, first TARGET_TWEETS
+def load_corpus(fixtures: dict):
+    texts_per_user, descriptions = [], []
+    for user in fixtures['users']:
+        tweets = user['tweets'][:TARGET_TWEETS]
+        texts_per_user.append([tweet['text'] for tweet in tweets if tweet.get('text') and not tweet.get('retweeted_tweet')])
+        descriptions.append(user.get('description') or None)
+    return texts_per_user, descriptions
+
+# scores every text like the prediction path does (batched get_sentiment_scores), returns (scores, labels, seconds)
+def score_corpus(sentiment_analyzer, texts: list):
+    start = time.perf_counter()
+    scores = get_sentiment_scores(texts, sentiment_analyzer)
+    seconds = time.perf_counter() - start
+    labels = []
+    for start in range(0, len(texts), 256):
+        labels += [(result[0] if isinstance(result, list) else result)['label'] for result in sentiment_analyzer(texts[start:start + 256], batch_size=32, truncation=True)]
+    return np.array(scores), labels, seconds
+
+# returns the rounded avg_tweet_sentiment and profile_description_sentiment features of every user from per-text scores
+def corpus_features(scores: np.ndarray, texts_per_user: list, descriptions: list):
+    features, position = [], 0
+    for texts, description in zip(texts_per_user, descriptions):
+        tweet_scores = scores[position:position + len(texts)]
+        position += len(texts)
+        description_score = scores[position] if description else 0
+        if description: position += 1
+        features.append((round(float(tweet_scores.mean()), 3) if len(texts) else 0, round(float(description_score), 3)))
+    return np.array(features)
+
+def drift(reference: np.ndarray, candidate: np.ndarray):
+    diff = np.abs(reference - candidate)
+    return {'max': round(float(diff.max()), 4), 'mean': round(float(diff.mean()), 4), 'p95': round(float(np.percentile(diff, 95)), 4)}
+
+# writes a small randomly initialized RoBERTa sentiment checkpoint (and a byte-level BPE tokenizer trained on texts) to path,
+# the same shape of model as the real one so every backend can be exercised without downloading anything
+def make_tiny_checkpoint(path: str, texts: list, seed=0):
+    import torch
+    from tokenizers import ByteLevelBPETokenizer
+    from tokenizers.processors import RobertaProcessing
+    from transformers import RobertaConfig, RobertaForSequenceClassification, RobertaTokenizerFast
+
+    special_tokens = ['<s>', '<pad>', '</s>', '<unk>', '<mask>']
+    tokenizer = ByteLevelBPETokenizer()
+    tokenizer.train_from_iterator(texts, vocab_size=2000, special_tokens=special_tokens)
+    tokenizer.post_processor = RobertaProcessing(('</s>', tokenizer.token_to_id('</s>')), ('<s>', tokenizer.token_to_id('<s>')))
+    tokenizer = RobertaTokenizerFast(tokenizer_object=tokenizer, bos_token='<s>', eos_token='</s>', sep_token='</s>', cls_token='<s>', unk_token='<unk>', pad_token='<pad>', mask_token='<mask>', model_max_length=512)
+
+    torch.manual_seed(seed)
+    config = RobertaConfig(vocab_size=len(tokenizer), hidden_size=64, num_hidden_layers=2, num_attention_heads=2, intermediate_size=128,
+                           max_position_embeddings=514, pad_token_id=tokenizer.pad_token_id, bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id,
+                           num_labels=3, id2label={0: 'LABEL_0', 1: 'LABEL_1', 2: 'LABEL_2'}, label2id={'LABEL_0': 0, 'LABEL_1': 1, 'LABEL_2': 2}, initializer_range=0.2)
+    RobertaForSequenceClassification(config).eval().save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    print(f"Saved a tiny sentiment checkpoint to {path}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drift of sentiment backends from the full precision pipeline')
+    parser.add_argument('--backends', nargs='+', default=['int8', 'onnx', 'onnx-int8'], choices=SENTIMENT_BACKENDS)
+    parser.add_argument('--reference', default='torch', choices=SENTIMENT_BACKENDS)
+    parser.add_argument('--model', default=SENTIMENT_MODEL, help='hub id or local checkpoint directory')
+    parser.add_argument('--fixtures', help='fixtures JSON from fake_twitter.py (e.g. recorded real timelines), synthetic users otherwise')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--max-feature-drift', type=float, help='exit with 1 if a backend moves a feature by more than this')
+    parser.add_argument('--out', help='write the report as JSON')
+    parser.add_argument('--make-tiny-checkpoint', metavar='PATH')
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures) if args.fixtures else generate_fixtures(args.users)
+    texts_per_user, descriptions = load_corpus(fixtures)
+    texts = []
+    for user_texts, description in zip(texts_per_user, descriptions):
+        texts += user_texts + ([description] if description else [])
+
+    if args.make_tiny_checkpoint:
+        make_tiny_checkpoint(args.make_tiny_checkpoint, texts)
+        sys.exit(0)
+
+    print(f"Corpus: {len(texts_per_user)} users, {len(texts)} texts, model {args.model}")
+    reference = load_sentiment_analyzer(args.reference, args.model, args.threads)
+    reference('warm up')
+    reference_scores, reference_labels, reference_seconds = score_corpus(reference, texts)
+    reference_features = corpus_features(reference_scores, texts_per_user, descriptions)
+    report = {'model': args.model, 'texts': len(texts), 'users': len(texts_per_user), 'reference': {'backend': args.reference, 'texts_per_second': round(len(texts) / reference_seconds, 1)}, 'backends': {}}
+    print(f"{args.reference:<10} {len(texts) / reference_seconds:>8.1f} texts/s (reference)")
+
+    failed = False
+    for backend in args.backends:
+        if backend == args.reference: continue
+        try:
+            sentiment_analyzer = load_sentiment_analyzer(backend, args.model, args.threads)
+        except Exception as e:
+            print(f"{backend:<10} unavailable: {e}")
+            report['backends'][backend] = {'error': str(e)}
+            continue
+        sentiment_analyzer('warm up')
+        scores, labels, seconds = score_corpus(sentiment_analyzer, texts)
+        features = corpus_features(scores, texts_per_user, descriptions)
+        result = {
+            'texts_per_second': round(len(texts) / seconds, 1),
+            'speedup': round(reference_seconds / seconds, 2),
+            'label_agreement': round(float(np.mean([a == b for a, b in zip(reference_labels, labels)])), 4),
+            'score_drift': drift(reference_scores, scores),
+            'avg_tweet_sentiment_drift': drift(reference_features[:, 0], features[:, 0]),
+            'profile_description_sentiment_drift': drift(reference_features[:, 1], features[:, 1]),
+            'users_with_changed_features': int(np.any(reference_features != features, axis=1).sum()),
+        }
+        report['backends'][backend] = result
+        print(f"{backend:<10} {result['texts_per_second']:>8.1f} texts/s ({result['speedup']}x), labels agree on {result['label_agreement']:.1%}, "
+              f"score drift max {result['score_drift']['max']} mean {result['score_drift']['mean']}, "
+              f"avg_tweet_sentiment drift max {result['avg_tweet_sentiment_drift']['max']}, "
+              f"profile_description_sentiment drift max {result['profile_description_sentiment_drift']['max']}, "
+              f"{result['users_with_changed_features']}/{len(texts_per_user)} users with a changed feature")
+        worst = max(result['avg_tweet_sentiment_drift']['max'], result['profile_description_sentiment_drift']['max'])
+        if args.max_feature_drift is not None and worst > args.max_feature_drift: failed = True
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if failed:
+        print(f"A backend drifted more than {args.max_feature_drift} on a feature.")
+        sys.exit(1)
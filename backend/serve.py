@@ -0,0 +1,170 @@
+import argparse
+import asyncio
+import gc
+import os
+import select
+import signal
+import socket
+import sys
+import time
+
+# Pre-fork server: the master imports the app and loads the model, explainer and sentiment pipeline once,
+# then forks workers that share those pages copy-on-write instead of each holding its own copy
+# (hypercorn --workers starts every worker from scratch, so each one imports torch and loads the weights itself)
+# workers report when they are ready, and the master prints their startup time and memory and restarts any that die
+# usage: python serve.py --bind 0.0.0.0:5000 --workers 4
+#        python serve.py --workers 4 --no-preload   (workers load everything themselves, for comparison)
+
+started = time.perf_counter()
+
+# imports the libraries and loads and warms the artifacts in the master, returns the seconds it took
+# CUDA can't be used across a fork, so with a GPU only the libraries are preloaded and every worker warms up its own artifacts
+def preload(artifacts=True):
+    start = time.perf_counter()
+    import joblib, pandas, shap, sklearn # imported lazily by the registry and the prediction path
+    from search_index import user_index
+    user_index.load()
+    if artifacts:
+        from registry import registry
+        registry.warm_up()
+    else:
+        import torch, transformers
+    return time.perf_counter() - start
+
+def cuda_available():
+    try:
+        import torch
+        return torch.cuda.is_available()
+    except ImportError:
+        return False
+
+# runs one worker on the inherited listening socket until SIGTERM
+def run_worker(index: int, sock: socket.socket, ready_fd: int, forked_at: float, preloaded: bool):
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+    from app import app, watchlist_store
+    from predict import prediction_cache
+    from search_index import user_index
+    from registry import registry
+    from metrics import process_startup
+
+    # connections opened by the master must not be shared, reopen them in this process
+    if prediction_cache.shared is not None and hasattr(prediction_cache.shared, 'reopen'): prediction_cache.shared.reopen()
+    watchlist_store.reopen()
+    user_index.reopen()
+
+    config = Config()
+    config.bind = [f"fd://{sock.fileno()}"]
+    config.accesslog = '-'
+
+    # ready once the artifacts are warm, right away when they were inherited from the master
+    async def report_ready():
+        while registry.status in ('cold', 'warming'): await asyncio.sleep(0.05)
+        startup_seconds = round(time.perf_counter() - forked_at, 3)
+        process_startup.update({'worker': index, 'startup_seconds': startup_seconds, 'preloaded': preloaded})
+        os.write(ready_fd, f"{index} {os.getpid()} {startup_seconds} {registry.status}\n".encode())
+
+    @app.before_serving
+    async def start_reporting():
+        app.add_background_task(report_ready)
+
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, stop.set)
+        await serve(app, config, shutdown_trigger=stop.wait)
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the master turns Ctrl+C into SIGTERM
+    asyncio.run(main())
+
+def format_memory(info: dict):
+    if 'rss_mb' not in info: return 'memory unknown'
+    return f"rss {info['rss_mb']} MB, pss {info['pss_mb']} MB, shared {info['shared_mb']} MB, private {info['private_mb']} MB"
+
+class Master:
+    def __init__(self, sock: socket.socket, workers: int, preloaded: bool):
+        self.sock = sock
+        self.workers = workers
+        self.preloaded = preloaded
+        self.pids = {} # pid -> worker index
+        self.stopping = False
+        self.ready_read, self.ready_write = os.pipe()
+
+    def spawn(self, index: int):
+        forked_at = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                os.close(self.ready_read)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                run_worker(index, self.sock, self.ready_write, forked_at, self.preloaded)
+            except BaseException as e:
+                if not isinstance(e, KeyboardInterrupt):
+                    print(f"Worker {index} failed: {e}")
+                    code = 1
+            finally:
+                os._exit(code) # never fall back into the master's loop
+        self.pids[pid] = index
+        return pid
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def on_ready(self, line: str):
+        from metrics import process_info
+        index, pid, startup_seconds, status = line.split()
+        print(f"Worker {index} (pid {pid}) {'ready' if status == 'ready' else 'serving with a ' + status + ' model'} in {startup_seconds}s, {format_memory(process_info(int(pid)))}")
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.workers): self.spawn(index)
+        buffer = ''
+        while self.pids:
+            readable, _, _ = select.select([self.ready_read], [], [], 0.5)
+            if readable:
+                buffer += os.read(self.ready_read, 4096).decode()
+                *lines, buffer = buffer.split('\n')
+                for line in lines: self.on_ready(line)
+            while self.pids:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0: break
+                index = self.pids.pop(pid, None)
+                if index is None or self.stopping: continue
+                print(f"Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting it.")
+                time.sleep(1) # don't spin if workers crash on startup
+                self.spawn(index)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the app from pre-forked workers sharing the preloaded model')
+    parser.add_argument('--bind', default='127.0.0.1:5000', help='host:port')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--backlog', type=int, default=2048)
+    parser.add_argument('--no-preload', action='store_true', help='load the artifacts in every worker instead of once in the master')
+    args = parser.parse_args()
+
+    host, _, port = args.bind.rpartition(':')
+    sock = socket.create_server((host.strip('[]') or '0.0.0.0', int(port)), family=socket.AF_INET6 if ':' in host else socket.AF_INET, backlog=args.backlog)
+    sock.set_inheritable(True)
+
+    # the tokenizers' thread pool doesn't survive a fork, tokenize on the calling thread in the workers
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+    import app # the libraries every route needs, shared by all workers either way
+    preloaded = not args.no_preload and not cuda_available()
+    if not args.no_preload:
+        from metrics import process_info
+        seconds = preload(preloaded)
+        print(f"Preloaded {'the model and sentiment pipeline' if preloaded else 'the libraries (the model stays in the workers on CUDA)'} in {round(seconds, 3)}s "
+              f"({round(time.perf_counter() - started, 3)}s since start), master {format_memory(process_info())}")
+    # objects allocated so far are never collected, so the collector doesn't write to (and unshare) their pages
+    gc.freeze()
+
+    print(f"Serving on {args.bind} with {args.workers} workers")
+    Master(sock, args.workers, preloaded).run()
+    sys.exit(0)
@@ -0,0 +1,230 @@
+import bisect
+import zlib
+from collections import Counter
+import numpy as np
+from fuzzywuzzy import fuzz
+
+# Near-duplicate tweet detection for the identical_tweet_freq feature
+#
+# Candidates are generated first and only candidate pairs are verified with fuzz.ratio:
+#   'exact' - length window + character histogram bound, both are upper bounds of fuzz.ratio so no match is ever lost
+#   'lsh'   - MinHash signatures of character shingles bucketed with LSH, sub-quadratic but may miss a rare pair
+#
+# Pairs are then counted in one of two modes:
+#   'parity'    - reproduces the original loop: each tweet is compared with the set of distinct earlier tweets,
+#                 so repeated copies of a tweet only count once (use with 'exact' candidates to match the old counts)
+#   'all_pairs' - each tweet is compared with every earlier tweet, so exact duplicates are all counted
+
+SIMILARITY_SCORE_TEST_MARK = 95
+HISTOGRAM_BUCKETS = 64
+LSH_PERMUTATIONS = 128
+LSH_BANDS = 32
+SHINGLE_SIZE = 3
+
+MERSENNE_PRIME = 4294967311 # smallest prime above 2^32, keeps a * x + b inside uint64
+
+# returns the normalized text of every tweet that has text, in timeline order
+def normalize_tweets(tweets: list):
+    return [tweet.text.lower().strip() for tweet in tweets if tweet.text]
+
+# fuzz.ratio rounds 100 * ratio, so anything below this can never reach the test mark
+def _min_ratio(similarity_score_test_mark):
+    return (similarity_score_test_mark - 0.5) / 100
+
+# returns text lengths and character count histograms (characters folded into a fixed number of buckets)
+def _length_and_histograms(texts: list):
+    lengths = np.array([len(text) for text in texts], dtype=np.int64)
+    histograms = np.zeros((len(texts), HISTOGRAM_BUCKETS), dtype=np.int32)
+    for i, text in enumerate(texts):
+        for char, count in Counter(text).items():
+            histograms[i, ord(char) % HISTOGRAM_BUCKETS] += count
+    return lengths, histograms
+
+# returns candidate neighbours for each distinct text using bounds that never exceed fuzz.ratio
+# fuzz.ratio = 2 * matches / total length, and matches can't exceed the shorter length or the shared characters
+def exact_candidates(texts: list, similarity_score_test_mark=SIMILARITY_SCORE_TEST_MARK):
+    n = len(texts)
+    candidates = [[] for _ in range(n)]
+    if n < 2: return candidates
+    min_ratio = _min_ratio(similarity_score_test_mark)
+
+    lengths, histograms = _length_and_histograms(texts)
+    order = np.argsort(lengths, kind='stable')
+    sorted_lengths = lengths[order]
+    for position, i in enumerate(order):
+        # 2 * len_i / (len_i + len_j) >= min_ratio  <=>  len_j <= len_i * (2 - min_ratio) / min_ratio
+        upper = np.searchsorted(sorted_lengths, lengths[i] * (2 - min_ratio) / min_ratio, side='right')
+        window = order[position + 1:upper]
+        if len(window) == 0: continue
+        totals = lengths[i] + lengths[window]
+        shared = np.minimum(histograms[window], histograms[i]).sum(axis=1)
+        for j in window[2 * shared >= min_ratio * totals]:
+            candidates[i].append(int(j))
+            candidates[int(j)].append(int(i))
+    return candidates
+
+# returns the hashed character shingles of a text
+def _shingles(text: str):
+    if len(text) <= SHINGLE_SIZE: return np.array([zlib.crc32(text.encode())], dtype=np.uint64)
+    return np.array(list({zlib.crc32(text[k:k + SHINGLE_SIZE].encode()) for k in range(len(text) - SHINGLE_SIZE + 1)}), dtype=np.uint64)
+
+# returns candidate neighbours for each distinct text that share at least one LSH band of their MinHash signatures
+def lsh_candidates(texts: list, similarity_score_test_mark=SIMILARITY_SCORE_TEST_MARK, seed=1):
+    n = len(texts)
+    candidates = [set() for _ in range(n)]
+    if n < 2: return [[] for _ in range(n)]
+    min_ratio = _min_ratio(similarity_score_test_mark)
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MERSENNE_PRIME, size=(LSH_PERMUTATIONS, 1), dtype=np.uint64)
+    b = rng.integers(0, MERSENNE_PRIME, size=(LSH_PERMUTATIONS, 1), dtype=np.uint64)
+    rows = LSH_PERMUTATIONS // LSH_BANDS
+
+    buckets = {}
+    for i, text in enumerate(texts):
+        signature = ((a * _shingles(text)[None, :] + b) % MERSENNE_PRIME).min(axis=1)
+        for band in range(LSH_BANDS):
+            buckets.setdefault((band, signature[band * rows:(band + 1) * rows].tobytes()), []).append(i)
+
+    pairs = set()
+    for bucket in buckets.values():
+        for x, i in enumerate(bucket):
+            for j in bucket[x + 1:]:
+                pairs.add((i, j))
+    if not pairs: return [[] for _ in range(n)]
+
+    # the length and histogram bounds are still exact, so use them to drop LSH collisions cheaply
+    lengths, histograms = _length_and_histograms(texts)
+    first, second = np.array(sorted(pairs)).T
+    totals = lengths[first] + lengths[second]
+    shared = np.minimum(histograms[first], histograms[second]).sum(axis=1)
+    keep = 2 * shared >= min_ratio * totals
+    for i, j in zip(first[keep], second[keep]):
+        candidates[int(i)].add(int(j))
+        candidates[int(j)].add(int(i))
+    return [sorted(neighbours) for neighbours in candidates]
+
+CANDIDATE_GENERATORS = {'exact': exact_candidates, 'lsh': lsh_candidates}
+
+# returns the number of identical tweet pairs and the total number of pairs for normalized texts in timeline order
+def count_identical_pairs(texts: list, similarity_score_test_mark=SIMILARITY_SCORE_TEST_MARK, mode='parity', candidates='exact'):
+    if mode not in ('parity', 'all_pairs'): raise ValueError(f"Unknown similarity mode: {mode}")
+
+    # distinct texts are numbered in order of first appearance
+    distinct_ids, distinct = {}, []
+    for text in texts:
+        if text not in distinct_ids:
+            distinct_ids[text] = len(distinct)
+            distinct.append(text)
+
+    neighbours = CANDIDATE_GENERATORS[candidates](distinct, similarity_score_test_mark)
+
+    # fuzz.ratio isn't guaranteed to be symmetric, so cache each direction separately
+    verified = {}
+    def is_match(i, j):
+        key = (i, j)
+        if key not in verified:
+            verified[key] = fuzz.ratio(distinct[i], distinct[j]) >= similarity_score_test_mark
+        return verified[key]
+
+    identical_tweet_pairs, num_pairs = 0, 0
+    seen = [0] * len(distinct) # occurrences of each distinct text so far
+    num_seen_distinct, num_seen = 0, 0
+
+    for text in texts:
+        i = distinct_ids[text]
+        if mode == 'parity':
+            num_pairs += num_seen_distinct
+            if seen[i]: identical_tweet_pairs += 1
+            identical_tweet_pairs += sum(1 for j in neighbours[i] if seen[j] and is_match(i, j))
+        else:
+            num_pairs += num_seen
+            identical_tweet_pairs += seen[i]
+            identical_tweet_pairs += sum(seen[j] for j in neighbours[i] if seen[j] and is_match(i, j))
+        if not seen[i]: num_seen_distinct += 1
+        seen[i] += 1
+        num_seen += 1
+
+    return identical_tweet_pairs, num_pairs
+
+# Incremental count_identical_pairs with 'exact' candidates: texts are added one at a time in timeline order
+# (e.g. as pages of tweets arrive) and the counts so far are always available, matching the batch counts
+# match_cache ({(text, other text): is match}) carries fuzz.ratio results over between indexes of overlapping texts,
+# e.g. a watchlist window that is recounted after a few new tweets; it's filled with every pair verified here
+# distinct texts are kept sorted by length, so each add only bounds the texts inside its length window (like exact_candidates)
+# and the length and histogram arrays grow by doubling, which keeps building an index of n texts close to the batch cost
+class SimilarityIndex:
+    def __init__(self, similarity_score_test_mark=SIMILARITY_SCORE_TEST_MARK, mode='parity', match_cache: dict = None):
+        if mode not in ('parity', 'all_pairs'): raise ValueError(f"Unknown similarity mode: {mode}")
+        self.similarity_score_test_mark = similarity_score_test_mark
+        self.mode = mode
+        self.min_ratio = _min_ratio(similarity_score_test_mark)
+        self.distinct_ids, self.distinct, self.seen = {}, [], []
+        self.lengths = np.zeros(16, dtype=np.int64) # rows past len(self.distinct) are spare capacity
+        self.histograms = np.zeros((16, HISTOGRAM_BUCKETS), dtype=np.int32)
+        self.sorted_lengths, self.sorted_ids = [], [] # distinct texts ordered by length
+        self.verified = {}
+        self.match_cache = match_cache
+        self.identical_tweet_pairs, self.num_pairs, self.num_seen, self.num_seen_distinct = 0, 0, 0, 0
+
+    # adds a normalized text and updates the counts
+    def add(self, text: str):
+        i = self.distinct_ids.get(text)
+        if i is None:
+            i = len(self.distinct)
+            self.distinct_ids[text] = i
+            self.distinct.append(text)
+            self.seen.append(0)
+            self._store(i, text)
+
+        # every distinct text seen before is already counted in self.seen, same bounds as exact_candidates
+        # 2 * min(len_i, len_j) >= min_ratio * (len_i + len_j)  <=>  len_i * r / (2 - r) <= len_j <= len_i * (2 - r) / r
+        length = int(self.lengths[i])
+        start = bisect.bisect_left(self.sorted_lengths, length * self.min_ratio / (2 - self.min_ratio))
+        end = bisect.bisect_right(self.sorted_lengths, length * (2 - self.min_ratio) / self.min_ratio)
+        others = np.array([j for j in self.sorted_ids[start:end] if j != i], dtype=np.int64)
+        if len(others):
+            totals = length + self.lengths[others]
+            shared = np.minimum(self.histograms[others], self.histograms[i]).sum(axis=1)
+            window = 2 * np.minimum(length, self.lengths[others]) >= self.min_ratio * totals
+            candidates = np.sort(others[window & (2 * shared >= self.min_ratio * totals)])
+        else:
+            candidates = others
+        matches = [int(j) for j in candidates if self.seen[j] and self._is_match(i, int(j))]
+
+        if self.mode == 'parity':
+            self.num_pairs += self.num_seen_distinct
+            self.identical_tweet_pairs += (1 if self.seen[i] else 0) + len(matches)
+        else:
+            self.num_pairs += self.num_seen
+            self.identical_tweet_pairs += self.seen[i] + sum(self.seen[j] for j in matches)
+        if not self.seen[i]: self.num_seen_distinct += 1
+        self.seen[i] += 1
+        self.num_seen += 1
+
+    # writes the length and histogram of distinct text i, doubling the arrays when they are full
+    def _store(self, i: int, text: str):
+        if i >= len(self.lengths):
+            self.lengths = np.concatenate([self.lengths, np.zeros_like(self.lengths)])
+            self.histograms = np.concatenate([self.histograms, np.zeros_like(self.histograms)])
+        lengths, histograms = _length_and_histograms([text])
+        self.lengths[i], self.histograms[i] = lengths[0], histograms[0]
+        position = bisect.bisect_right(self.sorted_lengths, len(text))
+        self.sorted_lengths.insert(position, len(text))
+        self.sorted_ids.insert(position, i)
+
+    # fuzz.ratio isn't guaranteed to be symmetric, so cache each direction separately
+    def _is_match(self, i: int, j: int):
+        key = (i, j)
+        if key not in self.verified:
+            pair = (self.distinct[i], self.distinct[j])
+            if self.match_cache is not None and pair in self.match_cache:
+                self.verified[key] = self.match_cache[pair]
+            else:
+                self.verified[key] = fuzz.ratio(*pair) >= self.similarity_score_test_mark
+                if self.match_cache is not None: self.match_cache[pair] = self.verified[key]
+        return self.verified[key]
+
+    # returns (identical tweet pairs, total pairs) so far
+    def counts(self):
+        return self.identical_tweet_pairs, self.num_pairs
@@ -0,0 +1,25 @@
+import asyncio
+
+# Coalesces concurrent calls with the same key into one computation:
+# the first caller starts it and everyone who asks for the same key while it runs awaits the same result
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+
+    # returns the result of fn(), sharing it with concurrent callers of the same key
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        # a task from another (already finished) event loop can't be awaited here
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        # one caller disconnecting must not cancel the computation for the others
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self._calls.get(key) is task: self._calls.pop(key)
+        if not task.cancelled(): task.exception() # mark as retrieved, waiting callers get it from the shield
+
+    def __len__(self):
+        return len(self._calls)
@@ -0,0 +1,123 @@
+import asyncio
+import time
+from helpers import get_sentiment_scores
+from similarity import SimilarityIndex, SIMILARITY_SCORE_TEST_MARK
+from metrics import span
+
+# Streaming tweet pipeline: pages of a timeline are fetched by a producer task and aggregated by a consumer
+# as soon as they arrive, so sentiment scoring and similarity checks of one page overlap the fetch of the next
+# and the features are ready right after the last page comes back
+
+# Running totals of a user's timeline, updated one page at a time
+# counts match the loops in predict.compute_features and dataset.analyze_user_data over the first `target` tweets
+# texts are scored by get_sentiment_scores, or by `scorer` (e.g. a helpers.SentimentBatcher shared by many users)
+class TimelineAggregator:
+    def __init__(self, sentiment_analyzer, target: int, description: str = None, similarity_score_test_mark=SIMILARITY_SCORE_TEST_MARK, scorer=None):
+        self.sentiment_analyzer = sentiment_analyzer
+        self.scorer = scorer or (lambda texts: get_sentiment_scores(texts, sentiment_analyzer))
+        self.target = target
+        self.description = description
+        self.description_sentiment = None
+        self.similarity = SimilarityIndex(similarity_score_test_mark)
+        self.tweets_count = 0
+        self.parsed_owned_tweets_count, self.parsed_owned_text_tweets_count, self.parsed_retweets_count = 0, 0, 0
+        self.likes_count, self.replies_count, self.retweets_count = 0, 0, 0
+        self.reply_tweets_count, self.quotes_tweet_count, self.urls_count, self.hashtags_count = 0, 0, 0, 0
+        self.sentiment = 0
+        self.timed_out = False
+
+    @property
+    def is_full(self):
+        return self.tweets_count >= self.target
+
+    # counts a page of tweets, scores its texts and adds them to the similarity index
+    # CPU-bound, the pipeline runs it on a worker thread
+    def add_page(self, tweets: list):
+        tweets = tweets[:self.target - self.tweets_count]
+        self.tweets_count += len(tweets)
+        texts = []
+
+        with span('similarity'):
+            for tweet in tweets:
+                if tweet.text: self.similarity.add(tweet.text.lower().strip())
+
+        for tweet in tweets:
+            if tweet.retweeted_tweet:
+                self.parsed_retweets_count += 1
+                continue
+            if tweet.text:
+                texts.append(tweet.text)
+                self.parsed_owned_text_tweets_count += 1
+            if tweet.in_reply_to: self.reply_tweets_count += 1
+            if tweet.is_quote_status: self.quotes_tweet_count += 1
+            self.parsed_owned_tweets_count += 1
+            self.hashtags_count += len(tweet.hashtags)
+            self.likes_count += tweet.favorite_count
+            self.replies_count += tweet.reply_count
+            self.retweets_count += tweet.retweet_count
+            self.urls_count += len(tweet.urls)
+
+        # the profile description rides along with the first batch of tweets
+        if self.description and self.description_sentiment is None: texts.append(self.description)
+        if not texts: return
+        scores = self.scorer(texts)
+        if self.description and self.description_sentiment is None:
+            self.description_sentiment = scores.pop()
+        self.sentiment += sum(scores)
+
+    # scores the description if no page had any text to score it with
+    def finish(self):
+        if self.description and self.description_sentiment is None:
+            self.description_sentiment = self.scorer([self.description])[0]
+        return self
+
+    # returns (identical tweet pairs, total pairs) of the tweets so far
+    def similarity_counts(self):
+        return self.similarity.counts()
+
+# yields pages of a timeline, stopping once target tweets have been yielded
+# fetch_first returns the first page (e.g. lambda: client.get_user_tweets(user_id, 'Tweets', count=target)),
+# following pages come from page.next(); the first `skip` tweets are dropped, so a fetch that is restarted
+# (e.g. on another session after a rate limit) picks up where the previous one stopped
+# before_request is awaited before every request and after_request called after each successful one
+async def iterate_pages(fetch_first, target: int, skip=0, before_request=None, after_request=None):
+    taken = 0
+    if before_request: await before_request()
+    res = await fetch_first()
+    if after_request: after_request()
+    while res and taken < target:
+        page = list(res)[:target - taken]
+        taken += len(page)
+        if taken > skip: yield page[max(0, skip - (taken - len(page))):]
+        if taken >= target: break # don't spend a request on a page we won't use
+        if before_request: await before_request()
+        res = await res.next()
+        if after_request: after_request()
+
+# feeds every page from pages (an async iterator) into the aggregator as soon as it arrives
+# with a deadline (time.monotonic() value), fetching stops when it passes and the aggregator keeps the pages received by then
+# errors from fetching are raised once the pages received before them have been aggregated
+async def aggregate_timeline(pages, aggregator: TimelineAggregator, deadline: float = None):
+    queue = asyncio.Queue()
+
+    async def produce():
+        try:
+            async for page in pages:
+                await queue.put(page)
+        finally:
+            queue.put_nowait(None)
+
+    producer = asyncio.ensure_future(produce())
+    timer = asyncio.get_running_loop().call_later(max(0, deadline - time.monotonic()), producer.cancel) if deadline is not None else None
+    try:
+        while (page := await queue.get()) is not None:
+            if page: await asyncio.to_thread(aggregator.add_page, page)
+    finally:
+        if timer: timer.cancel()
+        producer.cancel()
+
+    if producer.cancelled():
+        aggregator.timed_out = True
+    elif producer.exception():
+        raise producer.exception()
+    return aggregator
@@ -0,0 +1,200 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime, timezone
+import numpy as np
+from datastore import load_dataset, DATASET_STORE_PATH, DATASET_CSV_PATH
+from forest import CompiledForest, get_forest_path
+from helpers import features_dict
+from metrics import start_trace, span
+from registry import MODELS_DIR, MODEL_FILENAME, METADATA_FILENAME, get_model_version, set_latest_version
+
+# Training pipeline of the bot classifier: builds the feature matrix (cached between runs), optionally searches
+# hyperparameters over cached cross-validation folds, fits the forest on every core, evaluates it on the held out split
+# and writes a versioned artifact models/<version>/ (model.joblib, the compiled model.forest/ and metadata.json)
+# the version is the content hash of model.joblib, the same one the registry, the compiled forest and the result cache use
+# usage: python train.py                                  (default parameters, serve it with --promote or MODEL_VERSION)
+#        python train.py --search --iterations 30 --promote
+#        python train.py --jobs 4 --no-cache
+
+FEATURES = list(features_dict) # column order of the feature matrix, the order predict.build_features produces
+TARGET = 'is_bot'
+CACHE_DIR = os.path.join(MODELS_DIR, 'cache')
+TEST_SIZE = 0.2
+SPLIT_SEED = 82 # the split model.py always used, so metrics stay comparable between versions
+DEFAULT_PARAMS = {'n_estimators': 100, 'criterion': 'entropy'}
+SEARCH_SPACE = {
+    'n_estimators': [100, 200, 400],
+    'criterion': ['gini', 'entropy'],
+    'max_depth': [None, 10, 20, 40],
+    'min_samples_leaf': [1, 2, 4, 8],
+    'max_features': ['sqrt', 'log2', 0.5],
+    'class_weight': [None, 'balanced'],
+}
+
+# returns the files load_dataset reads, the dataset store's parts when there are any and dataset.csv otherwise
+def get_dataset_files(store_path=DATASET_STORE_PATH, csv_path=DATASET_CSV_PATH):
+    return sorted(glob.glob(os.path.join(store_path, 'part-*.arrow'))) or [csv_path]
+
+# returns a content hash of the training data and the feature order, the key of the cached feature matrix
+def get_data_hash(files: list):
+    sha = hashlib.sha256(json.dumps([FEATURES, TARGET]).encode())
+    for path in files:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()[:16]
+
+# returns (X, y) in FEATURES order, missing values count as 0 like in the notebook
+def build_matrix(df):
+    df = df.fillna(0)
+    return df[FEATURES].to_numpy(dtype=np.float64), df[TARGET].to_numpy(dtype=np.int64)
+
+# returns (X, y), from the cache when the data hasn't changed since the last run
+def load_matrix(data_hash: str, use_cache=True):
+    path = os.path.join(CACHE_DIR, f"features-{data_hash}.npz")
+    if use_cache and os.path.exists(path):
+        with np.load(path) as cached:
+            return cached['X'], cached['y'], True
+    with span('train_load'):
+        df = load_dataset()
+    with span('train_features'):
+        X, y = build_matrix(df)
+    if use_cache: save_npz(path, X=X, y=y)
+    return X, y, False
+
+# returns (train indices, test indices, [(fold train, fold validation)] within the train split), cached like the matrix
+# the folds are stratified so every one of them sees both classes in the dataset's proportion
+def load_splits(data_hash: str, y: np.ndarray, folds: int, seed: int, use_cache=True):
+    from sklearn.model_selection import StratifiedKFold, train_test_split
+    path = os.path.join(CACHE_DIR, f"splits-{data_hash}-{TEST_SIZE}-{SPLIT_SEED}-{folds}-{seed}.npz")
+    if use_cache and os.path.exists(path):
+        with np.load(path) as cached:
+            return cached['train'], cached['test'], [(cached[f"fold{i}_train"], cached[f"fold{i}_validation"]) for i in range(folds)]
+    train, test = train_test_split(np.arange(len(y)), test_size=TEST_SIZE, random_state=SPLIT_SEED)
+    cv = list(StratifiedKFold(folds, shuffle=True, random_state=seed).split(train, y[train])) if folds > 1 else []
+    if use_cache:
+        save_npz(path, train=train, test=test, **{f"fold{i}_{part}": indices for i, fold in enumerate(cv) for part, indices in zip(('train', 'validation'), fold)})
+    return train, test, cv
+
+def save_npz(path: str, **arrays):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, path) # a half written cache is never picked up
+
+# randomized search over SEARCH_SPACE on the precomputed folds, the candidates run in parallel (one core each)
+# returns (best params, best mean validation score)
+def search_params(X_train, y_train, cv: list, iterations: int, scoring: str, jobs: int, seed: int):
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.model_selection import RandomizedSearchCV
+    search = RandomizedSearchCV(RandomForestClassifier(random_state=seed, n_jobs=1), SEARCH_SPACE, n_iter=iterations, scoring=scoring,
+                                cv=cv, n_jobs=jobs, random_state=seed, refit=False)
+    search.fit(X_train, y_train)
+    return search.best_params_, float(search.best_score_)
+
+def evaluate(model, X_test, y_test):
+    from sklearn.metrics import accuracy_score, classification_report, confusion_matrix, f1_score, precision_score, recall_score, roc_auc_score
+    y_pred = model.predict(X_test)
+    probabilities = model.predict_proba(X_test)[:, list(model.classes_).index(1)]
+    print('Classification report: \n', classification_report(y_test, y_pred))
+    return {
+        'accuracy': round(float(accuracy_score(y_test, y_pred)), 4),
+        'precision': round(float(precision_score(y_test, y_pred)), 4),
+        'recall': round(float(recall_score(y_test, y_pred)), 4),
+        'f1': round(float(f1_score(y_test, y_pred)), 4),
+        'roc_auc': round(float(roc_auc_score(y_test, probabilities)), 4),
+        'confusion_matrix': confusion_matrix(y_test, y_pred).tolist(),
+        'test_rows': int(len(y_test)),
+    }
+
+# writes models/<version>/ and returns its path; the compiled forest is checked against the model before anything is kept
+def export(model, metadata: dict, X_check):
+    import joblib
+    os.makedirs(MODELS_DIR, exist_ok=True)
+    tmp_dir = os.path.join(MODELS_DIR, f".tmp-{os.getpid()}")
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        model_path = os.path.join(tmp_dir, MODEL_FILENAME)
+        joblib.dump(model, model_path)
+        version = get_model_version(model_path)
+        forest = CompiledForest.from_sklearn(model, version)
+        if not np.allclose(forest.predict_proba(X_check), model.predict_proba(X_check)): raise RuntimeError('The compiled forest disagrees with the model.')
+        forest.save(get_forest_path(model_path))
+        with open(os.path.join(tmp_dir, METADATA_FILENAME), 'w') as f:
+            json.dump({'version': version, **metadata}, f, indent=2)
+        path = os.path.join(MODELS_DIR, version)
+        if os.path.exists(path): shutil.rmtree(path) # the same model retrained, e.g. with other timings
+        os.replace(tmp_dir, path)
+        return version, path
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train the bot classifier and write a versioned model artifact')
+    parser.add_argument('--jobs', type=int, default=-1, help='cores used to fit trees and search candidates, -1 for all')
+    parser.add_argument('--search', action='store_true', help='randomized hyperparameter search before the final fit')
+    parser.add_argument('--iterations', type=int, default=20, help='search candidates')
+    parser.add_argument('--folds', type=int, default=5, help='cross-validation folds of the search')
+    parser.add_argument('--scoring', default='f1', help='sklearn scorer the search maximizes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-cache', action='store_true', help='rebuild the feature matrix and splits')
+    parser.add_argument('--promote', action='store_true', help='point models/LATEST at the new version so the registry serves it')
+    args = parser.parse_args(argv)
+
+    from sklearn import __version__ as sklearn_version
+    from sklearn.ensemble import RandomForestClassifier
+
+    trace = start_trace('train')
+    use_cache = not args.no_cache
+    with span('train_hash'):
+        files = get_dataset_files()
+        data_hash = get_data_hash(files)
+    X, y, cached = load_matrix(data_hash, use_cache)
+    print(f"Feature matrix {X.shape[0]} x {X.shape[1]} ({'cached' if cached else 'built'}), data hash {data_hash}")
+    with span('train_split'):
+        train, test, cv = load_splits(data_hash, y, args.folds if args.search else 0, args.seed, use_cache)
+    X_train, y_train, X_test, y_test = X[train], y[train], X[test], y[test]
+
+    params, search = dict(DEFAULT_PARAMS), None
+    if args.search:
+        with span('train_search'):
+            best_params, best_score = search_params(X_train, y_train, cv, args.iterations, args.scoring, args.jobs, args.seed)
+        params = best_params
+        search = {'iterations': args.iterations, 'folds': args.folds, 'scoring': args.scoring, 'best_score': round(best_score, 4), 'best_params': best_params}
+        print(f"Best {args.scoring} {best_score:.4f} over {args.folds} folds with {best_params}")
+
+    with span('train_fit'):
+        model = RandomForestClassifier(**params, random_state=args.seed, n_jobs=args.jobs)
+        model.fit(X_train, y_train)
+        model.n_jobs = None # serving predicts one request at a time, without a thread pool per call
+    with span('train_evaluate'):
+        metrics = evaluate(model, X_test, y_test)
+
+    metadata = {
+        'trained_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'features': FEATURES,
+        'classes': [int(c) for c in model.classes_],
+        'data': {'hash': data_hash, 'files': [os.path.basename(path) for path in files], 'rows': int(len(y)), 'bots': int(y.sum())},
+        'split': {'test_size': TEST_SIZE, 'seed': SPLIT_SEED, 'train_rows': int(len(train))},
+        'params': {**params, 'random_state': args.seed},
+        'search': search,
+        'metrics': metrics,
+        'sklearn_version': sklearn_version,
+    }
+    with span('train_export'):
+        metadata['stages'] = {stage: round(seconds, 3) for stage, _, seconds in trace.spans}
+        version, path = export(model, metadata, X_test)
+
+    print(trace.format())
+    print(f"Saved model version {version} to {path} (accuracy {metrics['accuracy']}, f1 {metrics['f1']}, roc auc {metrics['roc_auc']})")
+    if args.promote:
+        set_latest_version(version)
+        print(f"Promoted {version}, POST /reload to serve it without a restart.")
+    return version
+
+if __name__ == '__main__':
+    main()
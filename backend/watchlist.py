@@ -0,0 +1,319 @@
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+from clients import client_pool, timeline_cost
+from images import image_analyzer
+from registry import registry
+from retry import Deadline, retry
+from helpers import get_age, get_sentiment_scores
+from similarity import SimilarityIndex
+from streaming import iterate_pages
+from metrics import span
+from predict import FETCH_DEADLINE, FETCH_RETRY, TARGET_TWEETS, CONFIDENCE_HIGH, IMAGE_GRACE, DEFAULT_PROFILE_IMAGE_VALID, build_features, predict_features, invalid_prediction, lower_confidence
+
+# Watchlist of accounts that are re-scored regularly (e.g. daily) without refetching their whole timeline
+# each account keeps the latest WINDOW_TWEETS tweets as small per-tweet records plus running sums of them;
+# a refresh only fetches tweets newer than the last one seen (usually a single page), pushes them into the window,
+# subtracts the tweets that fall out of it and reruns the model
+# engagement (likes, replies, retweets) of tweets already in the window isn't refetched, so the window is rebuilt
+# from scratch every FULL_REFRESH_AGE to keep those counts from going stale
+# usage: python watchlist.py add elonmusk nasa | remove nasa | list | refresh [--full]
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+WATCHLIST_PATH = os.environ.get('WATCHLIST_PATH', os.path.join(dir_path, 'watchlist.sqlite3'))
+WINDOW_TWEETS = TARGET_TWEETS
+FULL_REFRESH_AGE = 7 * 24 * 60 * 60 # seconds
+REFRESH_CONCURRENCY = 4
+
+# running sums over the window, named like the streaming.TimelineAggregator counts build_features reads
+SUM_FIELDS = ('parsed_owned_tweets_count', 'parsed_owned_text_tweets_count', 'parsed_retweets_count', 'reply_tweets_count', 'quotes_tweet_count',
+              'likes_count', 'replies_count', 'retweets_count', 'urls_count', 'hashtags_count', 'sentiment')
+
+# returns what a tweet adds to the sums, counted by the same rules as TimelineAggregator.add_page
+# text is the normalized text used for near-duplicate detection, sentiment is scored separately for owned tweets
+def tweet_record(tweet):
+    record = {'id': tweet.id, 'text': tweet.text.lower().strip() if tweet.text else None}
+    if tweet.retweeted_tweet:
+        record['parsed_retweets_count'] = 1
+        return record
+    record.update({
+        'parsed_owned_tweets_count': 1,
+        'parsed_owned_text_tweets_count': 1 if tweet.text else 0,
+        'reply_tweets_count': 1 if tweet.in_reply_to else 0,
+        'quotes_tweet_count': 1 if tweet.is_quote_status else 0,
+        'likes_count': tweet.favorite_count,
+        'replies_count': tweet.reply_count,
+        'retweets_count': tweet.retweet_count,
+        'urls_count': len(tweet.urls),
+        'hashtags_count': len(tweet.hashtags),
+        'sentiment': 0,
+    })
+    return record
+
+# Persisted state of one watched account
+class WatchState:
+    def __init__(self, screen_name: str, user_id=None, window=None, sums=None, description=None, description_sentiment=None,
+                 profile_image_url=None, is_profile_image_valid=None, matches=None, full_refreshed_at=0, refreshed_at=0, result=None):
+        self.screen_name = screen_name
+        self.user_id = user_id
+        self.window = window or [] # tweet records in timeline order: the pinned tweet (if any, marked 'pinned') then the newest first
+        self.sums = sums or dict.fromkeys(SUM_FIELDS, 0)
+        self.description, self.description_sentiment = description, description_sentiment
+        self.profile_image_url, self.is_profile_image_valid = profile_image_url, is_profile_image_valid
+        self.matches = matches or {} # similarity.SimilarityIndex match cache of the window's texts
+        self.full_refreshed_at = full_refreshed_at
+        self.refreshed_at = refreshed_at
+        self.result = result
+
+    # the newest tweet in the window, the pinned tweet aside (an older pinned tweet must not stand in for it)
+    @property
+    def last_seen_id(self):
+        return max((int(record['id']) for record in self.window if not record.get('pinned')), default=None)
+
+    @property
+    def pinned_id(self):
+        return self.window[0]['id'] if self.window and self.window[0].get('pinned') else None
+
+    def reset(self, user_id):
+        self.__init__(self.screen_name, user_id, result=self.result)
+
+    # adds new tweet records (newest first) in front of the window, after the pinned tweet that stays on top,
+    # and drops the ones pushed out of it
+    def push(self, records: list, window_size=WINDOW_TWEETS):
+        pinned = self.window[:1] if self.pinned_id is not None else []
+        self.window = pinned + records + self.window[len(pinned):]
+        evicted, self.window = self.window[window_size:], self.window[:window_size]
+        for record in records:
+            for field in SUM_FIELDS: self.sums[field] += record.get(field, 0)
+        for record in evicted:
+            for field in SUM_FIELDS: self.sums[field] -= record.get(field, 0)
+
+    # recounts near-duplicate pairs over the window in timeline order, only pairs of new texts go through fuzz.ratio
+    def similarity_counts(self):
+        index = SimilarityIndex(match_cache=self.matches)
+        for record in self.window:
+            if record['text']: index.add(record['text'])
+        texts = set(index.distinct)
+        self.matches = {pair: match for pair, match in self.matches.items() if pair[0] in texts and pair[1] in texts}
+        return index.counts()
+
+    # the window's counts in the shape predict.build_features reads
+    def timeline(self):
+        counts = self.similarity_counts()
+        return SimpleNamespace(**self.sums, tweets_count=len(self.window), description_sentiment=self.description_sentiment, similarity_counts=lambda: counts)
+
+    def to_dict(self):
+        # matching pairs reference the first window position of each text instead of repeating it
+        positions = {}
+        for position, record in enumerate(self.window):
+            if record['text'] is not None: positions.setdefault(record['text'], position)
+        matches = [[positions[a], positions[b], match] for (a, b), match in self.matches.items() if a in positions and b in positions]
+        return {
+            'screen_name': self.screen_name, 'user_id': self.user_id, 'window': self.window, 'sums': self.sums,
+            'description': self.description, 'description_sentiment': self.description_sentiment,
+            'profile_image_url': self.profile_image_url, 'is_profile_image_valid': self.is_profile_image_valid,
+            'matches': matches, 'full_refreshed_at': self.full_refreshed_at, 'refreshed_at': self.refreshed_at, 'result': self.result,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        window = data.get('window') or []
+        matches = {(window[a]['text'], window[b]['text']): match for a, b, match in data.get('matches') or []}
+        return cls(data['screen_name'], data.get('user_id'), window, data.get('sums'), data.get('description'), data.get('description_sentiment'),
+                   data.get('profile_image_url'), data.get('is_profile_image_valid'), matches, data.get('full_refreshed_at', 0), data.get('refreshed_at', 0), data.get('result'))
+
+# Watched accounts and their state in a local SQLite file, states are stored as JSON
+class WatchlistStore:
+    def __init__(self, path=WATCHLIST_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.reopen()
+
+    # opens the connection, called again in forked workers since SQLite connections must not be used across a fork
+    def reopen(self):
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS watchlist (screen_name TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)')
+
+    # returns True if the account wasn't watched yet
+    def add(self, screen_name: str):
+        state = json.dumps(WatchState(screen_name).to_dict())
+        with self._lock:
+            return self._conn.execute('INSERT OR IGNORE INTO watchlist (screen_name, state, updated_at) VALUES (?, ?, ?)', (screen_name.lower(), state, time.time())).rowcount > 0
+
+    def remove(self, screen_name: str):
+        with self._lock:
+            return self._conn.execute('DELETE FROM watchlist WHERE screen_name = ?', (screen_name.lower(),)).rowcount > 0
+
+    def names(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute('SELECT screen_name FROM watchlist ORDER BY screen_name')]
+
+    def get(self, screen_name: str):
+        with self._lock:
+            row = self._conn.execute('SELECT state FROM watchlist WHERE screen_name = ?', (screen_name.lower(),)).fetchone()
+        return WatchState.from_dict(json.loads(row[0])) if row else None
+
+    def put(self, state: WatchState):
+        data = json.dumps(state.to_dict())
+        with self._lock:
+            self._conn.execute('UPDATE watchlist SET state = ?, updated_at = ? WHERE screen_name = ?', (data, time.time(), state.screen_name.lower()))
+
+    # returns the latest result of every watched account
+    def results(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT screen_name, state FROM watchlist ORDER BY screen_name').fetchall()
+        results = []
+        for screen_name, data in rows:
+            state = json.loads(data)
+            results.append({'screen_name': screen_name, 'refreshed_at': state.get('refreshed_at') or None, 'result': state.get('result')})
+        return results
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM watchlist').fetchone()[0]
+
+# collects the tweets newer than last_seen_id (every tweet on a full fetch, last_seen_id None) into progress['tweets'],
+# newest first, scanning at most the `limit` tweets /predict and the crawler sample. The timeline is newest first, so
+# paging stops at the first tweet already seen; the top tweet is held until the next one shows whether it's a pinned
+# tweet (older than the tweet below it), which goes to progress['pinned'] instead of ending an incremental fetch
+# A retry (progress kept) continues after the tweets scanned so far
+async def fetch_new_tweets(client, user_id: str, last_seen_id: int, progress: dict, limit=WINDOW_TWEETS):
+    def is_new(tweet):
+        return last_seen_id is None or int(tweet.id) > last_seen_id
+
+    pages = iterate_pages(lambda: client.get_user_tweets(user_id, 'Tweets', count=limit), limit, skip=progress['scanned'])
+    async for page in pages:
+        for tweet in page:
+            position, progress['scanned'] = progress['scanned'], progress['scanned'] + 1
+            if position == 0:
+                progress['first'] = tweet
+                continue
+            first = progress.pop('first', None)
+            if first is not None:
+                if int(first.id) < int(tweet.id): progress['pinned'] = first
+                elif is_new(first): progress['tweets'].append(first)
+            if not is_new(tweet):
+                await pages.aclose()
+                return
+            progress['tweets'].append(tweet)
+    # a timeline of a single tweet has nothing to compare it with, it's taken as a regular tweet
+    first = progress.pop('first', None)
+    if first is not None and is_new(first): progress['tweets'].append(first)
+
+# fetches what changed since the last refresh, updates the state in place and returns the new prediction
+# the state is only changed when every new tweet was fetched, a failed refresh leaves it as it was
+async def refresh_account(state: WatchState, artifacts, full=False, deadline=FETCH_DEADLINE):
+    budget = Deadline(deadline)
+    user = await retry(lambda: client_pool.run(lambda client: client.get_user_by_screen_name(state.screen_name)), FETCH_RETRY, budget, 'user_lookup')
+    if not user: return invalid_prediction("User not found.")
+
+    full = full or state.user_id != user.id or state.last_seen_id is None or time.time() - state.full_refreshed_at > FULL_REFRESH_AGE
+    last_seen_id = None if full else state.last_seen_id
+    image_changed = state.is_profile_image_valid is None or user.profile_image_url != state.profile_image_url
+    image_task = asyncio.ensure_future(image_analyzer.analyze(user.profile_image_url)) if image_changed else None
+
+    # a full fetch pages through the whole window, an incremental one usually takes a single page
+    async def fetch():
+        cost = timeline_cost(WINDOW_TWEETS) if last_seen_id is None else 1
+        await retry(lambda: client_pool.run(lambda client: fetch_new_tweets(client, user.id, last_seen_id, progress), cost=cost), FETCH_RETRY, budget, 'watchlist')
+
+    progress = {'tweets': [], 'scanned': 0}
+    with span('watchlist_fetch'):
+        try:
+            await fetch()
+            # a newly pinned (or unpinned) tweet sits elsewhere in a from-scratch sample, so the window is rebuilt
+            if not full and (progress['pinned'].id if 'pinned' in progress else None) != state.pinned_id:
+                full, last_seen_id, progress = True, None, {'tweets': [], 'scanned': 0}
+                await fetch()
+        except Exception as e:
+            if image_task: image_task.cancel()
+            print(f"Error refreshing user {state.screen_name}: {e}")
+            return invalid_prediction("Unable to fetch the user's tweets. Try again later.")
+
+    # like /predict: an image that can't be analyzed in time falls back to the default at a lower confidence,
+    # and isn't remembered, so the next refresh analyzes it again
+    confidence, image_url, is_profile_image_valid = CONFIDENCE_HIGH, user.profile_image_url, state.is_profile_image_valid
+    try:
+        if image_task: is_profile_image_valid = await asyncio.wait_for(image_task, max(budget.remaining(), IMAGE_GRACE) if budget.expires_at is not None else None)
+    except Exception as e:
+        print(f"Error analyzing profile image for user {state.screen_name}: {e!r}")
+        is_profile_image_valid, confidence, image_url = DEFAULT_PROFILE_IMAGE_VALID, lower_confidence(confidence), None
+
+    if full: state.reset(user.id)
+    pinned = progress.get('pinned') if full else None # an unchanged pinned tweet stays on top of the window
+    new_tweets = ([pinned] if pinned else []) + progress['tweets']
+    records = [tweet_record(tweet) for tweet in new_tweets]
+    if pinned: records[0]['pinned'] = True
+
+    # only new tweets (and a changed description) go through the sentiment model
+    texts = [tweet.text for tweet, record in zip(new_tweets, records) if record.get('parsed_owned_text_tweets_count')]
+    description_changed = user.description and (user.description != state.description or state.description_sentiment is None)
+    if description_changed: texts.append(user.description)
+    scores = await asyncio.to_thread(get_sentiment_scores, texts, artifacts.sentiment_analyzer) if texts else []
+    if description_changed: state.description_sentiment = scores.pop()
+    state.description = user.description
+    for record, score in zip((record for record in records if record.get('parsed_owned_text_tweets_count')), scores):
+        record['sentiment'] = score
+
+    state.push(records)
+    if not state.window: return invalid_prediction("User is either private or has no tweets to analyze.")
+    state.profile_image_url, state.is_profile_image_valid = image_url, is_profile_image_valid
+
+    timeline = await asyncio.to_thread(state.timeline)
+    features = build_features(user, get_age(user.created_at), timeline, is_profile_image_valid)
+    result = {**await asyncio.to_thread(predict_features, features, artifacts), 'confidence': confidence}
+
+    now = time.time()
+    if full: state.full_refreshed_at = now
+    state.refreshed_at, state.result = now, result
+    return {**result, 'new_tweets': len(new_tweets), 'full_refresh': full}
+
+# refreshes every watched account, yielding {'screen_name': ..., **prediction} as each one finishes
+async def refresh_watchlist(store: WatchlistStore, full=False, concurrency=REFRESH_CONCURRENCY):
+    artifacts = await asyncio.to_thread(registry.get)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def refresh(screen_name):
+        async with semaphore:
+            state = await asyncio.to_thread(store.get, screen_name)
+            if state is None: return {'screen_name': screen_name, 'error': 'Not on the watchlist.'}
+            try:
+                result = await refresh_account(state, artifacts, full)
+            except Exception as e:
+                print(f"Exception caught: {e}")
+                return {'screen_name': screen_name, 'error': str(e)}
+            if 'error' not in result: await asyncio.to_thread(store.put, state)
+            return {'screen_name': screen_name, **result}
+
+    for task in asyncio.as_completed([refresh(screen_name) for screen_name in store.names()]):
+        yield await task
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage and refresh the watchlist')
+    parser.add_argument('--path', default=WATCHLIST_PATH)
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('add').add_argument('screen_names', nargs='+')
+    commands.add_parser('remove').add_argument('screen_names', nargs='+')
+    commands.add_parser('list')
+    refresh_parser = commands.add_parser('refresh')
+    refresh_parser.add_argument('--full', action='store_true', help='refetch every window from scratch')
+    args = parser.parse_args()
+
+    store = WatchlistStore(args.path)
+    if args.command == 'add':
+        print(f"Added {sum(store.add(screen_name) for screen_name in args.screen_names)} accounts.")
+    elif args.command == 'remove':
+        print(f"Removed {sum(store.remove(screen_name) for screen_name in args.screen_names)} accounts.")
+    elif args.command == 'list':
+        for entry in store.results(): print(json.dumps(entry))
+    else:
+        async def main():
+            async for result in refresh_watchlist(store, args.full): print(json.dumps(result))
+        asyncio.run(main())